@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+"""
+python3 scripts <command> [options], see cli.py
+"""
+from cli import main
+
+main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+persistent store of the per-genome CAZy family counts behind the aggregated matrix
+
+every genome is recorded with the size, modification time and SHA-256 of the
+overview.txt it was counted from, so that an incremental summary only re-parses the
+added or modified files and drops the genomes whose files are gone; the matrix is
+then rebuilt from the stored counts without reading the unchanged overview files.
+"""
+import os
+import json
+
+from utils import sha256sum
+
+STORE = 'aggregate_store.json'
+
+# bumped whenever the stored counts are no longer comparable
+STORE_VERSION = 1
+
+
+def file_state(filename):
+    """
+    :param filename: <str> path to the file
+    :return: <dict> absolute path, size and modification time of the file
+    """
+    st = os.stat(filename)
+    return dict(path=os.path.abspath(filename), size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+
+def load_store(store_file, settings):
+    """
+    read the stored genome counts, discarding them if they were made with other settings
+
+    :param store_file: <str> path to the store
+    :param settings: <dict> summary settings the counts depend on
+    :return: <dict> genome id -> record
+    """
+    try:
+        with open(store_file) as f_in:
+            store = json.load(f_in)
+    except (OSError, ValueError):
+        return dict()
+    if store.get('version') != STORE_VERSION or store.get('settings') != settings:
+        print("aggregate store {} was built with other settings, rebuilding it".format(store_file))
+        return dict()
+    return store.get('genomes', dict())
+
+
+def save_store(store_file, genomes, settings):
+    """
+    write the store atomically
+
+    :param store_file: <str> path to the store
+    :param genomes: <dict> genome id -> record
+    :param settings: <dict> summary settings the counts depend on
+    :return:
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(store_file)), exist_ok=True)
+    tmp = store_file + '.tmp'
+    with open(tmp, 'w') as f_out:
+        json.dump(dict(version=STORE_VERSION, settings=settings, genomes=genomes), f_out)
+    os.replace(tmp, store_file)
+
+
+def plan_update(genomes, genome_files):
+    """
+    compare the overview files on disk with the store
+
+    a file whose size and modification time are unchanged is taken as unchanged, otherwise
+    it is hashed and only re-parsed if its content differs from the stored one
+
+    :param genomes: <dict> genome id -> record, the state of touched but identical files is refreshed
+    :param genome_files: list of (genome id, overview file) tuples
+    :return: <tuple> (list of (genome id, overview file, file state) to parse, list of removed genome ids)
+    """
+    changed = []
+    for genome, filename in genome_files:
+        state = file_state(filename)
+        record = genomes.get(genome)
+        if record is not None and all(record.get(k) == v for k, v in state.items()):
+            continue
+        state['sha256'] = sha256sum(filename)
+        if record is not None and record.get('sha256') == state['sha256']:
+            record.update(state)
+            continue
+        changed.append((genome, filename, state))
+
+    present = set(genome for genome, filename in genome_files)
+    removed = sorted(genome for genome in genomes if genome not in present)
+    return changed, removed
+
+
+def store_record(state, families, counts):
+    """
+    :param state: <dict> state of the overview file the counts were made from, as returned by plan_update
+    :param families: CAZy families
+    :param counts: count of every family
+    :return: <dict> store record
+    """
+    record = dict(state)
+    record['families'] = [str(f) for f in families]
+    record['counts'] = [int(c) for c in counts]
+    return record
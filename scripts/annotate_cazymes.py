@@ -23,20 +23,36 @@ from textwrap import dedent
 from utils import mkdir
 from utils import find_executable
 from utils import run_shell_command
-
-logfile = os.path.splitext(os.path.basename(os.path.abspath(__file__)))[0] + '.log'
-logging.getLogger().setLevel(logging.DEBUG)
-logFormatter = logging.Formatter('[%(asctime)s] - %(''levelname)s - %(message)s', datefmt='%Y-%m-%d %I:%M:%S %p')
-
-# fileHandler = logging.FileHandler(filename=logfile)
-# fileHandler.setFormatter(logFormatter)
-# logging.getLogger().addHandler(fileHandler)
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-logging.getLogger().addHandler(consoleHandler)
-
-f_out = open(logfile, 'w')
+from utils import fasta_stem
+from utils import read_fasta
+from utils import METRICS_ENV
+from utils import available_memory_gb
+from tool_metrics import install_shims
+from batch_annotation import annotate_batch
+from gene_calling import predict_genes
+from scheduler import cpu_budget
+from scheduler import run_jobs
+from result_cache import cache_key
+from result_cache import is_fresh
+from result_cache import read_manifest
+from result_cache import write_manifest
+from result_cache import normalize_tools
+from genome_logs import LOG_FORMAT
+from genome_logs import DATE_FORMAT
+from genome_logs import GenomeLogWriter
+from genome_logs import start_logging
+from sharding import parse_shard
+from sharding import shard_from_env
+from sharding import plan_key
+from sharding import select_shard
+from sharding import write_marker
+from databases import stage
+from profiles import PROFILES
+from profiles import profile_env
+from profiles import resolve_profile
+from profiles import write_profile
+from profiles import max_chunk_mb
+from fasta_index import index_proteins
 
 
 def parse_args():
@@ -83,10 +99,92 @@ def parse_args():
                         help="extra arguments to be passed directly to the run_dbcan.py executable "
                              "(e.g., --dbcan-args='--db_dir dbcan_output_dir')"
                         )
+    parser.add_argument('--batch', action='store_true',
+                        dest='batch',
+                        help="pool the proteins of all genomes and run the annotation once over the whole set, "
+                             "the hits are split back into the per-genome output directories"
+                        )
+    parser.add_argument('--batch-dir', metavar='<dir>',
+                        dest='batch_dir',
+                        help="path to the directory for the pooled query and outputs in batch mode. "
+                             "If not provided, the default is <outDir>/.batch"
+                        )
+    parser.add_argument('--dedup', action='store_true',
+                        dest='dedup',
+                        help="annotate every distinct protein sequence of the genomes once and copy its hits to "
+                             "every gene carrying it, implies --batch"
+                        )
+    parser.add_argument('--gene-cache', metavar='<dir>',
+                        dest='gene_cache', default=None,
+                        help="path to a cache of the prodigal gene predictions. Nucleotide genomes are gene called "
+                             "once and later runs are fed the cached proteins as --seq-type protein"
+                        )
+    parser.add_argument('--metrics', metavar='<file>',
+                        dest='metrics', default=None,
+                        help="append the wall time, CPU time, peak memory and I/O of every external tool run, "
+                             "and the DIAMOND phase timings, to this file as JSON lines"
+                        )
+    parser.add_argument('--log-dir', metavar='<dir>',
+                        dest='log_dir', default=None,
+                        help="path to the directory of the per-genome log files. "
+                             "If not provided, the default is <outDir>/logs"
+                        )
+    parser.add_argument('--log-max-bytes', type=int, metavar='<int>',
+                        dest='log_max_bytes', default=10 * 1024 * 1024,
+                        help="size at which a per-genome log file is rotated"
+                        )
+    parser.add_argument('--log-backups', type=int, metavar='<int>',
+                        dest='log_backups', default=3,
+                        help="number of rotated log files kept per genome"
+                        )
+    parser.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                        dest='jobs', default=1,
+                        help="number of genomes to annotate concurrently, 0 to fill the CPU cores available "
+                             "to this process"
+                        )
+    parser.add_argument('--threads-per-job', type=int, metavar='<int>',
+                        dest='threads_per_job', default=None,
+                        help="number of threads of each job, given to DIAMOND, HMMER and Hotpep within the limits of "
+                             "the profile. If not provided, the available CPU cores are split evenly across the jobs"
+                        )
+    parser.add_argument('--profile', metavar='<str>',
+                        dest='profile', default='default', choices=sorted(PROFILES) + ['auto'],
+                        help="DIAMOND block size and index chunks: 'small-query' for single genomes, 'batch' for "
+                             "pooled queries, 'low-memory' to bound the memory, 'auto' to choose per query from its "
+                             "size and the memory available to each job"
+                        )
+    parser.add_argument('--stage-db', metavar='<dir>',
+                        dest='stage_db', default=None,
+                        help="copy the database directory onto node-local storage, e.g. /dev/shm or $TMPDIR, "
+                             "once per node and annotate against the copy"
+                        )
+    parser.add_argument('--shard', metavar='<i/N>',
+                        dest='shard', default='none',
+                        help="annotate only shard i (0-based) of N size-balanced shards of the genomes. 'auto' takes "
+                             "the shard from SLURM_ARRAY_TASK_ID in a SLURM array job, 'none' annotates all genomes"
+                        )
+    parser.add_argument('--hotpep-index', action='store_true',
+                        dest='hotpep_index',
+                        help="match the Hotpep conserved peptides against the peptide index of the database "
+                             "directory (peptide_index.py build) instead of running the run_dbcan.py Hotpep stage"
+                        )
+    parser.add_argument('--stream-chunk-mb', type=float, metavar='<float>',
+                        dest='chunk_mb', default=None,
+                        help="annotate protein and metagenome inputs larger than this many MB in chunks of whole "
+                             "records of at most this size, merging the chunk outputs into the usual files"
+                        )
+    parser.add_argument('--max-memory', type=float, metavar='<GB>',
+                        dest='max_memory', default=None,
+                        help="memory ceiling in GB of each genome's DIAMOND run: the profile, the auto one "
+                             "included, is replaced by one whose memory estimate fits it and inputs too large for "
+                             "any are streamed in chunks that fit; genomes that cannot fit fail without running. "
+                             "It bounds the estimate, it is not enforced as a process limit"
+                        )
     return parser
 
 
-def dbcan_cazymes(input_file, seq_type, tools, db_dir, out_dir, dbcan_args=""):
+def dbcan_cazymes(input_file, seq_type, tools, db_dir, out_dir, dbcan_args="", threads=None, gene_cache=None,
+                  profile='default', memory_gb=None, hotpep_index=False, chunk_mb=None, max_memory=None):
     """
 
     :param input_file: <str> input file in FASTA format
@@ -95,6 +193,13 @@ def dbcan_cazymes(input_file, seq_type, tools, db_dir, out_dir, dbcan_args=""):
     :param db_dir: <str> path to the database directory
     :param out_dir <str> path to output directory
     :param dbcan_args: <str> extra arguments passed on to the executable
+    :param threads: <int> threads of the job, shared out by the profile to DIAMOND, HMMER and Hotpep
+    :param gene_cache: <str> path to the gene calling cache, nucleotide inputs are annotated from the cached proteins
+    :param profile: <str> performance profile, 'auto' to choose it from the query size and memory_gb
+    :param memory_gb: <float> memory available to the job in GB
+    :param hotpep_index: <bool> write Hotpep.out from the peptide index of the database directory
+    :param chunk_mb: <float> annotate protein and metagenome inputs larger than this in chunks of this size in MB
+    :param max_memory: <float> memory ceiling of the DIAMOND runs in GB, the profile and chunk size are fitted to it
     :return:
     """
 
@@ -102,23 +207,136 @@ def dbcan_cazymes(input_file, seq_type, tools, db_dir, out_dir, dbcan_args=""):
     dbcan = find_executable(['run_dbcan.py'])
 
     tools = list(map(str, tools.split(',')))
+    genome_log = GenomeLogWriter(os.path.basename(out_dir))
 
-    diamond_out = os.path.join(out_dir, 'diamond.out')
-    hmmer_out = os.path.join(out_dir, 'hmmer.out')
-    hotpep_out = os.path.join(out_dir, 'Hotpep.out')
-    if os.path.exists(diamond_out) and os.path.exists(hmmer_out) and os.path.exists(hotpep_out):
-        pass
-        # logging.critical("CAZyme predicted outputs \n{}\n{}\n{} exists!".format(diamond_out, hmmer_out, hotpep_out))
+    # skip the genome only if the cached outputs were produced from the same sequence, database and arguments
+    key = cache_key(input_file=input_file, seq_type=seq_type, tools=" ".join(tools), db_dir=db_dir,
+                    dbcan_args=dbcan_args, manifest=read_manifest(out_dir), hotpep_index=hotpep_index)
+    dbcan_tools = tools
+    native_hotpep = 'hotpep' in key
+    if native_hotpep:
+        # Hotpep.out comes from the peptide index, run_dbcan.py runs the other tools
+        dbcan_tools = [t for t in key['tools'] if t != 'hotpep']
+    if is_fresh(out_dir, key):
+        logging.info("CAZyme predicted outputs for {} are up to date".format(os.path.basename(input_file)))
     else:
-        call = ["{} {} {} --tools {} --db_dir {} --out_dir {} {}".format(dbcan, input_file, seq_type, ",".join(tools),
-                                                                         db_dir, out_dir, dbcan_args)]
-        cmd = " ".join(call)
+        fasta = input_file
+        dbcan_seq_type = seq_type
+        if gene_cache is not None and seq_type != 'protein':
+            # annotate the cached gene predictions instead of letting run_dbcan.py call the genes again
+            fasta = predict_genes(input_file=input_file, seq_type=seq_type, out_dir=out_dir, logfile=genome_log,
+                                  cache_dir=gene_cache, input_sha256=key['input']['sha256'])
+            if fasta is None:
+                logging.error("gene prediction failed on {}".format(os.path.basename(input_file)))
+                return out_dir
+            dbcan_seq_type = 'protein'
+
+        memory_gb = memory_gb or available_memory_gb()
+        ceiling = None
+        if max_memory is not None and 'diamond' in normalize_tools(" ".join(dbcan_tools)):
+            # the query is streamed in chunks small enough for a profile to fit DIAMOND into the ceiling
+            ceiling = max_memory
+            fit_mb = max_chunk_mb(db_dir, dbcan_seq_type, max_memory)
+            if fit_mb is not None and (fit_mb == 0 or dbcan_seq_type == 'prok' and
+                                       os.path.getsize(fasta) > fit_mb * 1024 * 1024):
+                logging.error("no profile fits DIAMOND on {} into --max-memory {} GB".format(
+                    os.path.basename(input_file), max_memory))
+                return out_dir
+            if fit_mb is not None:
+                chunk_mb = min(chunk_mb or fit_mb, fit_mb)
+
+        # single genomes are gene called as a whole, prodigal trains on the complete sequence
+        stream = chunk_mb is not None and dbcan_seq_type != 'prok' and \
+            os.path.getsize(fasta) > chunk_mb * 1024 * 1024
+        scratch = None
+        if fasta.endswith('.gz') and not stream:
+            # run_dbcan.py cannot read gzipped input and its tools open the query one after another, so it
+            # cannot be piped in either: stream it into a scratch copy removed after the run
+            scratch = os.path.join(out_dir, '.' + os.path.basename(fasta_stem(input_file)) + '.scratch.fa')
+            with open(scratch, 'w') as f_fasta:
+                for header, seq in read_fasta(input_file):
+                    f_fasta.write(">{}\n{}\n".format(header, seq))
+            fasta = scratch
+
+        try:
+            if not dbcan_tools:
+                # only Hotpep was asked for: the peptide index scans the proteins without run_dbcan.py
+                if dbcan_seq_type != 'protein':
+                    logging.error("--tools hotpep with --hotpep-index needs protein input or a gene cache, skipping "
+                                  "{}".format(os.path.basename(input_file)))
+                    return out_dir
+                settings = resolve_profile(profile, fasta, dbcan_seq_type, db_dir, memory_gb, threads=threads)
+                annotated = True
+            elif stream:
+                # numpy, imported only by the genomes that are streamed
+                from streaming_annotation import annotate_chunks
+                settings = annotate_chunks(dbcan, fasta, dbcan_seq_type, dbcan_tools, db_dir, out_dir, genome_log,
+                                           chunk_mb, dbcan_args=dbcan_args, threads=threads, profile=profile,
+                                           memory_gb=memory_gb, max_memory=ceiling)
+                annotated = settings is not None
+            else:
+                try:
+                    settings = resolve_profile(profile, fasta, dbcan_seq_type, db_dir, memory_gb, threads=threads,
+                                               max_memory_gb=ceiling)
+                except ValueError as error:
+                    logging.error(str(error))
+                    return out_dir
+                # the thread options of the profile come first, so that the extra arguments override them
+                call = ["{} {} {} --tools {} --db_dir {} --out_dir {} {} {}".format(dbcan, fasta, dbcan_seq_type,
+                                                                                    " ".join(dbcan_tools), db_dir,
+                                                                                    out_dir, settings['dbcan_args'],
+                                                                                    dbcan_args)]
+                cmd = " ".join(call)
 
-        logging.info("CAZyme prediction on {}".format(os.path.basename(input_file)))
-        run_shell_command(cmd=cmd, logfile=f_out, raise_errors=False, extra_env=None)
+                logging.info("CAZyme prediction on {} ({} profile)".format(os.path.basename(input_file),
+                                                                           settings['profile']))
+                tags = dict(genome=os.path.basename(out_dir), tool='run_dbcan', profile=settings['profile'])
+                annotated = run_shell_command(cmd=cmd, logfile=genome_log, raise_errors=False,
+                                              extra_env=profile_env(settings), tags=tags)
+            if settings is not None and settings.get('requested'):
+                logging.warning("{} profile of {} replaced by the {} profile to fit --max-memory".format(
+                    settings['requested'], os.path.basename(input_file), settings['profile']))
+            if annotated:
+                if native_hotpep:
+                    from peptide_index import scan_fasta
+                    from consensus import write_overview
+                    # run_dbcan.py writes the proteins it called from nucleotide input to uniInput
+                    proteins = fasta if dbcan_seq_type == 'protein' else os.path.join(out_dir, 'uniInput')
+                    scan_fasta(proteins, db_dir, os.path.join(out_dir, 'Hotpep.out'), jobs=settings['hotpep_cpu'] or 1)
+                    write_overview(out_dir)
+                if dbcan_seq_type != 'protein':
+                    index_proteins(out_dir, os.path.join(out_dir, 'uniInput'))
+                else:
+                    # proteins of a nucleotide genome come from the gene calling cache
+                    index_proteins(out_dir, fasta if seq_type != 'protein' else input_file, link=seq_type != 'protein')
+                write_profile(out_dir, settings)
+                write_manifest(out_dir, key)
+        finally:
+            if scratch is not None:
+                os.remove(scratch)
     return out_dir
 
 
+def find_genomes(data_dir):
+    """
+    find the genome FASTA files, plain or gzipped, in the data directory
+
+    :param data_dir: <str> path to the directory having the genome FASTA files
+    :return: <list> of absolute paths to the FASTA files
+    """
+    input_files = []
+    for root, dirs, fnames in os.walk(data_dir):
+        fnames.sort()
+        for fn in fnames:
+            if fn.endswith('.fna') or fn.endswith('.fasta'):
+                input_files.append(os.path.abspath(os.path.join(root, fn)))
+            elif fn.endswith('.fna.gz') or fn.endswith('.fasta.gz'):
+                # gzipped genomes are read directly unless they have already been decompressed
+                if fn[:-3] not in fnames and fasta_stem(fn) + '.fasta' not in fnames:
+                    input_files.append(os.path.abspath(os.path.join(root, fn)))
+    return input_files
+
+
 def main():
     """
 
@@ -126,6 +344,7 @@ def main():
     """
     parser = parse_args()
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=DATE_FORMAT)
 
     # check for input data directory
     if args.data_dir is None:
@@ -141,6 +360,11 @@ def main():
     if args.data_dir is not None and os.path.exists(args.data_dir) and not os.path.isdir(args.data_dir):
         raise NotADirectoryError(args.data_dir, "Is not a directory")
 
+    if args.hotpep_index and normalize_tools(args.tools) == ['hotpep'] and args.seq_type != 'protein' and \
+            args.gene_cache is None:
+        logging.error("--tools hotpep with --hotpep-index needs protein input or --gene-cache")
+        sys.exit(2)
+
     # check output directory
     if args.out_dir is None:
         logging.info("[output dir] not specified, output will be written to {}".format(args.data_dir))
@@ -149,19 +373,133 @@ def main():
         args.out_dir = mkdir(args.out_dir)
         logging.info("[output dir] - {}".format(os.path.abspath(args.out_dir)))
 
-    for root, dirs, fnames in os.walk(args.data_dir):
-        fnames.sort()
-        for fn in fnames:
-            if fn.endswith('.fna') or fn.endswith('.fasta'):
-                fn = os.path.abspath(os.path.join(root, fn))
-                outdir = os.path.dirname(fn)
-                mkdir(outdir)
-                dbcan_cazymes(input_file=fn,
-                              seq_type=args.seq_type,
-                              tools=args.tools,
-                              db_dir=os.path.abspath(args.db_dir),
-                              out_dir=outdir,
-                              dbcan_args=args.dbcan_args)
+    # tool output goes to one log file per genome, written by a single listener
+    log_dir = args.log_dir if args.log_dir is not None else os.path.join(args.out_dir, 'logs')
+    log_queue, listener = start_logging(log_dir, max_bytes=args.log_max_bytes, backup_count=args.log_backups)
+    logging.info("[log dir] - {}".format(os.path.abspath(log_dir)))
+    try:
+        annotate(args, log_queue)
+    finally:
+        listener.stop()
+
+
+def annotate(args, log_queue):
+    """
+    annotate the genomes of the data directory
+
+    :param args: parsed command line options
+    :param log_queue: queue the log records of the workers are sent to
+    :return:
+    """
+
+    if args.metrics is not None:
+        os.environ[METRICS_ENV] = os.path.abspath(args.metrics)
+        install_shims(os.path.join(args.out_dir, '.bin'))
+        logging.info("[metrics] - {}".format(os.environ[METRICS_ENV]))
+
+    if args.profile != 'default' or args.max_memory is not None:
+        # the diamond wrapper appends the block size and index chunks of the profile, which is also how the
+        # smaller profile --max-memory may switch to reaches DIAMOND
+        install_shims(os.path.join(args.out_dir, '.bin'), names=['diamond'])
+
+    if args.stage_db is not None:
+        args.db_dir = stage(args.db_dir, args.stage_db)
+        logging.info("[database dir] - {}".format(args.db_dir))
+
+    if args.max_memory is not None and max_chunk_mb(args.db_dir, 'protein', args.max_memory) == 0:
+        logging.error("no profile fits DIAMOND against {} into --max-memory {} GB".format(args.db_dir,
+                                                                                          args.max_memory))
+        sys.exit(2)
+
+    input_files = find_genomes(data_dir=args.data_dir)
+
+    shard = None
+    if args.shard == 'auto':
+        shard = shard_from_env()
+    elif args.shard != 'none':
+        shard = parse_shard(args.shard)
+    if shard is not None:
+        key = plan_key(input_files)
+        input_files = select_shard(args.out_dir, input_files, *shard)
+        logging.info("[shard] {}/{}: {} genomes".format(shard[0], shard[1], len(input_files)))
+
+    annotate_genomes(args, input_files, log_queue)
+    if shard is not None:
+        write_marker(args.out_dir, shard[0], shard[1], input_files, key)
+
+
+def annotate_genomes(args, input_files, log_queue):
+    """
+    annotate the given genome files
+
+    :param args: parsed command line options
+    :param input_files: <list> of paths to the genome files
+    :param log_queue: queue the log records of the workers are sent to
+    :return:
+    """
+    if args.batch or args.dedup:
+        if args.hotpep_index:
+            logging.warning("--hotpep-index is not applied to the pooled batch annotation")
+        batch_dir = args.batch_dir if args.batch_dir is not None else os.path.join(args.out_dir, '.batch')
+        try:
+            annotate_batch(input_files=input_files,
+                           seq_type=args.seq_type,
+                           tools=args.tools,
+                           db_dir=os.path.abspath(args.db_dir),
+                           batch_dir=batch_dir,
+                           logfile=GenomeLogWriter('batch'),
+                           dbcan_args=args.dbcan_args,
+                           gene_cache=args.gene_cache,
+                           profile=args.profile,
+                           dedup=args.dedup)
+        except ValueError as error:
+            logging.error(str(error))
+        return
+
+    if args.jobs != 1:
+        jobs, threads = cpu_budget(jobs=args.jobs, threads_per_job=args.threads_per_job)
+        logging.info("[scheduler] {} jobs x {} threads".format(jobs, threads))
+
+        # start the largest genomes first so that they do not end up as stragglers
+        input_files.sort(key=os.path.getsize, reverse=True)
+        tasks = [dict(input_file=fn,
+                      seq_type=args.seq_type,
+                      tools=args.tools,
+                      db_dir=os.path.abspath(args.db_dir),
+                      out_dir=mkdir(os.path.dirname(fn)),
+                      dbcan_args=args.dbcan_args,
+                      threads=threads,
+                      gene_cache=args.gene_cache,
+                      profile=args.profile,
+                      memory_gb=available_memory_gb() / jobs,
+                      hotpep_index=args.hotpep_index,
+                      chunk_mb=args.chunk_mb,
+                      max_memory=args.max_memory) for fn in input_files]
+        # the modules imported on demand by the tasks are loaded once, before the workers are forked
+        preload = []
+        if args.chunk_mb is not None:
+            preload.append('streaming_annotation')
+        if args.hotpep_index:
+            preload.extend(['peptide_index', 'consensus'])
+        run_jobs(func=dbcan_cazymes, tasks=tasks, jobs=jobs, threads_per_job=threads,
+                 label=lambda task: os.path.basename(task['input_file']), log_queue=log_queue, preload=preload)
+        return
+
+    for fn in input_files:
+        outdir = os.path.dirname(fn)
+        mkdir(outdir)
+        dbcan_cazymes(input_file=fn,
+                      seq_type=args.seq_type,
+                      tools=args.tools,
+                      db_dir=os.path.abspath(args.db_dir),
+                      out_dir=outdir,
+                      dbcan_args=args.dbcan_args,
+                      threads=args.threads_per_job,
+                      gene_cache=args.gene_cache,
+                      profile=args.profile,
+                      hotpep_index=args.hotpep_index,
+                      chunk_mb=args.chunk_mb,
+                      max_memory=args.max_memory)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+batched CAZyme annotation: pool the predicted proteins of many genomes into one
+tagged query set, run run_dbcan.py once over the whole set and split the hits
+back into the per-genome output directories
+
+with deduplication, every distinct protein sequence of the cohort is written to the
+pooled query once and its hits are copied to every gene carrying that sequence, so
+closely related strains share the DIAMOND, HMMER and Hotpep work
+"""
+import os
+import hashlib
+import logging
+
+from utils import mkdir
+from utils import find_executable
+from utils import run_shell_command
+from utils import read_fasta
+from utils import available_memory_gb
+from result_cache import cache_key
+from result_cache import database_fingerprint
+from result_cache import is_fresh
+from result_cache import read_manifest
+from result_cache import write_manifest
+from gene_calling import predict_genes
+from profiles import profile_env
+from profiles import resolve_profile
+from profiles import write_profile
+from fasta_index import index_proteins
+
+# separator between the genome tag and the original gene identifier in the pooled query
+TAG_SEP = "__"
+
+# run_dbcan.py outputs that are split back per genome, all of them carry a 'Gene ID' column
+OUTPUT_FILES = ['diamond.out', 'hmmer.out', 'Hotpep.out', 'overview.txt']
+
+
+def pool_proteins(proteins, pooled_file):
+    """
+    write the proteins of every genome into a single FASTA file, prefixing each
+    identifier with a genome tag so that the hits can be split back afterwards
+
+    :param proteins: <list> of (protein FASTA file, plain or gzipped, genome output directory) tuples
+    :param pooled_file: <str> path to the pooled FASTA file
+    :return: <dict> genome tag -> genome output directory
+    """
+    tags = dict()
+    with open(pooled_file, 'w') as f_pool:
+        for index, (faa, out_dir) in enumerate(proteins):
+            tag = "g{:06d}".format(index)
+            tags[tag] = out_dir
+            for header, seq in read_fasta(faa):
+                f_pool.write(">{}{}{}\n{}\n".format(tag, TAG_SEP, header, seq))
+    return tags
+
+
+def pool_unique_proteins(proteins, pooled_file):
+    """
+    write every distinct protein sequence of the genomes once into a single FASTA file,
+    identified by its index in the returned member lists
+
+    :param proteins: <list> of (protein FASTA file, plain or gzipped, genome output directory) tuples
+    :param pooled_file: <str> path to the pooled FASTA file
+    :return: <tuple> (genome tag -> genome output directory, list of the (genome tag, gene id) carrying
+             each distinct sequence)
+    """
+    tags = dict()
+    digests = dict()
+    members = []
+    with open(pooled_file, 'w') as f_pool:
+        for index, (faa, out_dir) in enumerate(proteins):
+            tag = "g{:06d}".format(index)
+            tags[tag] = out_dir
+            for header, seq in read_fasta(faa):
+                digest = hashlib.blake2b(seq.encode(), digest_size=16).digest()
+                unique = digests.get(digest)
+                if unique is None:
+                    unique = digests[digest] = len(members)
+                    members.append([])
+                    f_pool.write(">u{}\n{}\n".format(unique, seq))
+                members[unique].append((tag, header.split()[0]))
+    return tags, members
+
+
+def split_outputs(batch_dir, tags, members=None):
+    """
+    split the pooled run_dbcan.py outputs into the per-genome output layout
+
+    :param batch_dir: <str> directory having the pooled run_dbcan.py outputs
+    :param tags: <dict> genome tag -> genome output directory
+    :param members: <list> of the (genome tag, gene id) carrying each distinct sequence of a deduplicated
+                    pooled query, None if the query is tagged per genome
+    :return:
+    """
+    for fn in OUTPUT_FILES:
+        pooled = os.path.join(batch_dir, fn)
+        if not os.path.exists(pooled):
+            continue
+
+        rows = {tag: [] for tag in tags}
+        with open(pooled) as f_in:
+            header = f_in.readline()
+            gene_col = header.rstrip('\n').split('\t').index('Gene ID')
+            for line in f_in:
+                fields = line.rstrip('\n').split('\t')
+                if members is None:
+                    genes = [fields[gene_col].split(TAG_SEP, 1)]
+                else:
+                    genes = members[int(fields[gene_col][1:])]
+                for tag, gene_id in genes:
+                    fields[gene_col] = gene_id
+                    rows[tag].append('\t'.join(fields) + '\n')
+
+        for tag, lines in rows.items():
+            with open(os.path.join(tags[tag], fn), 'w') as f_out:
+                f_out.write(header)
+                f_out.writelines(lines)
+
+
+def annotate_batch(input_files, seq_type, tools, db_dir, batch_dir, logfile, dbcan_args="", gene_cache=None,
+                   profile='default', dedup=False):
+    """
+    annotate many genomes with a single run_dbcan.py invocation so that the CAZy
+    and dbCAN databases are loaded only once
+
+    :param input_files: <list> of input files in FASTA format
+    :param seq_type: <str> sequence type of the inputs
+    :param tools: <str> tools for cazyme annotation
+    :param db_dir: <str> path to the database directory
+    :param batch_dir: <str> path to the directory for the pooled query and outputs
+    :param logfile: file object to write the standard errors
+    :param dbcan_args: <str> extra arguments passed on to the executable
+    :param gene_cache: <str> path to the gene calling cache
+    :param profile: <str> performance profile, 'auto' to choose it from the pooled query size
+    :param dedup: <bool> annotate every distinct protein sequence once
+    :return: <list> of the genome output directories
+    """
+
+    # the outputs of a genome are split back into the directory of its FASTA file
+    out_dirs = dict()
+    for fn in input_files:
+        out_dir = os.path.dirname(fn)
+        if out_dir in out_dirs:
+            raise ValueError("{} and {} would share the output directory {}, keep one genome per "
+                             "directory".format(os.path.basename(out_dirs[out_dir]), os.path.basename(fn), out_dir))
+        out_dirs[out_dir] = fn
+
+    # locate the executable
+    dbcan = find_executable(['run_dbcan.py'])
+    batch_dir = mkdir(batch_dir)
+
+    # genomes whose cached outputs are up to date are left out of the pooled query
+    db_fingerprint = database_fingerprint(db_dir)
+    keys = dict()
+    for fn in input_files:
+        out_dir = os.path.dirname(fn)
+        key = cache_key(input_file=fn, seq_type=seq_type, tools=tools, db_dir=db_dir, dbcan_args=dbcan_args,
+                        manifest=read_manifest(out_dir), db_fingerprint=db_fingerprint)
+        if is_fresh(out_dir, key):
+            logging.info("CAZyme predicted outputs for {} are up to date".format(os.path.basename(fn)))
+        else:
+            keys[fn] = key
+
+    proteins = []
+    for fn in list(keys):
+        out_dir = os.path.dirname(fn)
+        if seq_type == 'protein':
+            faa = fn
+        else:
+            faa = predict_genes(input_file=fn, seq_type=seq_type, out_dir=out_dir, logfile=logfile,
+                                cache_dir=gene_cache, input_sha256=keys[fn]['input']['sha256'])
+        if faa is None:
+            logging.error("gene prediction failed on {}, skipping".format(fn))
+            del keys[fn]
+            continue
+        proteins.append((faa, out_dir))
+
+    if not proteins:
+        logging.info("no genomes left to annotate")
+        return []
+
+    pooled = os.path.join(batch_dir, 'pooled_proteins.faa')
+    members = None
+    if dedup:
+        tags, members = pool_unique_proteins(proteins=proteins, pooled_file=pooled)
+        genes = sum(len(m) for m in members)
+        logging.info("pooled the {} proteins of {} genomes into {} distinct sequences ({:.1f}x) in {}".format(
+            genes, len(tags), len(members), genes / max(len(members), 1), pooled))
+    else:
+        tags = pool_proteins(proteins=proteins, pooled_file=pooled)
+        logging.info("pooled the proteins of {} genomes into {}".format(len(tags), pooled))
+
+    settings = resolve_profile(profile, pooled, 'protein', db_dir, available_memory_gb())
+    tools = list(map(str, tools.split(',')))
+    call = ["{} {} protein --tools {} --db_dir {} --out_dir {} {} {}".format(dbcan, pooled, " ".join(tools),
+                                                                             db_dir, batch_dir,
+                                                                             settings['dbcan_args'], dbcan_args)]
+    cmd = " ".join(call)
+
+    logging.info("CAZyme prediction on {} pooled genomes ({} profile)".format(len(tags), settings['profile']))
+    run_tags = dict(genome='batch', tool='run_dbcan', genomes=len(tags), profile=settings['profile'])
+    if not run_shell_command(cmd=cmd, logfile=logfile, raise_errors=False, extra_env=profile_env(settings),
+                             tags=run_tags):
+        return []
+
+    split_outputs(batch_dir=batch_dir, tags=tags, members=members)
+    for faa, out_dir in proteins:
+        # cached predictions live outside the genome directory, link them in for fasta_index.py
+        index_proteins(out_dir, faa, link=seq_type != 'protein' and gene_cache is not None)
+    for fn, key in keys.items():
+        write_profile(os.path.dirname(fn), settings)
+        write_manifest(os.path.dirname(fn), key)
+    return list(tags.values())
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+benchmark the annotation and summary pipeline on synthetic genomes
+
+synthetic protein/nucleotide FASTA and run_dbcan.py outputs are generated at the
+requested scale and every stage is timed. run_dbcan.py is replaced by an offline
+stub so only the pipeline's own overhead is measured. The results are written as
+JSON so that runs can be compared.
+
+python3 benchmark_pipeline.py \
+-g number_of_genomes \
+-n genes_per_genome \
+-o results.json
+
+python3 benchmark_pipeline.py -s startup --max-startup 0.5
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import statistics
+import subprocess
+import platform
+import resource
+import argparse
+import tempfile
+import functools
+from datetime import datetime
+
+STAGES = ['startup', 'dbcan_cazymes', 'get_genomes', 'aggregate', 'legacy_merge', 'uncompress_fasta']
+
+FAMILIES = ['GH1', 'GH2', 'GH3', 'GH13', 'GH13_31', 'GH23', 'GH25', 'GH73', 'GT2', 'GT4', 'GT51', 'CE1', 'CE4',
+            'CE9', 'PL1', 'PL9', 'AA3', 'AA6', 'CBM32', 'CBM48', 'CBM50']
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+DIAMOND_HEADER = ['Gene ID', 'CAZy ID', '% Identical', 'Length', 'Mismatches', 'Gap Open', 'Gene Start',
+                  'Gene End', 'CAZy Start', 'CAZy End', 'E Value', 'Bit Score']
+HMMER_HEADER = ['HMM Profile', 'Profile Length', 'Gene ID', 'Gene Length', 'E Value', 'Profile Start',
+                'Profile End', 'Gene Start', 'Gene End', 'Coverage']
+HOTPEP_HEADER = ['CAZy Family', 'PPR Subfamily', 'Gene ID', 'Frequency', 'Hits', 'Signature Peptides']
+OVERVIEW_HEADER = ['Gene ID', 'HMMER', 'Hotpep', 'DIAMOND', 'Signalp', '#ofTools']
+
+# offline stand-in for run_dbcan.py: annotates a deterministic share of the input proteins
+DBCAN_STUB = '''#!{python}
+import os, sys, zlib
+sys.path.insert(0, {scripts!r})
+import benchmark_pipeline as bench
+args = sys.argv[1:]
+out_dir = args[args.index('--out_dir') + 1]
+# --tools takes space separated choices, as in run_dbcan.py
+tools = args[args.index('--tools') + 1:]
+tools = tools[:next((i for i, a in enumerate(tools) if a.startswith('--')), len(tools))]
+if not tools or set(tools) - {{'hmmer', 'diamond', 'hotpep', 'all'}}:
+    sys.exit('run_dbcan.py: invalid --tools {{}}'.format(tools))
+genes = [line[1:].split()[0] for line in open(args[0]) if line.startswith('>')]
+bench.write_dbcan_outputs(out_dir, genes, seed=zlib.crc32(args[0].encode()))
+'''
+
+# modules that must only be loaded by the commands working on tables
+HEAVY_MODULES = ['pandas', 'numpy', 'openpyxl']
+
+# commands run by every short-lived task, their startup must not import the heavy modules
+LIGHT_COMMANDS = ['annotate', 'pipeline', 'fetch', 'fasta', 'databases', 'cache', 'shards', 'metrics']
+
+# imports the module of a command the way cli.py does and reports the import time and the heavy modules loaded
+STARTUP_PROBE = '''
+import sys, time
+sys.path.insert(0, {scripts!r})
+start = time.perf_counter()
+import cli
+cli.load(sys.argv[1])
+print(time.perf_counter() - start, ",".join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+
+def write_dbcan_outputs(out_dir, genes, seed=0, hit_rate=0.05):
+    """
+    write synthetic run_dbcan.py outputs for a share of the genes
+
+    :param out_dir: <str> path to the genome output directory
+    :param genes: <list> gene identifiers
+    :param seed: <int> random seed
+    :param hit_rate: <float> share of the genes predicted as CAZymes
+    :return:
+    """
+    rng = random.Random(seed)
+    hits = [g for g in genes if rng.random() < hit_rate]
+    rows = {'diamond.out': [DIAMOND_HEADER], 'hmmer.out': [HMMER_HEADER], 'Hotpep.out': [HOTPEP_HEADER],
+            'overview.txt': [OVERVIEW_HEADER]}
+    for gene in hits:
+        family = rng.choice(FAMILIES)
+        tools = 0
+        hmmer = diamond = hotpep = '-'
+        if rng.random() < 0.8:
+            hmmer = "{}({}-{})".format(family, 1, 200)
+            rows['hmmer.out'].append([family + '.hmm', 200, gene, 300, '1e-30', 1, 200, 10, 210, 0.99])
+            tools += 1
+        if rng.random() < 0.8:
+            diamond = family
+            rows['diamond.out'].append([gene, "ABC{}.1|{}".format(rng.randint(1, 10 ** 6), family), 45.5, 300,
+                                        150, 3, 1, 300, 1, 300, '1e-50', 250.0])
+            tools += 1
+        if rng.random() < 0.7:
+            group = rng.randint(1, 30)
+            hotpep = "{}({})".format(family, group)
+            rows['Hotpep.out'].append([family, group, gene, 2.5, 8, 'AAAKSG,CCDEFG'])
+            tools += 1
+        rows['overview.txt'].append([gene, hmmer, hotpep, diamond, 'N', tools])
+
+    for fn, lines in rows.items():
+        with open(os.path.join(out_dir, fn), 'w') as f_out:
+            for fields in lines:
+                f_out.write('\t'.join(map(str, fields)) + '\n')
+
+
+def random_sequence(rng, alphabet, length):
+    """
+    random sequence over the alphabet
+    """
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def make_genomes(work_dir, n_genomes, n_genes, seed=0, protein_length=300):
+    """
+    generate a synthetic <genomes>/<taxid>/ tree with protein and gzipped nucleotide FASTA per genome
+
+    :param work_dir: <str> benchmark working directory
+    :param n_genomes: <int> number of genomes
+    :param n_genes: <int> number of genes per genome
+    :param seed: <int> random seed
+    :param protein_length: <int> length of the synthetic proteins
+    :return: <str> path to the genomes directory
+    """
+    rng = random.Random(seed)
+    genomes_dir = os.path.join(work_dir, 'genomes')
+    # a small pool of sequences keeps the generation fast at large scale
+    proteins = [random_sequence(rng, AMINO_ACIDS, protein_length) for _ in range(256)]
+    contigs = [random_sequence(rng, 'ACGT', protein_length * 3) for _ in range(256)]
+    for g in range(n_genomes):
+        taxid = str(100000 + g)
+        genome_dir = os.path.join(genomes_dir, taxid)
+        os.makedirs(genome_dir)
+        with open(os.path.join(genome_dir, taxid + '.faa'), 'w') as f_out:
+            for i in range(n_genes):
+                f_out.write(">contig_{}_{}\n{}\n".format(i // 50 + 1, i % 50 + 1, rng.choice(proteins)))
+        with gzip.open(os.path.join(genome_dir, taxid + '_genomic.fna.gz'), 'wt', compresslevel=1) as f_out:
+            for i in range(n_genes // 50 + 1):
+                f_out.write(">contig_{}\n{}\n".format(i + 1, ''.join(rng.choice(contigs) for _ in range(50))))
+    return genomes_dir
+
+
+def install_stubs(work_dir):
+    """
+    put the offline run_dbcan.py stub first on the PATH
+
+    :param work_dir: <str> benchmark working directory
+    :return: <str> path to the stub directory
+    """
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(bin_dir, 'run_dbcan.py')
+    with open(stub, 'w') as f_out:
+        f_out.write(DBCAN_STUB.format(python=sys.executable, scripts=os.path.dirname(os.path.abspath(__file__))))
+    os.chmod(stub, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    return bin_dir
+
+
+def timed(name, items, func, *args, **kwargs):
+    """
+    run a stage and record its wall time, CPU time and peak memory
+
+    :param name: <str> stage name
+    :param items: <int> number of items processed by the stage
+    :param func: stage function
+    :return: <tuple> (stage record, function result)
+    """
+    usage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    after = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    cpu = sum(a.ru_utime + a.ru_stime - b.ru_utime - b.ru_stime for a, b in zip(after, usage))
+    record = dict(stage=name, items=items, seconds=round(seconds, 6), cpu_seconds=round(cpu, 6),
+                  seconds_per_item=round(seconds / max(items, 1), 6),
+                  max_rss_kb=after[0].ru_maxrss)
+    print("{:<20} {:>8} items {:>10.3f} sec".format(name, items, seconds), file=sys.stderr)
+    return record, result
+
+
+def time_startup(repeat=5):
+    """
+    time the startup of every cli.py command in fresh interpreters: the whole '<command> -h' run, which is
+    what a job array task pays before doing any work, and the import of the command module alone
+
+    :param repeat: <int> number of runs per command, the medians are recorded
+    :return: <list> of per-command records
+    """
+    import cli
+
+    scripts = os.path.dirname(os.path.abspath(__file__))
+    probe = STARTUP_PROBE.format(scripts=scripts, heavy=HEAVY_MODULES)
+    records = []
+    for command in cli.COMMANDS:
+        runs, imports = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(scripts, 'cli.py'), command, '-h'], check=True,
+                           stdout=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - start)
+            out = subprocess.run([sys.executable, '-c', probe, command], check=True, stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout.split()
+            imports.append(float(out[0]))
+        heavy = out[1].split(',') if len(out) > 1 else []
+        records.append(dict(command=command, seconds=round(statistics.median(runs), 6),
+                            import_seconds=round(statistics.median(imports), 6), heavy_modules=heavy))
+        print("  {:<14} {:>8.3f} sec  {}".format(command, statistics.median(runs), " ".join(heavy)), file=sys.stderr)
+    return records
+
+
+def startup_regressions(records, max_seconds=None):
+    """
+    :param records: <list> of per-command startup records
+    :param max_seconds: <float> startup budget of a command, None for no budget
+    :return: <list> of messages, one per command over budget or importing a heavy module it should not
+    """
+    messages = []
+    for record in records:
+        if max_seconds is not None and record['seconds'] > max_seconds:
+            messages.append("{} starts in {:.3f} sec, over the {} sec budget".format(record['command'],
+                                                                                   record['seconds'], max_seconds))
+        if record['command'] in LIGHT_COMMANDS and record['heavy_modules']:
+            messages.append("{} imports {} at startup".format(record['command'], ", ".join(record['heavy_modules'])))
+    return messages
+
+
+def run_benchmark(work_dir, n_genomes, n_genes, stages=STAGES, seed=0, jobs=1, repeat=5):
+    """
+    generate the synthetic inputs and time the requested stages
+
+    :param work_dir: <str> benchmark working directory
+    :param n_genomes: <int> number of genomes
+    :param n_genes: <int> number of genes per genome
+    :param stages: <list> stages to run
+    :param seed: <int> random seed
+    :param jobs: <int> number of worker processes for the summary stage
+    :param repeat: <int> number of runs per command of the startup stage
+    :return: <dict> benchmark results
+    """
+    results = dict(created=datetime.now().isoformat(timespec='seconds'), genomes=n_genomes,
+                   genes_per_genome=n_genes, seed=seed, jobs=jobs, python=platform.python_version(),
+                   platform=platform.platform(), stages=[])
+
+    if 'startup' in stages:
+        import cli
+        record, commands = timed('startup', len(cli.COMMANDS), time_startup, repeat=repeat)
+        record['commands'] = commands
+        results['stages'].append(record)
+        if stages == ['startup']:
+            return results
+
+    record, genomes_dir = timed('generate', n_genomes, make_genomes, work_dir, n_genomes, n_genes, seed=seed)
+    results['stages'].append(record)
+    install_stubs(work_dir)
+    db_dir = os.path.join(work_dir, 'db')
+    os.makedirs(db_dir, exist_ok=True)
+    open(os.path.join(db_dir, 'CAZy.dmnd'), 'w').close()
+    taxids = sorted(os.listdir(genomes_dir))
+
+    import annotate_cazymes
+    import diamond_out_summary
+    import utils
+
+    if 'dbcan_cazymes' in stages:
+        def annotate():
+            for taxid in taxids:
+                genome_dir = os.path.join(genomes_dir, taxid)
+                annotate_cazymes.dbcan_cazymes(input_file=os.path.join(genome_dir, taxid + '.faa'),
+                                               seq_type='protein', tools='hmmer,diamond,hotpep', db_dir=db_dir,
+                                               out_dir=genome_dir)
+        record, _ = timed('dbcan_cazymes', n_genomes, annotate)
+        results['stages'].append(record)
+    else:
+        for taxid in taxids:
+            genome_dir = os.path.join(genomes_dir, taxid)
+            write_dbcan_outputs(genome_dir, ["contig_{}_{}".format(i // 50 + 1, i % 50 + 1) for i in range(n_genes)],
+                                seed=int(taxid))
+
+    summary_dir = os.path.join(work_dir, 'summary')
+    overview_files = [fn for genome, fn in utils.find_genome_files(genomes_dir, 'overview.txt')]
+    genome_counts = None
+    if 'get_genomes' in stages or 'aggregate' in stages or 'legacy_merge' in stages:
+        record, genome_counts = timed('get_genomes', len(overview_files), diamond_out_summary.count_genomes,
+                                      overview_files, summary_dir=summary_dir, jobs=jobs)
+        if 'get_genomes' in stages:
+            results['stages'].append(record)
+
+    if 'aggregate' in stages:
+        def aggregate():
+            diamond_out_summary.write_matrix(diamond_out_summary.count_matrix(genome_counts),
+                                             os.path.join(summary_dir, 'aggregated.csv'))
+        record, _ = timed('aggregate', len(genome_counts), aggregate)
+        results['stages'].append(record)
+
+    if 'legacy_merge' in stages:
+        pd = diamond_out_summary.pd
+
+        def legacy_merge():
+            frames = [pd.DataFrame({'CAZy ID': families, genome: counts}) for genome, families, counts in genome_counts]
+            merged = functools.reduce(lambda left, right: pd.merge(left, right, on=['CAZy ID'], how='outer'),
+                                      frames).fillna(0)
+            merged.to_csv(os.path.join(summary_dir, 'aggregated_legacy.csv'), index=False, sep=",")
+        record, _ = timed('legacy_merge', len(genome_counts), legacy_merge)
+        results['stages'].append(record)
+
+    if 'uncompress_fasta' in stages:
+        def uncompress():
+            for taxid in taxids:
+                utils.uncompress_fasta(os.path.join(genomes_dir, taxid, taxid + '_genomic.fna.gz'), suffix='.fna',
+                                       keep_compressed=True)
+        record, _ = timed('uncompress_fasta', n_genomes, uncompress)
+        results['stages'].append(record)
+
+    return results
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prefix_chars='-',
+        description=__doc__
+    )
+    parser.add_argument('-g', '--genomes', type=int, metavar='<int>',
+                        dest='n_genomes', default=100,
+                        help="number of synthetic genomes")
+    parser.add_argument('-n', '--genes', type=int, metavar='<int>',
+                        dest='n_genes', default=2000,
+                        help="number of genes per synthetic genome")
+    parser.add_argument('-s', '--stages', metavar='<stage1,stage2>',
+                        dest='stages', default=",".join(STAGES),
+                        help="comma separated stages to run, any of {}".format(STAGES))
+    parser.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                        dest='jobs', default=1,
+                        help="number of worker processes for the summary stage")
+    parser.add_argument('--startup-repeat', type=int, metavar='<int>',
+                        dest='repeat', default=5,
+                        help="number of runs per command of the startup stage")
+    parser.add_argument('--max-startup', type=float, metavar='<sec>',
+                        dest='max_startup', default=None,
+                        help="fail if a command of the startup stage takes longer than this to start")
+    parser.add_argument('--seed', type=int, metavar='<int>',
+                        dest='seed', default=0,
+                        help="random seed of the synthetic data")
+    parser.add_argument('-w', '--workDir', metavar='<dir>',
+                        dest='work_dir', default=None,
+                        help="working directory for the synthetic data, a temporary directory if not provided")
+    parser.add_argument('--keep', action='store_true',
+                        dest='keep',
+                        help="keep the synthetic data after the run")
+    parser.add_argument('-o', '--output', metavar='<file>',
+                        dest='output', default=None,
+                        help="path to the JSON results, printed to standard output if not provided")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+    stages = [s for s in args.stages.split(',') if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        sys.exit("unknown stages: {}".format(", ".join(sorted(unknown))))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='cazyme_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    if os.listdir(work_dir):
+        sys.exit("working directory {} is not empty".format(work_dir))
+    try:
+        results = run_benchmark(os.path.abspath(work_dir), args.n_genomes, args.n_genes, stages=stages,
+                                seed=args.seed, jobs=args.jobs, repeat=args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            json.dump(results, f_out, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    regressions = [message for stage in results['stages'] if stage['stage'] == 'startup'
+                   for message in startup_regressions(stage['commands'], max_seconds=args.max_startup)]
+    if regressions:
+        sys.exit("startup regressions:\n" + "\n".join(regressions))
+
+
+if __name__ == '__main__':
+    main()
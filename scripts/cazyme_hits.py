@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+columnar, genome-partitioned store of the consensus CAZyme hits
+
+each genome is written to its own <hits_dir>/genome=<id>/ partition holding the
+gene id, the CAZy family and the number of agreeing tools, either as a Parquet file
+with dictionary-encoded strings or as memory-mappable NumPy arrays (category codes
+plus their categories). A study-level query reads only the partitions and columns it
+needs.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+HIT_COLUMNS = ['Gene ID', 'CAZy ID', '#ofTools']
+
+# file names of the NumPy columns
+NPY_NAMES = {'Gene ID': 'gene_id', 'CAZy ID': 'cazy_id', '#ofTools': 'n_tools'}
+
+PARTITION_PREFIX = 'genome='
+
+
+def write_hits(hits, genome, hits_dir, fmt='parquet'):
+    """
+    write the consensus hits of a genome as a partition of the store
+
+    :param hits: data frame with the 'Gene ID', 'CAZy ID' and '#ofTools' columns
+    :param genome: genome id
+    :param hits_dir: path to the store
+    :param fmt: 'parquet' or 'npy'
+    :return: path to the partition
+    """
+    partition = os.path.join(hits_dir, PARTITION_PREFIX + str(genome))
+    os.makedirs(partition, exist_ok=True)
+    hits = hits[HIT_COLUMNS].reset_index(drop=True)
+
+    if fmt == 'parquet':
+        table = pd.DataFrame({'Gene ID': hits['Gene ID'].astype('category'),
+                              'CAZy ID': hits['CAZy ID'].astype('category'),
+                              '#ofTools': hits['#ofTools'].astype('int8')})
+        table.to_parquet(os.path.join(partition, 'part-0.parquet'), index=False)
+    elif fmt == 'npy':
+        for column in ['Gene ID', 'CAZy ID']:
+            values = pd.Categorical(hits[column].astype(str))
+            np.save(os.path.join(partition, NPY_NAMES[column] + '.npy'), values.codes.astype(np.int32))
+            np.save(os.path.join(partition, NPY_NAMES[column] + '.categories.npy'),
+                    np.asarray(values.categories, dtype=str))
+        np.save(os.path.join(partition, NPY_NAMES['#ofTools'] + '.npy'), hits['#ofTools'].to_numpy(np.int8))
+    else:
+        raise ValueError("unknown hits format: {}".format(fmt))
+    return partition
+
+
+def list_partitions(hits_dir):
+    """
+    list the genome partitions of the store
+
+    :param hits_dir: path to the store
+    :return: dict genome id -> partition path
+    """
+    partitions = dict()
+    with os.scandir(hits_dir) as entries:
+        for entry in entries:
+            if entry.is_dir() and entry.name.startswith(PARTITION_PREFIX):
+                partitions[entry.name[len(PARTITION_PREFIX):]] = entry.path
+    return dict(sorted(partitions.items()))
+
+
+def read_partition(partition, columns=None, mmap=True):
+    """
+    read one genome partition
+
+    :param partition: path to the partition
+    :param columns: columns to read, all of them if None
+    :param mmap: bool to memory-map the NumPy arrays instead of reading them
+    :return: data frame
+    """
+    columns = columns or HIT_COLUMNS
+    parquet = os.path.join(partition, 'part-0.parquet')
+    if os.path.exists(parquet):
+        return pd.read_parquet(parquet, columns=columns)
+
+    mode = 'r' if mmap else None
+    data = dict()
+    for column in columns:
+        codes = np.load(os.path.join(partition, NPY_NAMES[column] + '.npy'), mmap_mode=mode)
+        categories_file = os.path.join(partition, NPY_NAMES[column] + '.categories.npy')
+        if os.path.exists(categories_file):
+            data[column] = pd.Categorical.from_codes(codes, np.load(categories_file))
+        else:
+            data[column] = codes
+    return pd.DataFrame(data, columns=columns)
+
+
+def load_hits(hits_dir, genomes=None, columns=None, mmap=True):
+    """
+    load the hits of the selected genomes and columns, with a categorical 'genome' column
+
+    :param hits_dir: path to the store
+    :param genomes: genome ids to read, all of them if None
+    :param columns: hit columns to read, all of them if None
+    :param mmap: bool to memory-map the NumPy arrays instead of reading them
+    :return: data frame
+    """
+    partitions = list_partitions(hits_dir)
+    if genomes is not None:
+        wanted = set(map(str, genomes))
+        partitions = {g: p for g, p in partitions.items() if g in wanted}
+
+    frames = []
+    for genome, partition in partitions.items():
+        frame = read_partition(partition, columns=columns, mmap=mmap)
+        frame['genome'] = genome
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=(columns or HIT_COLUMNS) + ['genome'])
+
+    hits = pd.concat(frames, ignore_index=True)
+    # the per-genome categories differ, so they are re-encoded once over the whole selection
+    for column in hits.columns:
+        if column in ('Gene ID', 'CAZy ID', 'genome'):
+            hits[column] = hits[column].astype('category')
+    return hits
@@ -21,33 +21,28 @@ conda activate run_dbcan
 
 WORK_DIR="/home/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/scripts/"
 GENOMES_DIR="/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/genomes"
-DB_DIR="/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/db/"
+DB_ROOT="/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/db/"
 
 
 #WORK_DIR="/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/scripts/"
 #GENOMES_DIR="/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/genomes"
-#DB_DIR="/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/db/"
+#DB_ROOT="/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/db/"
 
 
 
 #python3 ${WORK_DIR}/fetch_genomes.py
 
-# dowload genomes
-test -d ${DB_DIR} || mkdir ${DB_DIR}
-cd ${DB_DIR} \
-  && wget http://bcb.unl.edu/dbCAN2/download/CAZyDB.07312019.fa.nr && diamond makedb --in CAZyDB.07312019.fa.nr -d CAZy \
-  && wget http://bcb.unl.edu/dbCAN2/download/Databases/dbCAN-HMMdb-V8.txt && mv dbCAN-HMMdb-V8.txt dbCAN.txt && hmmpress dbCAN.txt \
-  && wget http://bcb.unl.edu/dbCAN2/download/Databases/tcdb.fa && diamond makedb --in tcdb.fa -d tcdb \
-  && wget http://bcb.unl.edu/dbCAN2/download/Databases/tf-1.hmm && hmmpress tf-1.hmm \
-  && wget http://bcb.unl.edu/dbCAN2/download/Databases/tf-2.hmm && hmmpress tf-2.hmm \
-  && wget http://bcb.unl.edu/dbCAN2/download/Databases/stp.hmm && hmmpress stp.hmm
-
-# annotate cazymes
+# build the databases once, concurrent submissions wait on the build lock and reuse the release
 cd ${WORK_DIR} || exit
+python3 databases.py build --root ${DB_ROOT} --threads ${SLURM_CPUS_PER_TASK:-4} || exit 1
+DB_DIR=$(python3 databases.py path --root ${DB_ROOT})
+
+# annotate cazymes, reading the databases from memory
 python3 annotate_cazymes.py \
   --dataDir ${GENOMES_DIR} \
   --seq-type meta \
   --database-dir ${DB_DIR} \
+  --stage-db /dev/shm \
   --tools 'hmmer hotpep diamond'
 
 #python3 annotate_cazymes.py \
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+single entry point of the CAZyme annotation scripts
+
+only the module of the requested command is imported, so that pandas, numpy and the
+Excel readers are loaded by the commands that work on tables and not by every
+short-lived annotation task of a job array
+
+python3 cli.py <command> [options]
+python3 scripts <command> [options]
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import argparse
+import importlib
+import collections
+
+# command -> (module with a main() reading sys.argv, summary)
+COMMANDS = collections.OrderedDict([
+    ('annotate', ('annotate_cazymes', "annotate the genomes of a data directory with run_dbcan.py")),
+    ('pipeline', ('pipeline', "resumable fetch -> decompress -> gene-call -> annotate -> summarize driver")),
+    ('fetch', ('fetch_genomes_async', "download the genome assemblies of the taxa metadata sheet")),
+    ('summary', ('diamond_out_summary', "count the CAZy families of every genome into the aggregated matrix")),
+    ('consensus', ('consensus', "consensus hits of a genome from the HMMER, DIAMOND and Hotpep outputs")),
+    ('metadata', ('metadata', "convert the metadata sheets and join them to the CAZyme matrix")),
+    ('fasta', ('fasta_index', "index protein files, extract genes and export per-family FASTA")),
+    ('hotpep-index', ('peptide_index', "build and scan the conserved-peptide index")),
+    ('databases', ('databases', "build the versioned database releases and stage them on node-local storage")),
+    ('cache', ('result_cache', "list and evict the cached annotation results")),
+    ('shards', ('sharding', "write the SLURM array script of a sharded run and gather its shards")),
+    ('metrics', ('tool_metrics', "summarize the per-tool resource records")),
+    ('benchmark', ('benchmark_pipeline', "benchmark the pipeline on synthetic genomes")),
+])
+
+
+def load(command):
+    """
+    import the module of a command
+
+    :param command: <str> command name
+    :return: module
+    """
+    return importlib.import_module(COMMANDS[command][0])
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        prefix_chars='-',
+        description=__doc__,
+        epilog="commands:\n" + "\n".join("  {:<14}{}".format(name, summary)
+                                        for name, (module, summary) in COMMANDS.items())
+    )
+    parser.add_argument('command', metavar='<command>', choices=list(COMMANDS),
+                        help="command to run, its options follow it (<command> -h)")
+    parser.add_argument('options', nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+    module = load(args.command)
+    # the command parses sys.argv as if it had been run on its own
+    sys.argv = ["{} {}".format(os.path.basename(sys.argv[0]), args.command)] + args.options
+    module.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+consensus of the HMMER, DIAMOND and Hotpep predictions computed from the tool outputs
+
+hmmer.out, diamond.out and Hotpep.out are streamed in chunks into one long table of
+(gene, tool, family) calls; a configurable agreement rule is then applied to the
+per-gene tool calls in vectorized form. With the default rule the hits are the same as
+the ones derived from the run_dbcan.py overview.txt: genes called by both Hotpep and
+DIAMOND and by at least two tools, named after their Hotpep families.
+
+python3 consensus.py -i genome_dir [--require hotpep diamond --min-tools 2 --family-from hotpep]
+"""
+import os
+import argparse
+import collections
+
+import pandas as pd
+
+TOOLS = ['hmmer', 'hotpep', 'diamond']
+
+# output file, the column with the gene id and the column the families are read from
+TOOL_FILES = {'hmmer': ('hmmer.out', 'Gene ID', 'HMM Profile'),
+              'diamond': ('diamond.out', 'Gene ID', 'CAZy ID'),
+              'hotpep': ('Hotpep.out', 'Gene ID', 'CAZy Family')}
+
+# require: tools that must all call the gene; min_tools: number of tools calling it;
+# family_from: tool whose families name the hit, or 'agreed' for the families called by min_tools tools
+Rule = collections.namedtuple('Rule', ['require', 'min_tools', 'family_from'])
+
+DEFAULT_RULE = Rule(require=('hotpep', 'diamond'), min_tools=2, family_from='hotpep')
+
+
+def rule_spec(rule):
+    """
+    :param rule: Rule
+    :return: <str> canonical text form of the rule, used to key the summaries made with it
+    """
+    return "require={};min_tools={};family_from={}".format(",".join(sorted(rule.require)), rule.min_tools,
+                                                           rule.family_from)
+
+
+def read_calls(genome_dir, tool, chunksize=None):
+    """
+    stream the (gene, family) calls of one tool, in the order of its output file
+
+    :param genome_dir: <str> path to the genome output directory
+    :param tool: <str> 'hmmer', 'diamond' or 'hotpep'
+    :param chunksize: number of rows read at a time, None to read the whole file at once
+    :return: generator of data frames with the 'Gene ID' and 'family' columns
+    """
+    fn, gene_column, family_column = TOOL_FILES[tool]
+    path = os.path.join(genome_dir, fn)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    reader = pd.read_csv(path, sep='\t', usecols=[gene_column, family_column],
+                         dtype={gene_column: str, family_column: str}, chunksize=chunksize)
+    for chunk in ([reader] if chunksize is None else reader):
+        families = chunk[family_column].astype(str)
+        if tool == 'hmmer':
+            families = families.str.replace(r'\.hmm$', '', regex=True)
+        elif tool == 'diamond':
+            # <accession>|<family>|<family>|..., with a trailing '|' on some rows
+            families = families.str.split('|').str[1:]
+            chunk = chunk.assign(**{family_column: families}).explode(family_column)
+            families = chunk[family_column]
+            keep = families.notna() & (families != '')
+            chunk, families = chunk[keep], families[keep]
+        yield pd.DataFrame({'Gene ID': chunk[gene_column].to_numpy(), 'family': families.to_numpy()})
+
+
+def read_tool_calls(genome_dir, tools=TOOLS, chunksize=None):
+    """
+    read the calls of the tools into one long table
+
+    :param genome_dir: <str> path to the genome output directory
+    :param tools: tools to read
+    :param chunksize: number of rows read at a time, None to read the whole files at once
+    :return: data frame with the 'Gene ID', 'tool' and 'family' columns
+    """
+    frames = []
+    for tool in tools:
+        for chunk in read_calls(genome_dir, tool, chunksize=chunksize):
+            frames.append(chunk.assign(tool=tool))
+    if not frames:
+        return pd.DataFrame(columns=['Gene ID', 'tool', 'family'])
+    calls = pd.concat(frames, ignore_index=True)
+    calls['tool'] = pd.Categorical(calls['tool'], categories=TOOLS)
+    return calls[['Gene ID', 'tool', 'family']]
+
+
+def gene_calls(calls):
+    """
+    one row per gene with the '+'-joined families called by each tool ('-' if none, as in
+    overview.txt) and the number of tools calling the gene
+
+    :param calls: data frame from read_tool_calls
+    :return: data frame indexed by 'Gene ID'
+    """
+    joined = calls.groupby(['Gene ID', 'tool'], observed=True, sort=False)['family'].agg('+'.join).unstack('tool')
+    joined = joined.reindex(columns=TOOLS)
+    table = joined.fillna('-')
+    table['#ofTools'] = joined.notna().sum(axis=1).astype('int64')
+    return table
+
+
+def apply_rule(calls, rule=DEFAULT_RULE):
+    """
+    gene-level consensus hits
+
+    :param calls: data frame from read_tool_calls
+    :param rule: Rule
+    :return: data frame with the 'Gene ID', 'CAZy ID' and '#ofTools' columns
+    """
+    table = gene_calls(calls)
+    mask = table['#ofTools'] >= rule.min_tools
+    for tool in rule.require:
+        mask &= table[tool] != '-'
+    table = table[mask]
+
+    if rule.family_from != 'agreed':
+        hits = pd.DataFrame({'Gene ID': table.index, 'CAZy ID': table[rule.family_from].to_numpy(),
+                             '#ofTools': table['#ofTools'].to_numpy()})
+        return hits[hits['CAZy ID'] != '-'].reset_index(drop=True)
+
+    # families, subfamilies folded, called for the gene by at least min_tools tools
+    selected = calls[calls['Gene ID'].isin(table.index)]
+    selected = selected.assign(family=selected['family'].str.split('_').str[0]).drop_duplicates()
+    votes = selected.groupby(['Gene ID', 'family'], sort=False).size()
+    agreed = votes[votes >= rule.min_tools].reset_index()[['Gene ID', 'family']]
+    agreed = agreed.groupby('Gene ID', sort=False)['family'].agg('+'.join)
+    return pd.DataFrame({'Gene ID': agreed.index, 'CAZy ID': agreed.to_numpy(),
+                         '#ofTools': table.loc[agreed.index, '#ofTools'].to_numpy()})
+
+
+def consensus_hits(genome_dir, rule=DEFAULT_RULE, chunksize=None):
+    """
+    read the tool outputs of a genome and apply the agreement rule
+
+    :param genome_dir: <str> path to the genome output directory
+    :param rule: Rule
+    :param chunksize: number of rows read at a time, None to read the whole files at once
+    :return: data frame with the 'Gene ID', 'CAZy ID' and '#ofTools' columns
+    """
+    return apply_rule(read_tool_calls(genome_dir, chunksize=chunksize), rule=rule)
+
+
+def write_overview(genome_dir):
+    """
+    write the overview.txt of a genome from its tool outputs, in the run_dbcan.py format:
+    HMMER families with the gene coordinates, Hotpep families with their peptide group,
+    DIAMOND families. The Signalp calls of an existing overview are kept.
+
+    :param genome_dir: <str> path to the genome output directory
+    :return: <int> number of genes written
+    """
+    columns = collections.OrderedDict()
+    path = os.path.join(genome_dir, 'hmmer.out')
+    if os.path.exists(path) and os.path.getsize(path):
+        df = pd.read_csv(path, sep='\t', dtype=str)
+        calls = df['HMM Profile'].str.replace(r'\.hmm$', '', regex=True) + '(' + df['Gene Start'] + '-' + \
+            df['Gene End'] + ')'
+        columns['HMMER'] = calls.groupby(df['Gene ID'], sort=False).agg('+'.join)
+    path = os.path.join(genome_dir, 'Hotpep.out')
+    if os.path.exists(path) and os.path.getsize(path):
+        df = pd.read_csv(path, sep='\t', dtype=str)
+        calls = df['CAZy Family'] + '(' + df['PPR Subfamily'] + ')'
+        columns['Hotpep'] = calls.groupby(df['Gene ID'], sort=False).agg('+'.join)
+    path = os.path.join(genome_dir, 'diamond.out')
+    if os.path.exists(path) and os.path.getsize(path):
+        df = pd.read_csv(path, sep='\t', dtype=str)
+        calls = df['CAZy ID'].str.strip('|').str.split('|').str[1:].str.join('+')
+        columns['DIAMOND'] = calls.groupby(df['Gene ID'], sort=False).agg('+'.join)
+
+    if columns:
+        overview = pd.concat(columns, axis=1).reindex(columns=['HMMER', 'Hotpep', 'DIAMOND'])
+    else:
+        overview = pd.DataFrame(columns=['HMMER', 'Hotpep', 'DIAMOND'], index=pd.Index([], dtype=str))
+    overview['#ofTools'] = overview.notna().sum(axis=1)
+    overview = overview.fillna('-')
+    signalp = 'N'
+    path = os.path.join(genome_dir, 'overview.txt')
+    if os.path.exists(path) and os.path.getsize(path):
+        previous = pd.read_csv(path, sep='\t', dtype=str, usecols=['Gene ID', 'Signalp']).set_index('Gene ID')
+        signalp = previous['Signalp'].reindex(overview.index).fillna('N').to_numpy()
+    overview.insert(3, 'Signalp', signalp)
+    overview.index.name = 'Gene ID'
+
+    tmp = path + '.tmp'
+    overview.sort_index().to_csv(tmp, sep='\t')
+    os.replace(tmp, path)
+    return len(overview)
+
+
+def family_counts(hits):
+    """
+    :param hits: gene-level hits
+    :return: data frame with the 'CAZy ID' and 'count' columns, sorted by CAZy ID
+    """
+    counts = hits.drop_duplicates(subset=['Gene ID', 'CAZy ID']).groupby('CAZy ID').size()
+    return counts.rename('count').reset_index().sort_values('CAZy ID')
+
+
+def add_rule_args(parser):
+    """
+    add the agreement rule options to a parser
+
+    :param parser: argparse parser
+    :return:
+    """
+    parser.add_argument('--require', metavar='<tool>', nargs='*',
+                        dest='require', default=list(DEFAULT_RULE.require), choices=TOOLS,
+                        help="tools that must all call a gene")
+    parser.add_argument('--min-tools', type=int, metavar='<int>',
+                        dest='min_tools', default=DEFAULT_RULE.min_tools,
+                        help="number of tools that must call a gene")
+    parser.add_argument('--family-from', metavar='<str>',
+                        dest='family_from', default=DEFAULT_RULE.family_from, choices=TOOLS + ['agreed'],
+                        help="tool whose families name the hit, or 'agreed' for the families (subfamilies folded) "
+                             "called by at least --min-tools tools")
+
+
+def rule_from_args(args):
+    """
+    :param args: parsed options of add_rule_args
+    :return: Rule
+    """
+    return Rule(require=tuple(args.require), min_tools=args.min_tools, family_from=args.family_from)
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    parser.add_argument('-i', '--genome-dir', metavar='<dir>', required=True,
+                        dest='genome_dir',
+                        help="path to the run_dbcan.py output directory of a genome")
+    parser.add_argument('--families', action='store_true',
+                        dest='families',
+                        help="print the family counts instead of the gene-level hits")
+    add_rule_args(parser)
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+    hits = consensus_hits(args.genome_dir, rule=rule_from_args(args))
+    out = family_counts(hits) if args.families else hits
+    print(out.to_csv(sep='\t', index=False), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+build the dbCAN2 databases once into a versioned release directory and stage them on
+node-local storage
+
+every database is downloaded and indexed (diamond makedb, hmmpress) in a scratch
+directory and moved into <root>/<release>/ once complete; its sources, outputs and
+their SHA-256 are recorded in db_manifest.json, so later runs reuse the built indexes
+and only build what is missing or damaged. 'current' points at the last release built.
+
+staging copies a release onto node-local storage or /dev/shm, once per node, keeping
+the modification times so that the result cache keys stay the same.
+
+python3 databases.py build -r /var/scratch/.../db
+python3 databases.py stage -r /var/scratch/.../db -t /dev/shm
+python3 databases.py verify -r /var/scratch/.../db
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import argparse
+import tempfile
+from datetime import datetime
+
+# --- project specific imports ---#
+from utils import mkdir
+from utils import sha256sum
+from utils import find_executable
+from utils import run_shell_command
+
+DBCAN_URL = 'http://bcb.unl.edu/dbCAN2/download'
+
+RELEASE = 'dbCAN-V8_CAZyDB.07312019'
+
+MANIFEST = 'db_manifest.json'
+
+# downloaded files are kept in the release, out of the staged database directory
+SOURCES_DIR = 'sources'
+
+HMM_INDEX = ['.h3f', '.h3i', '.h3m', '.h3p']
+
+# name -> (source url, downloaded file, build command, outputs)
+DATABASES = {
+    'CAZy': ('{}/CAZyDB.07312019.fa.nr'.format(DBCAN_URL), 'CAZyDB.07312019.fa.nr',
+             '{diamond} makedb --threads {threads} --in {source} -d CAZy', ['CAZy.dmnd']),
+    'dbCAN': ('{}/Databases/dbCAN-HMMdb-V8.txt'.format(DBCAN_URL), 'dbCAN-HMMdb-V8.txt',
+              'cp {source} dbCAN.txt && {hmmpress} -f dbCAN.txt', ['dbCAN.txt'] + ['dbCAN.txt' + s for s in HMM_INDEX]),
+    'tcdb': ('{}/Databases/tcdb.fa'.format(DBCAN_URL), 'tcdb.fa',
+             '{diamond} makedb --threads {threads} --in {source} -d tcdb', ['tcdb.dmnd']),
+    'tf-1': ('{}/Databases/tf-1.hmm'.format(DBCAN_URL), 'tf-1.hmm',
+             'cp {source} tf-1.hmm && {hmmpress} -f tf-1.hmm', ['tf-1.hmm'] + ['tf-1.hmm' + s for s in HMM_INDEX]),
+    'tf-2': ('{}/Databases/tf-2.hmm'.format(DBCAN_URL), 'tf-2.hmm',
+             'cp {source} tf-2.hmm && {hmmpress} -f tf-2.hmm', ['tf-2.hmm'] + ['tf-2.hmm' + s for s in HMM_INDEX]),
+    'stp': ('{}/Databases/stp.hmm'.format(DBCAN_URL), 'stp.hmm',
+            'cp {source} stp.hmm && {hmmpress} -f stp.hmm', ['stp.hmm'] + ['stp.hmm' + s for s in HMM_INDEX]),
+}
+
+
+def read_manifest(release_dir):
+    """
+    :param release_dir: <str> path to the release directory
+    :return: <dict> manifest, empty if there is none
+    """
+    try:
+        with open(os.path.join(release_dir, MANIFEST)) as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_manifest(release_dir, manifest):
+    """
+    write the manifest atomically
+
+    :param release_dir: <str> path to the release directory
+    :param manifest: <dict> manifest
+    :return:
+    """
+    tmp = os.path.join(release_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f_out:
+        json.dump(manifest, f_out, indent=2, sort_keys=True)
+    os.replace(tmp, os.path.join(release_dir, MANIFEST))
+
+
+def download(url, out_file, blocksize=1 << 20):
+    """
+    download a file through a partial file, hashing it on the way
+
+    :param url: <str> source url
+    :param out_file: <str> path to the downloaded file
+    :param blocksize: <int> read size
+    :return: <str> SHA-256 digest of the file
+    """
+    # the http stack is only needed by the releases that are downloaded
+    import urllib.request
+
+    digest = hashlib.sha256()
+    part = out_file + '.part'
+    print("downloading {}".format(url))
+    with urllib.request.urlopen(url) as response, open(part, 'wb') as f_out:
+        for block in iter(lambda: response.read(blocksize), b''):
+            digest.update(block)
+            f_out.write(block)
+    os.replace(part, out_file)
+    return digest.hexdigest()
+
+
+def check_database(release_dir, entry, verify=False):
+    """
+    check the outputs of a built database against the manifest
+
+    :param release_dir: <str> path to the release directory
+    :param entry: <dict> manifest entry of the database
+    :param verify: bool to compare the checksums, the sizes only otherwise
+    :return: <list> names of the missing or damaged outputs
+    """
+    damaged = []
+    for name, record in entry.get('outputs', {}).items():
+        path = os.path.join(release_dir, name)
+        if not os.path.exists(path) or os.path.getsize(path) != record['size'] or \
+                (verify and sha256sum(path) != record['sha256']):
+            damaged.append(name)
+    return damaged
+
+
+def build_database(release_dir, name, threads=1, logfile=sys.stderr):
+    """
+    download and index one database in a scratch directory, then move the outputs into the release
+
+    :param release_dir: <str> path to the release directory
+    :param name: <str> database name, a key of DATABASES
+    :param threads: <int> number of threads for diamond makedb
+    :param logfile: file object to write the standard errors
+    :return: <dict> manifest entry, None if the build failed
+    """
+    url, source_name, command, outputs = DATABASES[name]
+    source = os.path.join(mkdir(os.path.join(release_dir, SOURCES_DIR)), source_name)
+    if not os.path.exists(source):
+        source_sha256 = download(url, source)
+    else:
+        source_sha256 = sha256sum(source)
+
+    tmp = tempfile.mkdtemp(prefix='.build-{}-'.format(name), dir=release_dir)
+    try:
+        tools = dict(diamond=find_executable(['diamond'], default='diamond'),
+                     hmmpress=find_executable(['hmmpress'], default='hmmpress'))
+        cmd = "cd {} && {}".format(tmp, command.format(source=source, threads=threads, **tools))
+        print("building {}".format(name))
+        if not run_shell_command(cmd=cmd, logfile=logfile, raise_errors=False, extra_env=None,
+                                 tags=dict(tool='databases', genome=name)):
+            return None
+        records = dict()
+        for output in outputs:
+            path = os.path.join(tmp, output)
+            records[output] = dict(size=os.path.getsize(path), sha256=sha256sum(path))
+            os.replace(path, os.path.join(release_dir, output))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return dict(url=url, source=source_name, source_sha256=source_sha256, outputs=records,
+                built=datetime.now().isoformat(timespec='seconds'))
+
+
+def build(root, release=RELEASE, names=None, threads=1, verify=False):
+    """
+    build the missing or damaged databases of a release and point 'current' at it; concurrent
+    builds under the root run one after another
+
+    :param root: <str> path to the database root directory
+    :param release: <str> release name
+    :param names: database names, all of them if None
+    :param threads: <int> number of threads for diamond makedb
+    :param verify: bool to compare the checksums of the built outputs
+    :return: <str> path to the release directory, None if a build failed
+    """
+    release_dir = mkdir(os.path.join(root, release))
+    # concurrent jobs wait for the first one to finish the build, then find the release up to date
+    with open(os.path.join(root, '.build.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(release_dir)
+        manifest.setdefault('release', release)
+        databases = manifest.setdefault('databases', dict())
+
+        failed = []
+        for name in names or DATABASES:
+            if name in databases and not check_database(release_dir, databases[name], verify=verify):
+                print("{} is up to date".format(name))
+                continue
+            entry = build_database(release_dir, name, threads=threads)
+            if entry is None:
+                failed.append(name)
+                continue
+            databases[name] = entry
+            write_manifest(release_dir, manifest)
+        if failed:
+            print("failed to build {}".format(", ".join(failed)), file=sys.stderr)
+            return None
+
+        current = os.path.join(root, 'current')
+        tmp = current + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(release, tmp)
+        os.replace(tmp, current)
+    return release_dir
+
+
+def release_files(db_dir):
+    """
+    :param db_dir: <str> path to the database directory
+    :return: <list> of paths relative to the database directory, the downloaded sources left out
+    """
+    files = []
+    for root, dirs, fnames in os.walk(db_dir):
+        dirs[:] = sorted(d for d in dirs if not (root == db_dir and d == SOURCES_DIR) and not d.startswith('.'))
+        files.extend(os.path.relpath(os.path.join(root, fn), db_dir) for fn in sorted(fnames)
+                     if not fn.endswith('.tmp'))
+    return files
+
+
+def stage(db_dir, target_dir):
+    """
+    copy a database directory onto node-local storage, once per node; concurrent jobs wait
+    for the first one to finish the copy. Falls back to the database directory itself if
+    the target lacks the space.
+
+    :param db_dir: <str> path to the release or database directory
+    :param target_dir: <str> node-local directory, e.g. /dev/shm or $TMPDIR
+    :return: <str> path to the database directory to use
+    """
+    db_dir = os.path.realpath(db_dir)
+    files = release_files(db_dir)
+    states = {fn: os.stat(os.path.join(db_dir, fn)) for fn in files}
+    staged = os.path.join(mkdir(target_dir), 'cazyme_db-{}'.format(
+        hashlib.sha256(db_dir.encode()).hexdigest()[:12]))
+
+    with open(staged + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if all(os.path.exists(os.path.join(staged, fn)) and
+               (os.stat(os.path.join(staged, fn)).st_size, os.stat(os.path.join(staged, fn)).st_mtime_ns) ==
+               (st.st_size, st.st_mtime_ns) for fn, st in states.items()):
+            return staged
+        if shutil.disk_usage(target_dir).free < sum(st.st_size for st in states.values()) * 1.05:
+            print("not enough space in {} to stage {}, reading it in place".format(target_dir, db_dir),
+                  file=sys.stderr)
+            return db_dir
+
+        print("staging {} to {}".format(db_dir, staged))
+        tmp = tempfile.mkdtemp(prefix='.staging-', dir=target_dir)
+        try:
+            for fn in files:
+                mkdir(os.path.dirname(os.path.join(tmp, fn)))
+                # copy2 keeps the modification times the result cache fingerprints the database by
+                shutil.copy2(os.path.join(db_dir, fn), os.path.join(tmp, fn))
+            shutil.rmtree(staged, ignore_errors=True)
+            os.rename(tmp, staged)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    return staged
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    parser.add_argument('command', choices=['build', 'verify', 'stage', 'path'],
+                        help="build the databases, verify their checksums, stage them on node-local storage "
+                             "or print the path of the release")
+    parser.add_argument('-r', '--root', metavar='<dir>', required=True,
+                        dest='root',
+                        help="path to the database root directory holding the releases")
+    parser.add_argument('--release', metavar='<str>',
+                        dest='release', default=None,
+                        help="release name. If not provided, build uses {} and the other commands "
+                             "the 'current' release".format(RELEASE))
+    parser.add_argument('--only', metavar='<str>', nargs='+',
+                        dest='names', default=None, choices=sorted(DATABASES),
+                        help="databases to build")
+    parser.add_argument('--threads', type=int, metavar='<int>',
+                        dest='threads', default=1,
+                        help="number of threads for diamond makedb")
+    parser.add_argument('-t', '--target-dir', metavar='<dir>',
+                        dest='target_dir', default='/dev/shm',
+                        help="node-local directory the release is staged to")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+
+    if args.command == 'build':
+        release_dir = build(args.root, release=args.release or RELEASE, names=args.names, threads=args.threads)
+        if release_dir is None:
+            sys.exit(1)
+        print(release_dir)
+        return
+
+    release_dir = os.path.join(args.root, args.release or 'current')
+    if args.command == 'path':
+        print(os.path.realpath(release_dir))
+    elif args.command == 'stage':
+        print(stage(release_dir, args.target_dir))
+    else:
+        manifest = read_manifest(release_dir)
+        damaged = {name: check_database(release_dir, entry, verify=True)
+                   for name, entry in manifest.get('databases', {}).items()}
+        missing = sorted(set(args.names or DATABASES) - set(manifest.get('databases', {})))
+        for name in missing:
+            print("{}\tnot built".format(name))
+        for name, outputs in sorted(damaged.items()):
+            print("{}\t{}".format(name, "damaged: " + ", ".join(outputs) if outputs else "ok"))
+        if missing or any(damaged.values()):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
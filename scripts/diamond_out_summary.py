@@ -4,71 +4,98 @@
 summarize dbcan diamond output file
 """
 import os
-import re
+import shutil
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-import functools
+
+from utils import available_cpu_cores
+from utils import find_genome_files
+from utils import parquet_engine
+from cazyme_hits import write_hits
+from cazyme_hits import PARTITION_PREFIX
+from aggregate_store import STORE
+from aggregate_store import load_store
+from aggregate_store import save_store
+from aggregate_store import plan_update
+from aggregate_store import store_record
+import consensus
+
+GENOMES_DIR = "/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/genomes"
+SUMMARY_DIR = "/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/summary"
+
+# overview.txt columns needed for the consensus, read with explicit dtypes
+OVERVIEW_DTYPES = {'Gene ID': str, 'Hotpep': 'category', 'DIAMOND': 'category', '#ofTools': 'int64'}
+
+
+def consensus_hits(overview_df):
+    """
+    select the genes predicted by both Hotpep and DIAMOND and supported by at least two tools,
+    the CAZy ID is the Hotpep family with the peptide group numbers stripped
+    :param overview_df: overview rows
+    :return: data frame with the 'Gene ID', 'CAZy ID' and '#ofTools' columns
+    """
+    mask = (overview_df['Hotpep'] != '-') & (overview_df['DIAMOND'] != '-') & (overview_df['#ofTools'] >= 2)
+    hits = overview_df.loc[mask, ['Gene ID']]
+    hits['CAZy ID'] = overview_df.loc[mask, 'Hotpep'].astype(str).str.replace(r'\([^)]*\)', '', regex=True)
+    hits['#ofTools'] = overview_df.loc[mask, '#ofTools']
+    return hits
 
 
-def get_genomes(overview_file):
+def read_overview(overview_file, chunksize=None):
+    """
+    read the consensus hits of an overview file, optionally in chunks of rows so that
+    metagenome-scale files are never held in memory as a whole
+    :param overview_file: path to the overview.txt file
+    :param chunksize: number of rows read at a time, None to read the whole file at once
+    :return: generator of data frames with the 'Gene ID', 'CAZy ID' and '#ofTools' columns
+    """
+    reader = pd.read_csv(overview_file, sep="\t", usecols=list(OVERVIEW_DTYPES), dtype=OVERVIEW_DTYPES,
+                         chunksize=chunksize)
+    if chunksize is None:
+        reader = [reader]
+    for chunk in reader:
+        # drop the duplicates within the chunk early to keep the retained hits compact
+        yield consensus_hits(chunk).drop_duplicates(subset=['Gene ID', 'CAZy ID'])
+
+
+def get_genomes(overview_file, summary_dir=SUMMARY_DIR, chunksize=None, hits_dir=None, hits_format='parquet',
+                rule=None):
     """
     summarize the dbcan diamond output file: counting every cazyme id
-    :param diamond_out
     :param overview_file
-    :param out_file:
+    :param summary_dir: directory to write the per-genome gene id summary
+    :param chunksize: number of overview rows read at a time, None to read the whole file at once
+    :param hits_dir: columnar store the consensus hits are written to, None to skip it
+    :param hits_format: 'parquet' or 'npy'
+    :param rule: consensus.Rule applied to the hmmer.out, diamond.out and Hotpep.out files next to the
+                 overview file, None to take the consensus from the overview file
     :return:
     """
 
-    # # read the sheet having genomes metadata
-    # print("reading file: {}".format(diamond_file))
-    # diamond_df = pd.read_csv(diamond_file, sep="\t")
-    # cols = list(diamond_df.columns)
-
-    # cazy_dict = dict()
-    # for index, row in diamond_df.iterrows():
-    #     if row['CAZy ID'].split('|')[-1] == "":
-    #         cazy_ids = row['CAZy ID'].split('|')[1:-1]
-    #         for id in cazy_ids:
-    #             id = id.rsplit('_')[0]
-    #             cazy_dict[row['Gene ID']+' '+id] = [row['Gene ID'], id, row['% Identical'], row['Length'],
-    #                                                 row['Mismatches'], row['Gap Open'], row['Gene Start'],
-    #                                                 row['Gene End'], row['CAZy Start'], row['CAZy End'],
-    #                                                 row['E Value'], row['Bit Score']]
-    #     else:
-    #         cazy_ids = row['CAZy ID'].split('|')[1:]
-
-    #         for id in cazy_ids:
-    #             id = id.rsplit('_')[0]
-    #             cazy_dict[row['Gene ID']+' '+id] = [row['Gene ID'], id, row['% Identical'], row['Length'],
-    #                                                 row['Mismatches'], row['Gap Open'], row['Gene Start'],
-    #                                                 row['Gene End'], row['CAZy Start'], row['CAZy End'],
-    #                                                 row['E Value'], row['Bit Score']]
-
-    # df_out = pd.DataFrame(list(cazy_dict.values()), columns=cols)
-    # sample_id = os.path.basename(os.path.dirname(diamond_file))
-    # diamond_cazy_df = pd.DataFrame(df_out.groupby('CAZy ID', as_index=True)['CAZy ID'].count()).rename(columns={'CAZy ID': sample_id}).reset_index()
-
-
-    # read the overview output
-    print("reading file {}".format(overview_file))
-    overview_df = pd.read_csv(overview_file, sep="\t")
-    cols = list(overview_df.columns)
-    overview_dict = dict()
-
-    for index, row in overview_df.iterrows():
-        if row['Hotpep'] != '-' and row['DIAMOND'] != '-' and row['#ofTools'] >= 2:
-            cazy_id = re.sub(r'\([^)]*\)', "", row['Hotpep'])
-
-            if not cazy_id in overview_dict:
-                overview_dict[row['Gene ID']+' '+cazy_id] = [row['Gene ID'], row['HMMER'], row['Hotpep'], row['DIAMOND'], row['#ofTools'], cazy_id]
-
-    df_out = pd.DataFrame(list(overview_dict.values()), columns=['Gene ID',  'HMMER', 'Hotpep', 'DIAMOND', '#ofTools', 'CAZy ID'])
+    if rule is not None:
+        # consensus of the tool outputs, the overview file is not read
+        print("reading the tool outputs of {}".format(os.path.dirname(overview_file)))
+        df_out = consensus.consensus_hits(os.path.dirname(overview_file), rule=rule, chunksize=chunksize)
+    else:
+        # read the overview output, only the consensus hits are kept
+        print("reading file {}".format(overview_file))
+        chunks = list(read_overview(overview_file, chunksize=chunksize))
+        df_out = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=['Gene ID', 'CAZy ID', '#ofTools'])
+    df_out = df_out.drop_duplicates(subset=['Gene ID', 'CAZy ID'])
+
     sample_id = os.path.basename(os.path.dirname(overview_file))
+    if hits_dir is not None:
+        write_hits(df_out, genome=sample_id, hits_dir=hits_dir, fmt=hits_format)
     overview_cazy_df = pd.DataFrame(df_out.groupby('CAZy ID', as_index=True)['CAZy ID'].count()).rename(columns={'CAZy ID': sample_id}).reset_index()
     overview_cazy_df = overview_cazy_df.sort_values('CAZy ID')
     overview_geneid_cazy_df = pd.DataFrame(df_out.groupby(['Gene ID', 'CAZy ID'], as_index=True)['CAZy ID'].count()).rename(columns={'CAZy ID': sample_id}).reset_index()
     overview_geneid_cazy_df = overview_geneid_cazy_df.sort_values('CAZy ID')
 
-    out = "/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/summary/{}_overview_geneids_cazyids_summary.csv".format(sample_id)
+    out = os.path.join(summary_dir, "{}_overview_geneids_cazyids_summary.csv".format(sample_id))
     out = os.path.abspath(out)
     if not os.path.exists(os.path.dirname(out)):
         os.makedirs(os.path.dirname(out))
@@ -76,32 +103,234 @@ def get_genomes(overview_file):
     return overview_cazy_df, overview_geneid_cazy_df
 
 
+# sparse CAZy family x genome count matrix in coordinate format
+CountMatrix = collections.namedtuple('CountMatrix', ['families', 'genomes', 'rows', 'cols', 'counts'])
+
+
+def count_matrix(genome_counts):
+    """
+    accumulate per-genome CAZy family counts into a sparse CAZy family x genome matrix in a single pass
+    :param genome_counts: iterable of (genome id, CAZy families, counts) tuples
+    :return: CountMatrix with the families sorted and the genomes in the given order
+    """
+    family_index = dict()
+    genomes, rows, cols, counts = [], [], [], []
+    for col, (genome, families, values) in enumerate(genome_counts):
+        genomes.append(genome)
+        for family, value in zip(families, values):
+            rows.append(family_index.setdefault(family, len(family_index)))
+            cols.append(col)
+            counts.append(value)
+
+    # renumber the rows so that the families are in lexicographic order
+    families = sorted(family_index)
+    order = np.empty(len(families), dtype=np.int64)
+    order[[family_index[f] for f in families]] = np.arange(len(families))
+    rows = order[np.asarray(rows, dtype=np.int64)] if rows else np.zeros(0, dtype=np.int64)
+    return CountMatrix(families=families, genomes=genomes, rows=rows,
+                       cols=np.asarray(cols, dtype=np.int64), counts=np.asarray(counts, dtype=np.int64))
+
+
+def write_matrix(matrix, out_file, fmt='csv'):
+    """
+    write the CAZy family x genome count matrix
+    :param matrix: CountMatrix
+    :param out_file: path to the output file
+    :param fmt: 'csv' for the dense table, 'npz' for the sparse coordinates or 'parquet' for the long table
+    :return:
+    """
+    out_file = os.path.abspath(out_file)
+    if not os.path.exists(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file))
+
+    if fmt == 'npz':
+        np.savez_compressed(out_file, families=np.array(matrix.families), genomes=np.array(matrix.genomes),
+                            rows=matrix.rows, cols=matrix.cols, counts=matrix.counts)
+    elif fmt == 'parquet':
+        pd.DataFrame({'CAZy ID': pd.Categorical.from_codes(matrix.rows, matrix.families),
+                      'genome': pd.Categorical.from_codes(matrix.cols, matrix.genomes),
+                      'count': matrix.counts}).to_parquet(out_file, index=False)
+    else:
+        write_dense_csv(matrix, out_file)
+
+
+def write_dense_csv(matrix, out_file):
+    """
+    stream the dense CAZy family x genome table row by row, formatted like the outer merge
+    of the per-genome tables: a genome lacking any of the families is written as floats
+    :param matrix: CountMatrix
+    :param out_file: path to the output file
+    :return:
+    """
+    n_families, n_genomes = len(matrix.families), len(matrix.genomes)
+    is_float = np.bincount(matrix.cols, minlength=n_genomes) < n_families
+    zero = ['0.0' if f else '0' for f in is_float]
+
+    order = np.lexsort((matrix.cols, matrix.rows))
+    rows, cols, counts = matrix.rows[order], matrix.cols[order], matrix.counts[order]
+    bounds = np.searchsorted(rows, np.arange(n_families + 1))
+
+    with open(out_file, 'w') as f_out:
+        f_out.write(','.join(['CAZy ID'] + [str(g) for g in matrix.genomes]) + '\n')
+        for row, family in enumerate(matrix.families):
+            values = list(zero)
+            for col, count in zip(cols[bounds[row]:bounds[row + 1]], counts[bounds[row]:bounds[row + 1]]):
+                values[col] = "{}.0".format(count) if is_float[col] else str(count)
+            f_out.write(','.join([family] + values) + '\n')
+
+
+def count_genome(overview_file, summary_dir=SUMMARY_DIR, chunksize=None, hits_dir=None, hits_format='parquet',
+                 rule=None):
+    """
+    summarize one genome and reduce its CAZy family counts to compact arrays for the parent process
+    :param overview_file: path to the overview.txt file
+    :param summary_dir: directory to write the per-genome gene id summary
+    :param chunksize: number of overview rows read at a time, None to read the whole file at once
+    :param hits_dir: columnar store the consensus hits are written to, None to skip it
+    :param hits_format: 'parquet' or 'npy'
+    :param rule: consensus.Rule applied to the tool outputs, None to take the consensus from the overview file
+    :return: (genome id, CAZy families, counts) tuple
+    """
+    overview_cazy, overview_geneid_cazy = get_genomes(overview_file=overview_file, summary_dir=summary_dir,
+                                                      chunksize=chunksize, hits_dir=hits_dir,
+                                                      hits_format=hits_format, rule=rule)
+    sample_id = overview_cazy.columns[1]
+    return sample_id, np.asarray(overview_cazy['CAZy ID'], dtype=object), overview_cazy[sample_id].to_numpy()
+
+
+def count_genomes(overview_files, summary_dir=SUMMARY_DIR, chunksize=None, jobs=1, hits_dir=None,
+                  hits_format='parquet', rule=None):
+    """
+    summarize many genomes in a process pool
+    :param overview_files: list of paths to the overview.txt files
+    :param summary_dir: directory to write the per-genome gene id summaries
+    :param chunksize: number of overview rows read at a time, None to read the whole file at once
+    :param jobs: number of worker processes
+    :param hits_dir: columnar store the consensus hits are written to, None to skip it
+    :param hits_format: 'parquet' or 'npy'
+    :param rule: consensus.Rule applied to the tool outputs, None to take the consensus from the overview files
+    :return: list of (genome id, CAZy families, counts) tuples in the order of the overview files
+    """
+    if jobs <= 1:
+        return [count_genome(fn, summary_dir, chunksize, hits_dir, hits_format, rule) for fn in overview_files]
+
+    n = len(overview_files)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(count_genome, overview_files, [summary_dir] * n, [chunksize] * n,
+                                 [hits_dir] * n, [hits_format] * n, [rule] * n, chunksize=max(1, n // (jobs * 4))))
+
+
+def update_genome_counts(genome_files, store_file, summary_dir=SUMMARY_DIR, chunksize=None, jobs=1, hits_dir=None,
+                         hits_format='parquet', rule=None):
+    """
+    bring the aggregate store up to date, parsing only the added or modified overview files
+    and dropping the genomes whose overview file is gone
+    :param genome_files: list of (genome id, overview file) tuples
+    :param store_file: path to the aggregate store
+    :param summary_dir: directory to write the per-genome gene id summaries
+    :param chunksize: number of overview rows read at a time, None to read the whole file at once
+    :param jobs: number of worker processes
+    :param hits_dir: columnar store the consensus hits are written to, None to skip it
+    :param hits_format: 'parquet' or 'npy'
+    :param rule: consensus.Rule applied to the tool outputs, None to take the consensus from the overview files
+    :return: list of (genome id, CAZy families, counts) tuples in the order of the genome files
+    """
+    settings = dict(hits_dir=os.path.abspath(hits_dir) if hits_dir else None, hits_format=hits_format)
+    if rule is not None:
+        # a rule change recounts every genome, run_dbcan.py rewrites the overview file with the tool outputs
+        settings['consensus'] = consensus.rule_spec(rule)
+    genomes = load_store(store_file, settings)
+    changed, removed = plan_update(genomes, genome_files)
+    print("aggregate store: {} genomes unchanged, {} to summarize, {} removed".format(
+        len(genome_files) - len(changed), len(changed), len(removed)))
+
+    for genome in removed:
+        del genomes[genome]
+        summary = os.path.join(summary_dir, "{}_overview_geneids_cazyids_summary.csv".format(genome))
+        if os.path.exists(summary):
+            os.remove(summary)
+        if hits_dir is not None:
+            shutil.rmtree(os.path.join(hits_dir, PARTITION_PREFIX + genome), ignore_errors=True)
+
+    counted = count_genomes([fn for genome, fn, state in changed], summary_dir=summary_dir, chunksize=chunksize,
+                            jobs=jobs, hits_dir=hits_dir, hits_format=hits_format, rule=rule)
+    for (genome, fn, state), (sample_id, families, counts) in zip(changed, counted):
+        genomes[genome] = store_record(state, families, counts)
+    save_store(store_file, genomes, settings)
+
+    return [(genome, genomes[genome]['families'], genomes[genome]['counts']) for genome, fn in genome_files]
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prefix_chars='-',
+        description=__doc__
+    )
+    parser.add_argument('-g', '--genomes-dir', metavar='<dir>',
+                        dest='genomes_dir', default=GENOMES_DIR,
+                        help="path to the genomes directory having the <taxid>/overview.txt files")
+    parser.add_argument('-s', '--summary-dir', metavar='<dir>',
+                        dest='summary_dir', default=SUMMARY_DIR,
+                        help="path to the directory to write the summaries")
+    parser.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                        dest='jobs', default=available_cpu_cores(),
+                        help="number of genomes summarized in parallel")
+    parser.add_argument('--chunksize', type=int, metavar='<int>',
+                        dest='chunksize', default=None,
+                        help="number of overview rows read at a time, for metagenome-scale overview files")
+    parser.add_argument('--format', metavar='<str>',
+                        dest='fmt', default='csv', choices=['csv', 'npz', 'parquet'],
+                        help="format of the aggregated CAZy family x genome matrix")
+    parser.add_argument('--hits-format', metavar='<str>',
+                        dest='hits_format', default=None, choices=['parquet', 'npy'],
+                        help="also write the gene-level consensus hits to a genome-partitioned columnar store")
+    parser.add_argument('--hits-dir', metavar='<dir>',
+                        dest='hits_dir', default=None,
+                        help="path to the columnar hits store. If not provided, the default is <summary-dir>/cazyme_hits")
+    parser.add_argument('--incremental', action='store_true',
+                        dest='incremental',
+                        help="only summarize the genomes added or modified since the last incremental run, "
+                             "keeping their counts in <summary-dir>/{}".format(STORE))
+    parser.add_argument('--consensus', metavar='<str>',
+                        dest='consensus', default='overview', choices=['overview', 'tools'],
+                        help="take the consensus from overview.txt, or apply the agreement rule below to "
+                             "hmmer.out, diamond.out and Hotpep.out")
+    consensus.add_rule_args(parser)
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    parser = parse_args()
+    args = parser.parse_args()
+    if 'parquet' in (args.fmt, args.hits_format) and parquet_engine() is None:
+        parser.error("the parquet format needs pyarrow or fastparquet (conda install -c conda-forge pyarrow), "
+                     "or choose --format npz / --hits-format npy")
+    genome_files = find_genome_files(args.genomes_dir, 'overview.txt')
+
+    rule = consensus.rule_from_args(args) if args.consensus == 'tools' else None
+    hits_dir = None
+    if args.hits_format is not None:
+        hits_dir = args.hits_dir if args.hits_dir is not None else os.path.join(args.summary_dir, 'cazyme_hits')
+
+    if args.incremental:
+        genome_counts = update_genome_counts(genome_files, os.path.join(args.summary_dir, STORE),
+                                             summary_dir=args.summary_dir, chunksize=args.chunksize, jobs=args.jobs,
+                                             hits_dir=hits_dir, hits_format=args.hits_format, rule=rule)
+    else:
+        genome_counts = count_genomes([fn for genome, fn in genome_files], summary_dir=args.summary_dir,
+                                      chunksize=args.chunksize, jobs=args.jobs, hits_dir=hits_dir,
+                                      hits_format=args.hits_format, rule=rule)
+
+    out1 = os.path.join(args.summary_dir, "dbcan_overview_aggregated_cazyids_summary.{}".format(args.fmt))
+    write_matrix(count_matrix(genome_counts), out1, fmt=args.fmt)
+
+
 if __name__ == "__main__":
-    #genomes_dir="/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/genomes/"
-    #out1 = "/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/summary/dbcan_overview_aggregated_cazyids_summary.csv"
-
-    genomes_dir = "/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/genomes"
-    out1 = "/var/scratch/jjuma/Stanley_Onyango/cazyme_project_05102020/summary/dbcan_overview_aggregated_cazyids_summary.csv"
-    diamond_dfs = []
-    overview_dfs = []
-
-    for root, dirs, fnames in os.walk(genomes_dir):
-        fnames.sort()
-        for fn in fnames:
-            # if fn == 'diamond.out':
-            #     diamond_file = os.path.abspath(os.path.join(root, fn))
-            if fn == 'overview.txt':
-                overview_file = os.path.abspath(os.path.join(root, fn))
-                if os.path.getsize(overview_file) == 0:
-                    continue
-                else:
-                    overview_cazy, overview_geneid_cazy = get_genomes(overview_file=overview_file)
-                    overview_dfs.append(overview_cazy)
-
-    overview_results = functools.reduce(lambda left, right: pd.merge(left, right, on=['CAZy ID'], how='outer'), overview_dfs).fillna(0)
-
-
-    out1 = os.path.abspath(out1)
-    if not os.path.exists(os.path.dirname(out1)):
-        os.makedirs(os.path.dirname(out1))
-    overview_results.to_csv(out1, index=False, sep=",")
+    main()
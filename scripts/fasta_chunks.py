@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+split a large FASTA file on record boundaries into bounded-size chunk files
+
+plain files are memory-mapped and their record offsets found window by window, so
+neither the offset scan nor the chunk writer ever holds more than a window or a chunk
+of the input; gzipped files are read sequentially. A producer thread writes the next
+chunks while the current one is annotated, at most `prefetch` chunk files waiting on
+disk at any time.
+"""
+
+# --- standard imports ---#
+import os
+import mmap
+import queue
+import threading
+
+# --- third party imports ---#
+import numpy as np
+
+# --- project specific imports ---#
+from utils import read_fasta
+
+WINDOW = 64 * 1024 * 1024
+
+
+def record_offsets(mm, window=WINDOW):
+    """
+    byte offsets of the FASTA records of a memory-mapped file
+
+    :param mm: mmap or bytes of the FASTA file
+    :param window: <int> number of bytes scanned at a time
+    :return: <np.ndarray> int64 offsets of the '>' opening every record
+    """
+    offsets = []
+    previous = b'\n'
+    for start in range(0, len(mm), window):
+        block = np.frombuffer(mm[start:start + window], dtype=np.uint8)
+        starts = np.flatnonzero(block == ord('>'))
+        before = np.empty(len(starts), dtype=np.uint8)
+        if len(starts):
+            before[starts > 0] = block[starts[starts > 0] - 1]
+            before[starts == 0] = previous[0]
+        offsets.append(starts[before == ord('\n')] + start)
+        previous = bytes(block[-1:])
+    return np.concatenate(offsets).astype(np.int64) if offsets else np.zeros(0, dtype=np.int64)
+
+
+def plan_chunks(offsets, size, chunk_bytes):
+    """
+    group consecutive records into chunks of at most chunk_bytes, a record larger than
+    that making a chunk of its own
+
+    :param offsets: <np.ndarray> record offsets
+    :param size: <int> file size
+    :param chunk_bytes: <int> chunk size in bytes
+    :return: <list> of (start, end) byte ranges
+    """
+    bounds = np.append(offsets, size)
+    chunks = []
+    start = bounds[0] if len(bounds) > 1 else size
+    while start < size:
+        # last record boundary within the chunk size, at least one record
+        i = np.searchsorted(bounds, start, side='right')
+        j = max(np.searchsorted(bounds, start + chunk_bytes, side='right') - 1, i)
+        end = int(bounds[j])
+        chunks.append((int(start), end))
+        start = end
+    return chunks
+
+
+def write_range(mm, start, end, out_file, blocksize=16 * 1024 * 1024):
+    """
+    copy a byte range of the memory-mapped file to a chunk file
+
+    :return: <str> path to the chunk file
+    """
+    with open(out_file, 'wb') as f_out:
+        for pos in range(start, end, blocksize):
+            f_out.write(mm[pos:min(pos + blocksize, end)])
+    return out_file
+
+
+def iter_chunks(fasta, chunk_bytes, out_dir):
+    """
+    write the chunk files one after the other
+
+    :param fasta: <str> FASTA file, plain or gzipped
+    :param chunk_bytes: <int> chunk size in bytes
+    :param out_dir: <str> directory the chunk files are written to
+    :return: generator of (chunk index, path to the chunk file)
+    """
+    name = os.path.join(out_dir, 'chunk-{:05d}.fa')
+    if fasta.endswith('.gz'):
+        index, size, f_out = 0, 0, None
+        for header, seq in read_fasta(fasta):
+            if f_out is not None and size + len(header) + len(seq) > chunk_bytes:
+                f_out.close()
+                yield index, name.format(index)
+                index, size, f_out = index + 1, 0, None
+            if f_out is None:
+                f_out = open(name.format(index), 'w')
+            f_out.write(">{}\n{}\n".format(header, seq))
+            size += len(header) + len(seq) + 3
+        if f_out is not None:
+            f_out.close()
+            yield index, name.format(index)
+        return
+
+    with open(fasta, 'rb') as f_in:
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ranges = plan_chunks(record_offsets(mm), len(mm), chunk_bytes)
+            for index, (start, end) in enumerate(ranges):
+                yield index, write_range(mm, start, end, name.format(index))
+
+
+def stream_chunks(fasta, chunk_bytes, out_dir, prefetch=1):
+    """
+    write the chunk files in a producer thread, at most prefetch of them ahead of the consumer;
+    the consumer removes each chunk file once done with it. Chunk files left behind when the
+    consumer stops early are removed.
+
+    :param fasta: <str> FASTA file, plain or gzipped
+    :param chunk_bytes: <int> chunk size in bytes
+    :param out_dir: <str> directory the chunk files are written to
+    :param prefetch: <int> number of chunk files written ahead
+    :return: generator of (chunk index, path to the chunk file)
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for chunk in iter_chunks(fasta, chunk_bytes, out_dir):
+                while not stop.is_set():
+                    try:
+                        chunks.put(chunk, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    os.remove(chunk[1])
+                    return
+        except Exception as error:
+            errors.append(error)
+        chunks.put(done)
+
+    producer = threading.Thread(target=produce, name='fasta-chunks', daemon=True)
+    producer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        while producer.is_alive() or not chunks.empty():
+            try:
+                chunk = chunks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if chunk is not done and os.path.exists(chunk[1]):
+                os.remove(chunk[1])
+        producer.join()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+samtools-style .fai offset index of FASTA files and random-access retrieval of the
+annotated CAZyme genes
+
+the index (name, length, offset, line bases, line width per record) is written next to
+the FASTA file while it is decompressed during the fetch or once the proteins of a genome
+are annotated, and built on first use otherwise. Sequences are read with one seek per
+gene; the per-family export reads the genomes in parallel.
+
+python3 fasta_index.py index proteins.faa
+python3 fasta_index.py extract -g genomes_dir -p pairs.tsv -o genes.faa
+python3 fasta_index.py export -g genomes_dir -s summary_dir -o families_dir -f GH -j 8
+"""
+
+# --- standard imports ---#
+import os
+import csv
+import glob
+import shutil
+import logging
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+# --- project specific imports ---#
+from utils import mkdir
+from utils import read_fasta
+from utils import available_cpu_cores
+from result_cache import read_manifest
+
+FAI_SUFFIX = '.fai'
+
+# run_dbcan.py writes the proteins it called to uniInput, gene_calling.py to proteins.faa
+PROTEIN_FILES = ['uniInput', 'proteins.faa']
+
+SUMMARY_SUFFIX = '_overview_geneids_cazyids_summary.csv'
+
+FaiRecord = collections.namedtuple('FaiRecord', ['length', 'offset', 'linebases', 'linewidth'])
+
+
+class FaiBuilder(object):
+    """
+    accumulate the .fai records of a FASTA file from its lines as they are read or written
+    """
+
+    def __init__(self, filename=''):
+        self.filename = filename
+        self.records = []
+        self.pos = 0
+        self._name = None
+        self._short = False
+
+    def add(self, line, size=None):
+        """
+        :param line: <str> line without its line ending
+        :param size: <int> size of the line in bytes, line ending included; len(line) + 1 if not given
+        :return:
+        """
+        size = len(line) + 1 if size is None else size
+        if line.startswith('>'):
+            self._close()
+            self._name = line[1:].split()[0]
+            self._record = [0, self.pos + size, 0, 0]
+            self._short = False
+        elif self._name is not None and not line:
+            # a blank line ends the sequence lines that can be seeked into
+            self._short = self._record[2] > 0
+        elif self._name is not None:
+            # every line but the last of a record has the same length, as samtools requires
+            record = self._record
+            if record[2] == 0:
+                record[2], record[3] = len(line), size
+            elif self._short or len(line) > record[2] or (size > len(line) and size - len(line) != record[3] - record[2]):
+                raise ValueError("{}: different line length in sequence '{}'".format(self.filename, self._name))
+            self._short = len(line) < record[2]
+            record[0] += len(line)
+        self.pos += size
+
+    def _close(self):
+        if self._name is not None:
+            self.records.append((self._name, FaiRecord(*self._record)))
+            self._name = None
+
+    def write(self, fai_file):
+        """
+        write the .fai file atomically
+
+        :param fai_file: <str> path to the index
+        :return: <str> path to the index
+        """
+        self._close()
+        tmp = fai_file + '.tmp'
+        with open(tmp, 'w') as f_out:
+            for name, record in self.records:
+                f_out.write("{}\t{}\t{}\t{}\t{}\n".format(name, *record))
+        os.replace(tmp, fai_file)
+        return fai_file
+
+
+def build_index(fasta):
+    """
+    index a plain FASTA file
+
+    :param fasta: <str> path to the FASTA file
+    :return: <str> path to the index
+    """
+    builder = FaiBuilder(fasta)
+    with open(fasta, 'rb') as f_in:
+        for line in f_in:
+            stripped = line.rstrip(b'\r\n')
+            builder.add(stripped.decode('ascii', 'replace'), size=len(line))
+    return builder.write(fasta + FAI_SUFFIX)
+
+
+def read_index(fasta):
+    """
+    read the index of a FASTA file, building it if it is missing or older than the file
+
+    :param fasta: <str> path to the FASTA file
+    :return: <dict> record name -> FaiRecord
+    """
+    fai = fasta + FAI_SUFFIX
+    if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta):
+        build_index(fasta)
+    index = dict()
+    with open(fai) as f_in:
+        for line in f_in:
+            fields = line.rstrip('\n').split('\t')
+            index[fields[0]] = FaiRecord(*map(int, fields[1:5]))
+    return index
+
+
+def fetch(fasta, names, index=None):
+    """
+    read the sequences of the given records, one seek each
+
+    :param fasta: <str> path to the FASTA file
+    :param names: <list> of record names
+    :param index: <dict> record name -> FaiRecord, read if not given
+    :return: generator of (name, sequence) tuples, the sequence None if the record is not in the file
+    """
+    if fasta.endswith('.gz'):
+        # gzipped files cannot be seeked into, they are scanned once
+        wanted = set(names)
+        found = {header.split()[0]: seq for header, seq in read_fasta(fasta) if header.split()[0] in wanted}
+        for name in names:
+            yield name, found.get(name)
+        return
+
+    index = read_index(fasta) if index is None else index
+    with open(fasta, 'rb') as f_in:
+        for name in names:
+            record = index.get(name)
+            if record is None:
+                yield name, None
+                continue
+            lines = (record.length - 1) // record.linebases if record.length else 0
+            f_in.seek(record.offset)
+            data = f_in.read(record.length + lines * (record.linewidth - record.linebases))
+            yield name, data.replace(b'\n', b'').replace(b'\r', b'').decode('ascii')
+
+
+def index_proteins(out_dir, proteins, link=False):
+    """
+    write the .fai index of the proteins the gene ids of a genome refer to, for extract and export
+
+    :param out_dir: <str> path to the genome output directory
+    :param proteins: <str> path to the protein file
+    :param link: <bool> link the protein file into the output directory as proteins.faa, for cached predictions
+    :return:
+    """
+    if link:
+        target = os.path.join(out_dir, 'proteins.faa')
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(os.path.abspath(proteins), target)
+        proteins = target
+    if not os.path.exists(proteins) or proteins.endswith('.gz'):
+        return
+    try:
+        build_index(proteins)
+    except (OSError, ValueError) as error:
+        logging.warning("no index of {}: {}".format(proteins, error))
+
+
+def protein_file(genome_dir):
+    """
+    :param genome_dir: <str> path to the genome output directory
+    :return: <str> path to the proteins the gene ids of the genome refer to, None if there is none
+    """
+    for fn in PROTEIN_FILES:
+        path = os.path.join(genome_dir, fn)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            return path
+    # protein genomes are annotated as they are, their input is the protein file
+    key = (read_manifest(genome_dir) or {}).get('key', {})
+    if key.get('seq_type') == 'protein' and os.path.exists(key['input']['path']):
+        return key['input']['path']
+    return None
+
+
+def read_summary(summary_file):
+    """
+    :param summary_file: <str> per-genome gene id summary of diamond_out_summary.py
+    :return: <list> of (gene id, CAZy ID) tuples
+    """
+    with open(summary_file) as f_in:
+        return [(row['Gene ID'], row['CAZy ID']) for row in csv.DictReader(f_in)]
+
+
+def export_genome(genome, genome_dir, summary_file, parts_dir, families=None):
+    """
+    write the CAZyme genes of a genome into one part file per family
+
+    :param genome: <str> genome id
+    :param genome_dir: <str> path to the genome output directory
+    :param summary_file: <str> per-genome gene id summary
+    :param parts_dir: <str> directory for the part files of the genome
+    :param families: <tuple> family prefixes to export, all families if None
+    :return: <dict> family -> number of genes written
+    """
+    fasta = protein_file(genome_dir)
+    if fasta is None:
+        print("no protein file for {} in {}".format(genome, genome_dir))
+        return dict()
+
+    genes = collections.defaultdict(list)
+    for gene, cazy_id in read_summary(summary_file):
+        for family in cazy_id.split('+'):
+            if families is None or family.startswith(families):
+                genes[gene].append((family, cazy_id))
+
+    parts = dict()
+    counts = collections.Counter()
+    try:
+        for gene, seq in fetch(fasta, sorted(genes)):
+            if seq is None:
+                print("{} is not in {}".format(gene, fasta))
+                continue
+            for family, cazy_id in genes[gene]:
+                if family not in parts:
+                    parts[family] = open(os.path.join(mkdir(parts_dir), family + '.faa'), 'w')
+                parts[family].write(">{}|{} {}\n{}\n".format(genome, gene, cazy_id, seq))
+                counts[family] += 1
+    finally:
+        for f_out in parts.values():
+            f_out.close()
+    return dict(counts)
+
+
+def export_families(genomes_dir, summary_dir, out_dir, families=None, jobs=1):
+    """
+    write one FASTA file per CAZy family with the genes of every genome, the genomes read in parallel
+
+    :param genomes_dir: <str> path to the genomes directory having the <taxid> output directories
+    :param summary_dir: <str> directory having the per-genome gene id summaries
+    :param out_dir: <str> directory to write the <family>.faa files
+    :param families: <tuple> family prefixes to export, all families if None
+    :param jobs: <int> number of worker processes
+    :return: <dict> family -> number of genes written
+    """
+    summaries = sorted(glob.glob(os.path.join(summary_dir, '*' + SUMMARY_SUFFIX)))
+    genomes = [os.path.basename(fn)[:-len(SUMMARY_SUFFIX)] for fn in summaries]
+    parts_root = os.path.join(mkdir(out_dir), '.parts')
+    tasks = [(genome, os.path.join(genomes_dir, genome), fn, os.path.join(parts_root, genome), families)
+             for genome, fn in zip(genomes, summaries)]
+
+    if jobs <= 1:
+        results = [export_genome(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(export_genome, *zip(*tasks))) if tasks else []
+
+    # concatenate the parts in genome order
+    totals = collections.Counter()
+    for counts in results:
+        totals.update(counts)
+    for family in sorted(totals):
+        tmp = os.path.join(out_dir, family + '.faa.tmp')
+        with open(tmp, 'w') as f_out:
+            for genome, counts in zip(genomes, results):
+                if family in counts:
+                    with open(os.path.join(parts_root, genome, family + '.faa')) as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+        os.replace(tmp, os.path.join(out_dir, family + '.faa'))
+    shutil.rmtree(parts_root, ignore_errors=True)
+    return dict(totals)
+
+
+def extract(genomes_dir, pairs, out_file):
+    """
+    write the sequences of the given (genome, gene id) pairs
+
+    :param genomes_dir: <str> path to the genomes directory having the <taxid> output directories
+    :param pairs: <list> of (genome id, gene id) tuples
+    :param out_file: <str> path to the FASTA file
+    :return: <int> number of sequences written
+    """
+    by_genome = collections.OrderedDict()
+    for genome, gene in pairs:
+        by_genome.setdefault(genome, []).append(gene)
+
+    written = 0
+    with open(out_file, 'w') as f_out:
+        for genome, genes in by_genome.items():
+            fasta = protein_file(os.path.join(genomes_dir, genome))
+            if fasta is None:
+                print("no protein file for {}".format(genome))
+                continue
+            for gene, seq in fetch(fasta, genes):
+                if seq is None:
+                    print("{} is not in {}".format(gene, fasta))
+                    continue
+                f_out.write(">{}|{}\n{}\n".format(genome, gene, seq))
+                written += 1
+    return written
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index = subparsers.add_parser('index', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="write the .fai index of FASTA files")
+    index.add_argument('fasta', metavar='<file>', nargs='+',
+                       help="plain FASTA files")
+
+    extract_parser = subparsers.add_parser('extract', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                           help="write the sequences of (genome, gene id) pairs")
+    extract_parser.add_argument('-g', '--genomes-dir', metavar='<dir>', required=True,
+                                dest='genomes_dir',
+                                help="path to the genomes directory having the <taxid> output directories")
+    extract_parser.add_argument('-p', '--pairs', metavar='<file>', required=True,
+                                dest='pairs',
+                                help="tab-separated genome id and gene id per line")
+    extract_parser.add_argument('-o', '--out', metavar='<file>', required=True,
+                                dest='out_file',
+                                help="path to the FASTA file to write")
+
+    export = subparsers.add_parser('export', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help="write one FASTA file per CAZy family across the genomes")
+    export.add_argument('-g', '--genomes-dir', metavar='<dir>', required=True,
+                        dest='genomes_dir',
+                        help="path to the genomes directory having the <taxid> output directories")
+    export.add_argument('-s', '--summary-dir', metavar='<dir>', required=True,
+                        dest='summary_dir',
+                        help="directory having the <taxid>{} files".format(SUMMARY_SUFFIX))
+    export.add_argument('-o', '--out-dir', metavar='<dir>', required=True,
+                        dest='out_dir',
+                        help="directory to write the <family>.faa files")
+    export.add_argument('-f', '--families', metavar='<str>', nargs='+',
+                        dest='families', default=None,
+                        help="family prefixes to export, e.g. GH or GH13. If not provided, all families are exported")
+    export.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                        dest='jobs', default=available_cpu_cores(),
+                        help="number of genomes read in parallel")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+
+    if args.command == 'index':
+        for fasta in args.fasta:
+            print(build_index(fasta))
+    elif args.command == 'extract':
+        with open(args.pairs) as f_in:
+            pairs = [tuple(line.rstrip('\n').split('\t')[:2]) for line in f_in if line.strip()]
+        written = extract(args.genomes_dir, pairs, args.out_file)
+        print("{} of {} sequences written to {}".format(written, len(pairs), args.out_file))
+    else:
+        families = tuple(args.families) if args.families else None
+        totals = export_families(args.genomes_dir, args.summary_dir, args.out_dir, families=families, jobs=args.jobs)
+        print("{} genes in {} family files written to {}".format(sum(totals.values()), len(totals), args.out_dir))
+
+
+if __name__ == '__main__':
+    main()
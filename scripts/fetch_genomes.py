@@ -6,11 +6,22 @@ fetch refseq sequences using ncbi-download
 import os
 import sys
 import subprocess
-import pandas as pd
 from utils import find_executable
 from utils import uncompress_fasta
 
 
+def read_taxa_metadata(metadata_file):
+    """
+    read the taxa metadata sheet
+    :param metadata_file:
+    :return: dict with tax ids as key and [species, bioproject accession, scientific name] as values
+    """
+    # pandas, imported only once a sheet is read
+    from metadata import TAXA_SHEET
+    from metadata import TaxaIndex
+    return TaxaIndex(metadata_file, sheet_name=TAXA_SHEET).to_dict()
+
+
 def get_genomes(metadata_file, out_dir):
     """
     get taxids from the metadata file for use in downloading the genomes
@@ -22,12 +33,7 @@ def get_genomes(metadata_file, out_dir):
     # locate the executable
     tool = find_executable(["ncbi-genome-download"])
 
-    # read the sheet having genomes metadata
-    meta_df = pd.read_excel(metadata_file, sheet_name="Taxa_metadata")
-
-    # create a dict with tax ids as key and genome names and bioproject accessions as values
-    subset_df = meta_df[['Tax_ID', 'Species', 'BioProject Accession', 'Scientific_Name']]
-    meta_dic = subset_df.set_index('Tax_ID').T.to_dict('list')
+    meta_dic = read_taxa_metadata(metadata_file)
 
     for tax_id, records in meta_dic.items():
         bioproj_acc = records[1]
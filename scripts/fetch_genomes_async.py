@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+fetch genbank genome assemblies concurrently
+
+the GenBank FTP paths are resolved with batched E-utilities queries (many taxids
+per request) and the assemblies are downloaded over reused HTTP connections with
+a bounded number of concurrent transfers, decompressed on the fly straight to disk
+
+python3 fetch_genomes_async.py \
+-m taxa_metadata.xlsx \
+-o path_to_genomes_dir \
+-j max_concurrent_downloads
+"""
+
+# --- standard imports ---#
+import os
+import ssl
+import sys
+import json
+import time
+import zlib
+import asyncio
+import logging
+import argparse
+import functools
+from urllib.parse import urljoin, urlsplit, urlencode
+
+# --- project specific imports ---#
+from fetch_genomes import read_taxa_metadata
+from utils import uncompress_fasta
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+
+# E-utilities allow 3 requests per second without an API key, 10 with one
+EUTILS_INTERVAL = {False: 0.34, True: 0.1}
+
+
+class HttpError(Exception):
+    """
+    non-successful HTTP response
+    """
+    def __init__(self, url, status):
+        super().__init__("HTTP {} for {}".format(status, url))
+        self.url = url
+        self.status = status
+
+
+class HttpPool:
+    """
+    minimal asyncio HTTP/1.1 client keeping idle keep-alive connections per host for reuse
+    """
+
+    def __init__(self, limit_per_host=8, timeout=60):
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self._idle = dict()
+        self._slots = dict()
+        self._ssl = ssl.create_default_context()
+
+    async def _open(self, scheme, host, port):
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl if scheme == 'https' else None), self.timeout)
+
+    async def _connect(self, key):
+        idle = self._idle.setdefault(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        return (*await self._open(*key), False)
+
+    def _release(self, key, reader, writer, reusable):
+        if reusable and len(self._idle.setdefault(key, [])) < self.limit_per_host:
+            self._idle[key].append((reader, writer))
+        else:
+            writer.close()
+
+    async def _request(self, key, path, netloc):
+        """
+        send a GET request on a pooled connection and read the status line, opening a fresh
+        connection if the server has already closed the reused one
+        """
+        reader, writer, reused = await self._connect(key)
+        request = ("GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: cazyme-fetch\r\n"
+                   "Accept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n".format(path, netloc))
+        try:
+            writer.write(request.encode('latin-1'))
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except ConnectionError:
+            if not reused:
+                raise
+            status_line = b''
+        if not status_line and reused:
+            writer.close()
+            reader, writer = await self._open(*key)
+            writer.write(request.encode('latin-1'))
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        return reader, writer, status_line
+
+    async def stream(self, url, max_redirects=5):
+        """
+        GET the url and yield the response body in chunks
+
+        :param url: <str> http or https url
+        :param max_redirects: <int> number of redirects followed
+        :return: async generator of bytes
+        """
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            slots = self._slots.setdefault(key, asyncio.Semaphore(self.limit_per_host))
+            async with slots:
+                reader, writer, status_line = await self._request(key, path, parts.netloc)
+                try:
+                    status = int(status_line.split()[1])
+                    headers = dict()
+                    while True:
+                        line = await asyncio.wait_for(reader.readline(), self.timeout)
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                    reusable = headers.get('connection', '').lower() != 'close' and \
+                        ('content-length' in headers or 'chunked' in headers.get('transfer-encoding', ''))
+
+                    if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                        async for _ in self._body(reader, headers):
+                            pass
+                        self._release(key, reader, writer, reusable)
+                        # the location may be relative to the requested url
+                        url = urljoin(url, headers['location'])
+                        continue
+                    if status != 200:
+                        raise HttpError(url, status)
+
+                    async for chunk in self._body(reader, headers):
+                        yield chunk
+                except BaseException:
+                    writer.close()
+                    raise
+                self._release(key, reader, writer, reusable)
+                return
+        raise HttpError(url, 'too many redirects')
+
+    async def _body(self, reader, headers, blocksize=1 << 16):
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), self.timeout)).split(b';')[0], 16)
+                if size == 0:
+                    # trailers end with an empty line
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield await asyncio.wait_for(reader.readexactly(size), self.timeout)
+                await reader.readline()
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(blocksize, remaining)), self.timeout)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(chunk, remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(blocksize), self.timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def get(self, url):
+        """
+        GET the url and return the whole response body
+        """
+        return b''.join([chunk async for chunk in self.stream(url)])
+
+    def close(self):
+        for idle in self._idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class Eutils:
+    """
+    rate-limited E-utilities client
+    """
+
+    def __init__(self, pool, base_url=EUTILS_URL, api_key=None):
+        self.pool = pool
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self._lock = asyncio.Lock()
+        self._last = 0.0
+
+    async def query(self, tool, **params):
+        params['retmode'] = 'json'
+        if self.api_key:
+            params['api_key'] = self.api_key
+        async with self._lock:
+            wait = self._last + EUTILS_INTERVAL[bool(self.api_key)] - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last = time.monotonic()
+        body = await self.pool.get("{}/{}.fcgi?{}".format(self.base_url, tool, urlencode(params)))
+        return json.loads(body.decode('utf-8'))
+
+
+async def resolve_ftp_paths(eutils, records, batch_size=50):
+    """
+    resolve the GenBank FTP path of every taxid, querying many taxids per request
+
+    :param eutils: Eutils client
+    :param records: <dict> tax id -> [species, bioproject accession, scientific name]
+    :param batch_size: <int> number of taxids per query
+    :return: <dict> tax id -> ftp path, taxids without an assembly are left out
+    """
+    tax_ids = list(records)
+    ftp_paths = dict()
+    for i in range(0, len(tax_ids), batch_size):
+        batch = tax_ids[i:i + batch_size]
+        term = " OR ".join("(txid{}[Organism] AND {}[BioProject])".format(t, records[t][1]) for t in batch)
+        logging.info("resolving genbank ftp paths for {} taxonomy ids".format(len(batch)))
+        try:
+            found = await eutils.query('esearch', db='assembly', term=term, retmax=batch_size * 20)
+            uids = found['esearchresult']['idlist']
+            if not uids:
+                continue
+            summary = await eutils.query('esummary', db='assembly', id=",".join(uids))
+        except (HttpError, OSError, ValueError, KeyError, asyncio.TimeoutError) as error:
+            logging.error("error occurred when fetching genome accessions: {}".format(error))
+            continue
+
+        # match the assemblies back to the taxids by bioproject, preferring the exact taxid
+        by_bioproject = dict()
+        for t in batch:
+            by_bioproject.setdefault(str(records[t][1]), []).append(t)
+        for uid in summary['result'].get('uids', []):
+            doc = summary['result'][uid]
+            ftp_path = doc.get('ftppath_genbank')
+            if not ftp_path:
+                continue
+            for project in doc.get('gb_bioprojects', []):
+                candidates = by_bioproject.get(project.get('bioprojectaccn'), [])
+                exact = [t for t in candidates if str(t) == str(doc.get('taxid'))]
+                for t in exact or candidates:
+                    ftp_paths.setdefault(t, ftp_path)
+    return ftp_paths
+
+
+def assembly_url(ftp_path, mirror=None):
+    """
+    https url of the genomic FASTA of an assembly, optionally rewritten to a mirror
+
+    :param ftp_path: <str> GenBank ftp path of the assembly directory
+    :param mirror: <str> base url replacing the scheme and host, e.g. http://localhost:8000
+    :return: <str> url
+    """
+    url = os.path.join(ftp_path, os.path.basename(ftp_path) + '_genomic.fna.gz')
+    url = url.replace('ftp://', 'https://', 1)
+    if mirror:
+        url = mirror.rstrip('/') + urlsplit(url).path
+    return url
+
+
+async def download_fasta(pool, url, out_file):
+    """
+    download a gzipped FASTA file and decompress it on the fly
+
+    :param pool: HttpPool
+    :param url: <str> url of the .fna.gz file
+    :param out_file: <str> path to the decompressed output file
+    :return: <tuple> (compressed bytes, seconds)
+    """
+    start = time.monotonic()
+    received = 0
+    tmp = out_file + '.part'
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    member_open = False
+    try:
+        with open(tmp, 'wb') as f_out:
+            async for chunk in pool.stream(url):
+                received += len(chunk)
+                while chunk:
+                    f_out.write(decompressor.decompress(chunk))
+                    # gzip files may hold several members
+                    chunk = decompressor.unused_data
+                    member_open = not decompressor.eof
+                    if decompressor.eof:
+                        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                    else:
+                        chunk = b''
+            f_out.write(decompressor.flush())
+            if member_open:
+                raise zlib.error("truncated gzip stream from {}".format(url))
+    except BaseException:
+        # a truncated transfer leaves no partial file behind
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, out_file)
+    return received, time.monotonic() - start
+
+
+async def fetch_genome(pool, semaphore, tax_id, records, ftp_path, out_dir, mirror=None):
+    """
+    fetch the assembly of one taxid, falling back to ncbi-genome-download when no ftp path was found
+
+    :return: <bool> success
+    """
+    output_dir = os.path.join(out_dir, str(tax_id))
+    os.makedirs(output_dir, exist_ok=True)
+
+    async with semaphore:
+        if ftp_path:
+            url = assembly_url(ftp_path, mirror=mirror)
+            out_file = os.path.join(output_dir, os.path.splitext(os.path.basename(url))[0])
+            if os.path.exists(out_file):
+                logging.info("unzipped file {} exists".format(out_file))
+                return True
+            try:
+                received, seconds = await download_fasta(pool, url, out_file)
+            except (HttpError, OSError, zlib.error, asyncio.TimeoutError, asyncio.IncompleteReadError) as error:
+                logging.error("error occurred when fetching {}: {}".format(url, error))
+                return False
+            logging.info("fetched {} ({:.1f} MB in {:.1f} sec, {:.2f} MB/s)".format(
+                os.path.basename(url), received / 1e6, seconds, received / 1e6 / max(seconds, 1e-9)))
+            return True
+
+        species, bioproj_acc, sciname = records[0], records[1], records[2]
+        genus = species.split()[0]
+        strain = " ".join(sciname.replace('[', '').replace(']', '').rsplit(" ", 2)[1:])
+        cmd = ('ncbi-genome-download --section genbank --formats "fasta" '
+               '--assembly-levels "all" --genera "{}" --strains "{}" --taxids {} '
+               '--output-folder {} --flat-output -v bacteria'.format(genus, strain, tax_id, output_dir))
+        logging.info("fetching genbank genome assembly for taxid {}".format(tax_id))
+        process = await asyncio.create_subprocess_shell(cmd)
+        if await process.wait() != 0:
+            logging.error("error {} occurred when fetching genome accession\ncommand running: {}".format(
+                process.returncode, cmd))
+            return False
+        # decompress in a worker thread, the event loop keeps the other transfers going meanwhile
+        loop = asyncio.get_running_loop()
+        for fn in os.listdir(output_dir):
+            await loop.run_in_executor(None, functools.partial(uncompress_fasta, filename=os.path.join(output_dir, fn),
+                                                               suffix=".fna"))
+        return True
+
+
+async def fetch_genomes(metadata, out_dir, concurrency=8, batch_size=50, eutils_url=EUTILS_URL, mirror=None,
+                        api_key=None):
+    """
+    resolve and fetch the genome assemblies of every taxid in the metadata
+
+    :param metadata: <dict> tax id -> [species, bioproject accession, scientific name]
+    :param out_dir: <str> path to the genomes directory
+    :param concurrency: <int> maximum number of concurrent downloads
+    :param batch_size: <int> number of taxids per E-utilities query
+    :param eutils_url: <str> base url of the E-utilities
+    :param mirror: <str> base url replacing the NCBI ftp host for the downloads
+    :param api_key: <str> NCBI API key
+    :return: <dict> tax id -> success
+    """
+    pool = HttpPool(limit_per_host=concurrency)
+    try:
+        ftp_paths = await resolve_ftp_paths(Eutils(pool, eutils_url, api_key), metadata, batch_size=batch_size)
+        semaphore = asyncio.Semaphore(concurrency)
+        start = time.monotonic()
+        results = await asyncio.gather(*[fetch_genome(pool, semaphore, tax_id, records, ftp_paths.get(tax_id),
+                                                      out_dir, mirror=mirror)
+                                         for tax_id, records in metadata.items()])
+        logging.info("fetched {}/{} genomes in {:.1f} sec".format(sum(results), len(results),
+                                                                  time.monotonic() - start))
+        return dict(zip(metadata, results))
+    finally:
+        pool.close()
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prefix_chars='-',
+        description=__doc__
+    )
+    parser.add_argument('-m', '--metadata', metavar='<file>', required=True,
+                        dest='metadata_file',
+                        help="taxa metadata sheet (Taxa_metadata) in Excel format")
+    parser.add_argument('-o', '--outDir', metavar='<dir>', required=True,
+                        dest='out_dir',
+                        help="path to the genomes directory")
+    parser.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                        dest='concurrency', default=8,
+                        help="maximum number of concurrent downloads")
+    parser.add_argument('--batch-size', type=int, metavar='<int>',
+                        dest='batch_size', default=50,
+                        help="number of taxids resolved per E-utilities query")
+    parser.add_argument('--eutils-url', metavar='<url>',
+                        dest='eutils_url', default=EUTILS_URL,
+                        help="base url of the E-utilities")
+    parser.add_argument('--mirror', metavar='<url>',
+                        dest='mirror', default=None,
+                        help="base url replacing the NCBI ftp host for the downloads (e.g. a local stand-in server)")
+    parser.add_argument('--api-key', metavar='<str>',
+                        dest='api_key', default=os.environ.get('NCBI_API_KEY'),
+                        help="NCBI API key, raises the E-utilities rate limit")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S %p')
+
+    metadata = read_taxa_metadata(args.metadata_file)
+    results = asyncio.run(
+        fetch_genomes(metadata, args.out_dir, concurrency=args.concurrency, batch_size=args.batch_size,
+                      eutils_url=args.eutils_url, mirror=args.mirror, api_key=args.api_key))
+    if not all(results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
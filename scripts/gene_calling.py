@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+gene calling stage: predict the proteins of nucleotide genomes with prodigal and
+cache them by input hash and prodigal mode, so that later annotation runs are fed
+the cached proteins instead of re-running the gene prediction
+"""
+import os
+import shutil
+import logging
+import tempfile
+
+from utils import mkdir
+from utils import sha256sum
+from utils import find_executable
+from utils import run_shell_command
+
+# prodigal mode used for each sequence type, as in run_dbcan.py
+PRODIGAL_MODES = {'prok': 'single', 'meta': 'meta'}
+
+
+def prodigal_command(input_file, seq_type, faa, gff):
+    """
+    build the prodigal command line, gzipped genomes are streamed into prodigal
+
+    :param input_file: <str> nucleotide FASTA file, plain or gzipped
+    :param seq_type: <str> sequence type of the input ['prok', 'meta']
+    :param faa: <str> path to the predicted proteins
+    :param gff: <str> path to the predicted genes
+    :return: <str> command
+    """
+    prodigal = find_executable(['prodigal'])
+    if input_file.endswith('.gz'):
+        return "gzip -dc {} | {} -q -a {} -o {} -f gff -p {}".format(input_file, prodigal, faa, gff,
+                                                                      PRODIGAL_MODES[seq_type])
+    return "{} -q -i {} -a {} -o {} -f gff -p {}".format(prodigal, input_file, faa, gff, PRODIGAL_MODES[seq_type])
+
+
+def cache_entry(cache_dir, seq_type, input_sha256):
+    """
+    directory of the cached gene predictions of an input
+
+    :param cache_dir: <str> path to the gene calling cache
+    :param seq_type: <str> sequence type of the input ['prok', 'meta']
+    :param input_sha256: <str> SHA-256 digest of the input file
+    :return: <str> path to the cache entry
+    """
+    return os.path.join(cache_dir, PRODIGAL_MODES[seq_type], input_sha256[:2], input_sha256)
+
+
+def predict_genes(input_file, seq_type, out_dir, logfile, cache_dir=None, input_sha256=None):
+    """
+    predict the proteins of a genome, reusing the cached predictions when available
+
+    :param input_file: <str> nucleotide FASTA file, plain or gzipped
+    :param seq_type: <str> sequence type of the input ['prok', 'meta']
+    :param out_dir: <str> path to the genome output directory, used when no cache is given; its predictions
+                    are keyed on the input digest written next to them
+    :param logfile: file object to write the standard errors
+    :param cache_dir: <str> path to the gene calling cache
+    :param input_sha256: <str> SHA-256 digest of the input file, computed if not given
+    :return: <str> path to the predicted proteins in FASTA format, None if the prediction failed
+    """
+    if cache_dir is None:
+        input_sha256 = input_sha256 or sha256sum(input_file)
+        faa = os.path.join(out_dir, 'proteins.faa')
+        gff = os.path.join(out_dir, 'genes.gff')
+        # the predictions are reused only if they were made from the same input
+        digest_file = faa + '.sha256'
+        if os.path.exists(faa) and os.path.exists(digest_file):
+            with open(digest_file) as f_in:
+                if f_in.read().strip() == input_sha256:
+                    return faa
+            os.remove(digest_file)
+
+        # predict into temporary files moved into place once complete
+        logging.info("gene prediction on {}".format(os.path.basename(input_file)))
+        cmd = prodigal_command(input_file, seq_type, faa + '.tmp', gff + '.tmp')
+        if not run_shell_command(cmd=cmd, logfile=logfile, raise_errors=False, extra_env=None,
+                                 tags=dict(genome=os.path.basename(out_dir), tool='gene_calling')):
+            for tmp in (faa + '.tmp', gff + '.tmp'):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return None
+        os.replace(gff + '.tmp', gff)
+        os.replace(faa + '.tmp', faa)
+        with open(digest_file, 'w') as f_out:
+            f_out.write(input_sha256 + '\n')
+        return faa
+
+    entry = cache_entry(cache_dir, seq_type, input_sha256 or sha256sum(input_file))
+    faa = os.path.join(entry, 'proteins.faa')
+    if os.path.exists(faa):
+        logging.info("cached gene predictions for {}".format(os.path.basename(input_file)))
+        return faa
+
+    # predict into a scratch directory and move it into place once complete
+    parent = mkdir(os.path.dirname(entry))
+    tmp = tempfile.mkdtemp(prefix='.tmp', dir=parent)
+    logging.info("gene prediction on {}".format(os.path.basename(input_file)))
+    cmd = prodigal_command(input_file, seq_type, os.path.join(tmp, 'proteins.faa'), os.path.join(tmp, 'genes.gff'))
+    if not run_shell_command(cmd=cmd, logfile=logfile, raise_errors=False, extra_env=None,
+                             tags=dict(genome=os.path.basename(out_dir), tool='gene_calling')):
+        shutil.rmtree(tmp, ignore_errors=True)
+        return None
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another run cached the same input in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    return faa
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+per-genome log files written through a queue
+
+every process, including the scheduler's workers, only puts log records on a queue;
+a single listener thread in the main process writes them to one rotating log file
+per genome, so concurrent annotation runs never share a file descriptor and the
+log of a failing taxid can be read on its own
+"""
+import os
+import logging
+import collections
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = '[%(asctime)s] - %(''levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %I:%M:%S %p'
+
+# records without a genome go to the pipeline log
+PIPELINE_LOG = 'annotate_cazymes'
+
+
+class GenomeFileHandler(logging.Handler):
+    """
+    route the records to a size-rotated log file per genome, keeping at most max_open files open
+    """
+
+    def __init__(self, log_dir, max_bytes=10 * 1024 * 1024, backup_count=3, max_open=64):
+        super().__init__()
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_open = max_open
+        self._handlers = collections.OrderedDict()
+
+    def _handler(self, genome):
+        handler = self._handlers.pop(genome, None)
+        if handler is None:
+            handler = RotatingFileHandler(os.path.join(self.log_dir, "{}.log".format(genome)),
+                                          maxBytes=self.max_bytes, backupCount=self.backup_count)
+            handler.setFormatter(self.formatter)
+            if len(self._handlers) >= self.max_open:
+                self._handlers.popitem(last=False)[1].close()
+        self._handlers[genome] = handler
+        return handler
+
+    def emit(self, record):
+        self._handler(getattr(record, 'genome', None) or PIPELINE_LOG).emit(record)
+
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+class GenomeLogWriter:
+    """
+    file-like sink that turns the standard error lines of a tool into log records of a genome,
+    usable as the logfile of run_shell_command
+    """
+
+    def __init__(self, genome, level=logging.DEBUG):
+        self.genome = str(genome)
+        self.level = level
+        self.logger = logging.getLogger('tools')
+
+    def write(self, text):
+        for line in text.splitlines():
+            if line.strip():
+                self.logger.log(self.level, line, extra=dict(genome=self.genome))
+
+    def flush(self):
+        pass
+
+
+def install_queue_handler(queue):
+    """
+    send the records of this process to the queue, used as the initializer of pool workers
+
+    :param queue: queue drained by the listener
+    :return:
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(logging.DEBUG)
+
+
+def start_logging(log_dir, max_bytes=10 * 1024 * 1024, backup_count=3, console_level=logging.INFO):
+    """
+    start the listener writing the per-genome log files and echoing the pipeline messages to the console
+
+    :param log_dir: <str> directory of the log files
+    :param max_bytes: <int> size at which a log file is rotated
+    :param backup_count: <int> number of rotated files kept per genome
+    :param console_level: level of the records echoed to the console
+    :return: <tuple> (queue, listener), stop the listener once done
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+
+    file_handler = GenomeFileHandler(log_dir, max_bytes=max_bytes, backup_count=backup_count)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    console_handler.setLevel(console_level)
+
+    queue = multiprocessing.Queue(-1)
+    listener = QueueListener(queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    install_queue_handler(queue)
+    return queue, listener
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+cached, indexed access to the taxa and sample/subject metadata sheets
+
+the Excel sheets are converted once into a typed columnar file (Parquet when pyarrow
+or fastparquet is installed, a pickle otherwise) stored next to them and keyed on the
+size and modification time of the workbook, so that later reads skip openpyxl.
+
+the aggregated CAZyme matrix (CAZy family x genome) is joined to the taxa sheet on the
+Tax_ID of the genome directories. The sample sheet carries no genome or Tax_ID, only
+sample ids; joining it to the CAZymes therefore takes a sample x taxon abundance table
+whose columns are Tax_IDs or specI clusters (the 'specI' column of the taxa sheet).
+
+python3 metadata.py convert metadata/*.xlsx
+python3 metadata.py join -m summary.csv -t taxa_metadata.xlsx -o genomes.csv
+python3 metadata.py join -m summary.csv -t taxa_metadata.xlsx -s samples.xlsx -a abundance.tsv -o samples.csv
+"""
+
+# --- standard imports ---#
+import os
+import glob
+import argparse
+import collections
+
+# --- third-party imports ---#
+import pandas as pd
+
+# --- project specific imports ---#
+from utils import parquet_engine
+
+TAXA_SHEET = 'Taxa_metadata'
+
+# columns of the taxa sheet used to fetch the genomes
+TAXA_COLUMNS = ['Species', 'BioProject Accession', 'Scientific_Name']
+
+# name given to the unnamed first column of the sample sheet
+SAMPLE_ID = 'sample'
+
+CACHE_DIR = '.metadata_cache'
+
+Taxon = collections.namedtuple('Taxon', ['species', 'bioproject', 'scientific_name'])
+
+
+def _columnar_engine():
+    """
+    :return: <str> 'parquet' if a Parquet engine is importable, 'pickle' otherwise
+    """
+    return 'parquet' if parquet_engine() else 'pickle'
+
+
+def _typed(df):
+    """
+    give the sheet compact, consistent column types: 'NA' strings become missing values,
+    numeric-looking columns numbers and low-cardinality strings categories
+
+    :param df: data frame as read from the sheet
+    :return: data frame
+    """
+    df = df.replace('NA', pd.NA)
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        numbers = pd.to_numeric(df[column], errors='coerce')
+        if numbers.notna().sum() == df[column].notna().sum():
+            df[column] = numbers
+        elif df[column].nunique() <= len(df) // 2:
+            df[column] = df[column].astype(str).where(df[column].notna()).astype('category')
+        else:
+            df[column] = df[column].astype('string')
+    return df
+
+
+def cache_file(xlsx_file, sheet_name, cache_dir=None):
+    """
+    path of the converted sheet, named after the size and modification time of the workbook
+
+    :param xlsx_file: <str> path to the Excel workbook
+    :param sheet_name: <str> sheet name
+    :param cache_dir: <str> cache directory, <workbook dir>/.metadata_cache if not given
+    :return: <str> path, without the format extension
+    """
+    st = os.stat(xlsx_file)
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(xlsx_file)), CACHE_DIR)
+    stem = os.path.splitext(os.path.basename(xlsx_file))[0]
+    return os.path.join(cache_dir, "{}.{}.{}-{}".format(stem, sheet_name, st.st_size, st.st_mtime_ns))
+
+
+def read_sheet(xlsx_file, sheet_name=0, cache_dir=None):
+    """
+    read a metadata sheet from its columnar cache, converting the workbook on the first read
+
+    :param xlsx_file: <str> path to the Excel workbook
+    :param sheet_name: <str> or <int> sheet name or position
+    :param cache_dir: <str> cache directory, <workbook dir>/.metadata_cache if not given
+    :return: data frame
+    """
+    base = cache_file(xlsx_file, sheet_name, cache_dir)
+    for suffix, reader in (('.parquet', pd.read_parquet), ('.pkl', pd.read_pickle)):
+        if os.path.exists(base + suffix):
+            return reader(base + suffix)
+
+    df = _typed(pd.read_excel(xlsx_file, sheet_name=sheet_name))
+    try:
+        cache_dir = os.path.dirname(base)
+        os.makedirs(cache_dir, exist_ok=True)
+        # conversions of older versions of the workbook are stale
+        stem = os.path.basename(base).rsplit('.', 1)[0]
+        for stale in glob.glob(os.path.join(glob.escape(cache_dir), glob.escape(stem) + '.*')):
+            os.remove(stale)
+        suffix = '.parquet' if _columnar_engine() == 'parquet' else '.pkl'
+        tmp = base + '.tmp'
+        if suffix == '.parquet':
+            try:
+                df.to_parquet(tmp, index=False)
+            except (TypeError, ValueError, ImportError):
+                suffix = '.pkl'
+        if suffix == '.pkl':
+            df.to_pickle(tmp)
+        os.replace(tmp, base + suffix)
+    except OSError as error:
+        print("could not cache {} in {}: {}".format(xlsx_file, os.path.dirname(base), error))
+    return df
+
+
+class TaxaIndex:
+    """
+    Tax_ID -> (species, bioproject, scientific name) lookups on the taxa sheet, loaded on first use
+    """
+
+    def __init__(self, xlsx_file, sheet_name=TAXA_SHEET, cache_dir=None):
+        self.xlsx_file = xlsx_file
+        self.sheet_name = sheet_name
+        self.cache_dir = cache_dir
+        self._frame = None
+
+    @property
+    def frame(self):
+        """
+        :return: taxa sheet indexed by Tax_ID
+        """
+        if self._frame is None:
+            df = read_sheet(self.xlsx_file, sheet_name=self.sheet_name, cache_dir=self.cache_dir)
+            # trailing blank rows of the sheet have no Tax_ID
+            df = df.dropna(subset=['Tax_ID']).astype({'Tax_ID': 'int64'})
+            self._frame = df.set_index('Tax_ID', drop=False).sort_index()
+        return self._frame
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __contains__(self, tax_id):
+        return int(tax_id) in self.frame.index
+
+    def __getitem__(self, tax_id):
+        row = self.frame.loc[int(tax_id), TAXA_COLUMNS]
+        if isinstance(row, pd.DataFrame):
+            row = row.iloc[0]
+        return Taxon(*(None if pd.isna(v) else v for v in row))
+
+    def items(self):
+        """
+        :return: iterator of (tax id, Taxon) pairs in Tax_ID order
+        """
+        subset = self.frame[TAXA_COLUMNS].astype(object)
+        subset = subset.where(subset.notna(), None)
+        for tax_id, values in zip(subset.index, subset.itertuples(index=False, name=None)):
+            yield int(tax_id), Taxon(*values)
+
+    def to_dict(self):
+        """
+        :return: dict with tax ids as key and [species, bioproject accession, scientific name] as values
+        """
+        return {tax_id: list(taxon) for tax_id, taxon in self.items()}
+
+
+def read_samples(xlsx_file, sheet_name=0, cache_dir=None):
+    """
+    read the sample/subject sheet indexed by sample id
+
+    :param xlsx_file: <str> path to the Excel workbook
+    :param sheet_name: <str> or <int> sheet name or position
+    :param cache_dir: <str> cache directory
+    :return: data frame
+    """
+    df = read_sheet(xlsx_file, sheet_name=sheet_name, cache_dir=cache_dir)
+    df = df.rename(columns={df.columns[0]: SAMPLE_ID}) if str(df.columns[0]).startswith('Unnamed') else df
+    return df.set_index(SAMPLE_ID)
+
+
+def read_matrix(matrix_file):
+    """
+    read the aggregated CAZyme matrix as genomes x CAZy families
+
+    :param matrix_file: <str> path to the dbcan_overview_aggregated_cazyids_summary.csv file
+    :return: data frame indexed by Tax_ID
+    """
+    matrix = pd.read_csv(matrix_file, index_col='CAZy ID').fillna(0).T
+    matrix.index = matrix.index.astype(int)
+    matrix.index.name = 'Tax_ID'
+    return matrix
+
+
+def join_taxa(matrix, taxa, columns=None):
+    """
+    join the taxa metadata onto the genome rows of the CAZyme matrix
+
+    :param matrix: genomes x CAZy families data frame indexed by Tax_ID
+    :param taxa: TaxaIndex
+    :param columns: taxa columns to join, all of them if None
+    :return: data frame
+    """
+    meta = taxa.frame.drop(columns='Tax_ID')
+    if columns is not None:
+        meta = meta[columns]
+    return meta.join(matrix, how='right')
+
+
+def join_samples(matrix, samples, abundance, taxa=None):
+    """
+    profile the CAZy families of the samples by weighting the genome counts with the taxon abundances,
+    and join the sample/subject metadata
+
+    :param matrix: genomes x CAZy families data frame indexed by Tax_ID
+    :param samples: sample/subject data frame indexed by sample id
+    :param abundance: samples x taxa data frame, with Tax_IDs or specI clusters as columns
+    :param taxa: TaxaIndex, required to map specI clusters to Tax_IDs
+    :return: data frame
+    """
+    tax_ids = pd.to_numeric(pd.Series(abundance.columns), errors='coerce')
+    if tax_ids.isna().any():
+        if taxa is None:
+            raise ValueError("abundance columns are not Tax_IDs, the taxa sheet is needed to map them")
+        specI = taxa.frame.dropna(subset=['specI']).drop_duplicates('specI').set_index('specI')['Tax_ID']
+        tax_ids = pd.Series(abundance.columns).map(specI)
+    abundance = abundance.set_axis(tax_ids.to_numpy(), axis=1)
+    abundance = abundance.loc[:, abundance.columns.notna()]
+    abundance = abundance.T.groupby(level=0).sum().T
+
+    shared = matrix.index.intersection(abundance.columns.astype(int))
+    profile = abundance[shared].to_numpy(dtype=float) @ matrix.loc[shared].to_numpy(dtype=float)
+    profile = pd.DataFrame(profile, index=abundance.index, columns=matrix.columns)
+    return samples.join(profile, how='right')
+
+
+def parse_args():
+    """
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                    help="convert the Excel sheets into their columnar cache")
+    convert.add_argument('xlsx_files', metavar='<file>', nargs='+',
+                         help="Excel workbooks")
+
+    join = subparsers.add_parser('join', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                 help="join the metadata onto the aggregated CAZyme matrix")
+    join.add_argument('-m', '--matrix', metavar='<file>', required=True,
+                      dest='matrix_file',
+                      help="aggregated CAZyme matrix written by diamond_out_summary.py")
+    join.add_argument('-t', '--taxa', metavar='<file>', required=True,
+                      dest='taxa_file',
+                      help="taxa metadata workbook (Taxa_metadata sheet)")
+    join.add_argument('-s', '--samples', metavar='<file>',
+                      dest='samples_file', default=None,
+                      help="sample/subject metadata workbook, requires --abundance")
+    join.add_argument('-a', '--abundance', metavar='<file>',
+                      dest='abundance_file', default=None,
+                      help="tab-separated samples x taxa abundance table, Tax_IDs or specI clusters as columns")
+    join.add_argument('-c', '--columns', metavar='<str>', nargs='+',
+                      dest='columns', default=None,
+                      help="taxa columns to join, all of them if not given")
+    join.add_argument('-o', '--out', metavar='<file>', required=True,
+                      dest='out_file',
+                      help="output CSV file")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    parser = parse_args()
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        for xlsx_file in args.xlsx_files:
+            for sheet_name in pd.ExcelFile(xlsx_file).sheet_names:
+                df = read_sheet(xlsx_file, sheet_name=sheet_name)
+                print("{}\t{}\t{} rows".format(xlsx_file, sheet_name, len(df)))
+        return
+
+    if (args.samples_file is None) != (args.abundance_file is None):
+        parser.error("--samples and --abundance go together")
+
+    taxa = TaxaIndex(args.taxa_file)
+    matrix = read_matrix(args.matrix_file)
+    if args.samples_file is None:
+        out = join_taxa(matrix, taxa, columns=args.columns)
+    else:
+        abundance = pd.read_csv(args.abundance_file, sep='\t', index_col=0)
+        out = join_samples(matrix, read_samples(args.samples_file), abundance, taxa=taxa)
+    out.to_csv(args.out_file)
+
+
+if __name__ == '__main__':
+    main()
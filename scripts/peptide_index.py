@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+conserved-peptide matcher standing in for the Hotpep stage of run_dbcan.py
+
+the Hotpep conserved-peptide groups (CAZY_PPR_patterns/<family>/<group>.txt, one
+peptide and its frequency per line) are compiled once per database release into a
+sorted array of peptide codes with postings (group, frequency), saved as .npy files
+in the database directory. Scans memory-map the index, so that the worker processes
+share its pages, and match batches of proteins with array lookups. A protein is
+assigned to a group when it holds at least --hits of the group peptides summing to a
+frequency of at least --freq, the best group of each family is written to Hotpep.out.
+
+python3 peptide_index.py build -p CAZY_PPR_patterns -db db_dir
+python3 peptide_index.py scan -i proteins.faa -db db_dir -o out_dir/Hotpep.out -j 8
+"""
+
+# --- standard imports ---#
+import os
+import re
+import sys
+import json
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+# --- third party imports ---#
+import numpy as np
+
+# --- project specific imports ---#
+from utils import read_fasta
+from utils import available_cpu_cores
+
+INDEX_PREFIX = 'hotpep.'
+INDEX_META = INDEX_PREFIX + 'index.json'
+INDEX_ARRAYS = ['kmers', 'offsets', 'groups', 'freqs']
+INDEX_VERSION = 2
+
+ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'
+INVALID = 255
+# longest peptide whose base-20 code fits in 64 bits
+MAX_K = 14
+
+# run_dbcan.py defaults of --hotpep_hits and --hotpep_freq
+MIN_HITS = 6
+MIN_FREQ = 2.6
+
+# summed frequencies within this of the threshold pass it, whatever the order they were added in
+FREQ_TOLERANCE = 1e-9
+
+HOTPEP_HEADER = ['CAZy Family', 'PPR Subfamily', 'Gene ID', 'Frequency', 'Hits', 'Signature Peptides']
+
+PeptideIndex = collections.namedtuple('PeptideIndex', ['k', 'labels', 'kmers', 'offsets', 'groups', 'freqs'])
+
+_LOOKUP = np.full(256, INVALID, dtype=np.uint8)
+for _code, _residue in enumerate(ALPHABET):
+    _LOOKUP[ord(_residue)] = _LOOKUP[ord(_residue.lower())] = _code
+
+# index of the worker processes, memory-mapped once per worker
+_INDEX = None
+
+
+def encode(peptide):
+    """
+    :param peptide: <str> peptide of standard residues
+    :return: <int> base-20 code of the peptide, None if it holds another residue
+    """
+    code = 0
+    for residue in peptide.upper():
+        if residue not in ALPHABET:
+            return None
+        code = code * len(ALPHABET) + ALPHABET.index(residue)
+    return code
+
+
+def decode(code, k):
+    """
+    :param code: <int> base-20 code
+    :param k: <int> peptide length
+    :return: <str> peptide
+    """
+    residues = []
+    for _ in range(k):
+        code, residue = divmod(int(code), len(ALPHABET))
+        residues.append(ALPHABET[residue])
+    return ''.join(reversed(residues))
+
+
+def read_patterns(patterns_dir):
+    """
+    read the conserved-peptide groups
+
+    :param patterns_dir: <str> path to the Hotpep patterns directory, <family>/<group>.txt files
+    :return: <list> of ((family, group), [(peptide, frequency), ...]) sorted by family and group
+    """
+    groups = []
+    for root, dirs, fnames in os.walk(patterns_dir):
+        dirs.sort()
+        for fn in sorted(fnames):
+            number = re.sub(r'\D', '', os.path.splitext(fn)[0])
+            if not fn.endswith('.txt') or not number:
+                continue
+            peptides = []
+            with open(os.path.join(root, fn)) as f_in:
+                for line in f_in:
+                    fields = line.split()
+                    if fields and not fields[0].startswith('#'):
+                        peptides.append((fields[0], float(fields[1]) if len(fields) > 1 else 1.0))
+            if peptides:
+                groups.append(((os.path.basename(root), int(number)), peptides))
+    return sorted(groups, key=lambda g: g[0])
+
+
+def patterns_fingerprint(patterns_dir):
+    """
+    :param patterns_dir: <str> path to the Hotpep patterns directory
+    :return: <list> [files, total size, latest mtime_ns] of the pattern files
+    """
+    files, size, mtime = 0, 0, 0
+    for root, dirs, fnames in os.walk(patterns_dir):
+        for fn in fnames:
+            st = os.stat(os.path.join(root, fn))
+            files, size, mtime = files + 1, size + st.st_size, max(mtime, st.st_mtime_ns)
+    return [files, size, mtime]
+
+
+def build_index(patterns_dir, db_dir):
+    """
+    compile the conserved-peptide groups into the database directory, unless an index of the
+    same patterns is already there
+
+    :param patterns_dir: <str> path to the Hotpep patterns directory
+    :param db_dir: <str> path to the database directory
+    :return: <dict> index metadata
+    """
+    fingerprint = patterns_fingerprint(patterns_dir)
+    meta = read_meta(db_dir)
+    if meta is not None and meta['version'] == INDEX_VERSION and meta['patterns'] == fingerprint:
+        return meta
+    if meta is not None:
+        os.remove(os.path.join(db_dir, INDEX_META))
+
+    groups = read_patterns(patterns_dir)
+    if not groups:
+        raise ValueError("no peptide groups found in {}".format(patterns_dir))
+    lengths = {len(p) for label, peptides in groups for p, freq in peptides}
+    if len(lengths) != 1:
+        raise ValueError("the peptides of {} have different lengths: {}".format(patterns_dir, sorted(lengths)))
+    k = lengths.pop()
+    if k > MAX_K:
+        raise ValueError("the peptides of {} are longer than {} residues: {}".format(patterns_dir, MAX_K, k))
+
+    codes, group_ids, freqs = [], [], []
+    skipped = 0
+    for group_id, (label, peptides) in enumerate(groups):
+        for peptide, freq in peptides:
+            code = encode(peptide)
+            if code is None:
+                skipped += 1
+                continue
+            codes.append(code)
+            group_ids.append(group_id)
+            freqs.append(freq)
+    if skipped:
+        print("{} peptides with non-standard residues skipped".format(skipped), file=sys.stderr)
+
+    codes = np.asarray(codes, dtype=np.uint64)
+    order = np.argsort(codes, kind='stable')
+    kmers, counts = np.unique(codes[order], return_counts=True)
+    arrays = dict(kmers=kmers,
+                  offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                  groups=np.asarray(group_ids, dtype=np.int32)[order],
+                  freqs=np.asarray(freqs, dtype=np.float64)[order])
+
+    for name in INDEX_ARRAYS:
+        tmp = os.path.join(db_dir, INDEX_PREFIX + name + '.tmp.npy')
+        np.save(tmp, arrays[name])
+        os.replace(tmp, os.path.join(db_dir, INDEX_PREFIX + name + '.npy'))
+    meta = dict(version=INDEX_VERSION, k=k, patterns=fingerprint, peptides=int(len(codes)),
+                labels=[list(label) for label, peptides in groups])
+    # the metadata is written last, an index without it is incomplete
+    tmp = os.path.join(db_dir, INDEX_META + '.tmp')
+    with open(tmp, 'w') as f_out:
+        json.dump(meta, f_out)
+    os.replace(tmp, os.path.join(db_dir, INDEX_META))
+    return meta
+
+
+def read_meta(db_dir):
+    """
+    :param db_dir: <str> path to the database directory
+    :return: <dict> index metadata, None if there is no index
+    """
+    try:
+        with open(os.path.join(db_dir, INDEX_META)) as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return None
+
+
+def load_index(db_dir, mmap=True):
+    """
+    :param db_dir: <str> path to the database directory
+    :param mmap: <bool> memory-map the arrays instead of reading them
+    :return: PeptideIndex
+    """
+    meta = read_meta(db_dir)
+    if meta is None:
+        raise FileNotFoundError("no peptide index in {}, build it with 'peptide_index.py build'".format(db_dir))
+    if meta['version'] != INDEX_VERSION:
+        raise ValueError("the peptide index in {} is from an older version, rebuild it with "
+                         "'peptide_index.py build'".format(db_dir))
+    arrays = {name: np.load(os.path.join(db_dir, INDEX_PREFIX + name + '.npy'), mmap_mode='r' if mmap else None)
+              for name in INDEX_ARRAYS}
+    return PeptideIndex(k=meta['k'], labels=[tuple(label) for label in meta['labels']], **arrays)
+
+
+def scan_batch(index, batch, min_hits=MIN_HITS, min_freq=MIN_FREQ):
+    """
+    match a batch of proteins against the peptide groups
+
+    :param index: PeptideIndex
+    :param batch: <list> of (gene id, sequence) tuples
+    :param min_hits: <int> peptides of a group a protein must hold
+    :param min_freq: <float> summed frequency of these peptides
+    :return: <list> of Hotpep.out rows, the best group of each family, in the order of the batch
+    """
+    k, base = index.k, len(ALPHABET)
+    lengths = np.array([len(seq) for gene, seq in batch], dtype=np.int64)
+    residues = _LOOKUP[np.frombuffer(''.join(seq for gene, seq in batch).encode('ascii', 'replace'), dtype=np.uint8)]
+    if len(residues) < k:
+        return []
+
+    # codes of every window of k residues lying within one protein and made of standard residues
+    protein = np.repeat(np.arange(len(batch), dtype=np.uint64), lengths)
+    windows = np.lib.stride_tricks.sliding_window_view(residues, k)
+    valid = (protein[:len(windows)] == protein[k - 1:]) & (windows != INVALID).all(axis=1)
+    powers = base ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    codes = (windows[valid].astype(np.uint64) * powers).sum(axis=1, dtype=np.uint64)
+
+    # distinct peptides of each protein, found in the index
+    pairs = np.unique(np.column_stack([protein[:len(windows)][valid], codes]), axis=0)
+    proteins, codes = pairs[:, 0], pairs[:, 1]
+    pos = np.minimum(np.searchsorted(index.kmers, codes), len(index.kmers) - 1)
+    found = index.kmers[pos] == codes
+    proteins, codes, pos = proteins[found], codes[found], pos[found]
+
+    # expand the postings of the found peptides
+    starts = np.asarray(index.offsets[pos])
+    counts = np.asarray(index.offsets[pos + 1]) - starts
+    postings = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    groups = np.asarray(index.groups[postings]).astype(np.int64)
+    keys = np.repeat(proteins.astype(np.int64), counts) * len(index.labels) + groups
+    peptides = np.repeat(codes, counts)
+
+    keys, inverse = np.unique(keys, return_inverse=True)
+    hits = np.bincount(inverse)
+    freqs = np.bincount(inverse, weights=np.asarray(index.freqs[postings], dtype=np.float64))
+    passing = np.flatnonzero((hits >= min_hits) & (freqs >= min_freq - FREQ_TOLERANCE))
+
+    best = dict()
+    for i in passing:
+        protein_id, group = divmod(int(keys[i]), len(index.labels))
+        family, number = index.labels[group]
+        score = (freqs[i], hits[i])
+        if (protein_id, family) not in best or score > best[protein_id, family][0]:
+            best[protein_id, family] = (score, i, number)
+
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+    rows = []
+    for (protein_id, family), (score, i, number) in sorted(best.items()):
+        signature = sorted(decode(code, k) for code in peptides[order[bounds[i]:bounds[i + 1]]])
+        rows.append([family, number, batch[protein_id][0], round(float(freqs[i]), 2), int(hits[i]),
+                     ','.join(signature)])
+    return rows
+
+
+def batches(fasta, batch_size):
+    """
+    :param fasta: <str> protein file in FASTA format
+    :param batch_size: <int> proteins per batch
+    :return: generator of lists of (gene id, sequence) tuples, the gene id being the first word of the header
+    """
+    batch = []
+    for header, seq in read_fasta(fasta):
+        batch.append((header.split()[0], seq))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _init_worker(db_dir):
+    global _INDEX
+    _INDEX = load_index(db_dir)
+
+
+def _scan_worker(batch, min_hits, min_freq):
+    return scan_batch(_INDEX, batch, min_hits=min_hits, min_freq=min_freq)
+
+
+def scan_fasta(fasta, db_dir, out_file, jobs=1, batch_size=2000, min_hits=MIN_HITS, min_freq=MIN_FREQ):
+    """
+    scan a protein file and write its Hotpep.out
+
+    :param fasta: <str> protein file in FASTA format
+    :param db_dir: <str> path to the database directory holding the index
+    :param out_file: <str> path to the Hotpep.out file
+    :param jobs: <int> number of worker processes
+    :param batch_size: <int> proteins per batch
+    :param min_hits: <int> peptides of a group a protein must hold
+    :param min_freq: <float> summed frequency of these peptides
+    :return: <int> number of rows written
+    """
+    tmp = out_file + '.tmp'
+    written = 0
+    with open(tmp, 'w') as f_out:
+        f_out.write('\t'.join(HOTPEP_HEADER) + '\n')
+        if jobs <= 1:
+            index = load_index(db_dir)
+            results = (scan_batch(index, batch, min_hits, min_freq) for batch in batches(fasta, batch_size))
+            for rows in results:
+                written += write_rows(f_out, rows)
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(db_dir,)) as executor:
+                # keep a bounded number of batches in flight, written in input order
+                pending = collections.deque()
+                for batch in batches(fasta, batch_size):
+                    pending.append(executor.submit(_scan_worker, batch, min_hits, min_freq))
+                    if len(pending) >= 2 * jobs:
+                        written += write_rows(f_out, pending.popleft().result())
+                while pending:
+                    written += write_rows(f_out, pending.popleft().result())
+    os.replace(tmp, out_file)
+    return written
+
+
+def write_rows(f_out, rows):
+    for row in rows:
+        f_out.write('\t'.join(map(str, row)) + '\n')
+    return len(rows)
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="compile the conserved-peptide groups into the database directory")
+    build.add_argument('-p', '--patterns', metavar='<dir>', required=True,
+                       dest='patterns_dir',
+                       help="path to the Hotpep CAZY_PPR_patterns directory")
+    build.add_argument('-db', '--database-dir', metavar='<dir>', required=True,
+                       dest='db_dir',
+                       help="path to the database directory, e.g. the release built by databases.py")
+
+    scan = subparsers.add_parser('scan', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                 help="write the Hotpep.out of a protein file")
+    scan.add_argument('-i', '--input', metavar='<file>', required=True,
+                      dest='fasta',
+                      help="protein file in FASTA format, plain or gzipped")
+    scan.add_argument('-db', '--database-dir', metavar='<dir>', required=True,
+                      dest='db_dir',
+                      help="path to the database directory holding the index")
+    scan.add_argument('-o', '--out', metavar='<file>', required=True,
+                      dest='out_file',
+                      help="path to the Hotpep.out file")
+    scan.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                      dest='jobs', default=available_cpu_cores(),
+                      help="number of worker processes")
+    scan.add_argument('--batch-size', type=positive_int, metavar='<int>',
+                      dest='batch_size', default=2000,
+                      help="proteins per batch")
+    scan.add_argument('--hits', type=int, metavar='<int>',
+                      dest='min_hits', default=MIN_HITS,
+                      help="conserved peptides of a group a protein must hold")
+    scan.add_argument('--freq', type=float, metavar='<float>',
+                      dest='min_freq', default=MIN_FREQ,
+                      help="summed frequency of these peptides")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+
+    if args.command == 'build':
+        meta = build_index(args.patterns_dir, args.db_dir)
+        print("{} peptides of length {} in {} groups".format(meta['peptides'], meta['k'], len(meta['labels'])))
+        return
+
+    written = scan_fasta(args.fasta, args.db_dir, args.out_file, jobs=args.jobs, batch_size=args.batch_size,
+                         min_hits=args.min_hits, min_freq=args.min_freq)
+    print("{} Hotpep rows written to {}".format(written, args.out_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+resumable pipeline driver: fetch -> decompress -> gene-call -> annotate -> summarize
+
+the state of every genome is kept in an SQLite work queue; each stage transition is
+committed in its own transaction, so that a run killed by a SLURM preemption or a node
+failure resumes where it stopped. Failed stages are retried with exponential backoff,
+stages claimed by a process that is gone are handed out again. The annotate stage only
+completes once the result manifest is written, so outputs half-written by a killed
+run_dbcan.py are annotated again.
+
+python3 pipeline.py run -g genomes_dir -s meta -db db_dir -o summary_dir [-m taxa_metadata.xlsx]
+python3 pipeline.py status -g genomes_dir
+python3 pipeline.py retry -g genomes_dir [genome ...]
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import time
+import socket
+import sqlite3
+import asyncio
+import logging
+import argparse
+
+# --- project specific imports ---#
+from utils import mkdir
+from utils import uncompress_fasta
+from annotate_cazymes import find_genomes
+from annotate_cazymes import dbcan_cazymes
+from gene_calling import predict_genes
+from scheduler import cpu_budget
+from scheduler import run_jobs
+from scheduler import worker_pool
+from result_cache import cache_key
+from result_cache import is_fresh
+from result_cache import read_manifest
+from genome_logs import GenomeLogWriter
+from genome_logs import start_logging
+
+STAGES = ['fetch', 'decompress', 'gene-call', 'annotate', 'summarize', 'done']
+
+# stages run per genome in the worker pool, the others run once over all the genomes waiting for them
+GENOME_STAGES = ['decompress', 'gene-call', 'annotate']
+
+# default location of the queue, the gene cache and the logs, hidden from the genome discovery
+STATE_DIR = '.pipeline'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS genomes (
+    genome TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    owner TEXT,
+    claimed REAL,
+    input_file TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    genome TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    at REAL NOT NULL,
+    detail TEXT
+);
+"""
+
+
+def owner_id():
+    """
+    :return: <str> host and process id of the caller
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    """
+    per-genome stage and status, one row per genome; status is pending, running or failed,
+    and a genome that went through every stage is at stage and status 'done'
+    """
+
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        self.db = sqlite3.connect(queue_file, timeout=120, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _transaction(self, statements):
+        """
+        run (sql, parameters) statements in one immediate transaction
+
+        :return: <int> number of rows changed by the first statement
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            changed = [self.db.execute(sql, params).rowcount for sql, params in statements]
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return changed[0]
+
+    def add(self, genome, stage, input_file=None):
+        """
+        queue a genome at a stage, keeping the state of a genome already queued
+
+        :return: <bool> True if the genome is new
+        """
+        return self._transaction([
+            ("INSERT OR IGNORE INTO genomes (genome, stage, input_file, updated) VALUES (?, ?, ?, ?)",
+             (genome, stage, input_file, time.time()))]) == 1
+
+    def get(self, genome):
+        return self.db.execute("SELECT * FROM genomes WHERE genome = ?", (genome,)).fetchone()
+
+    def runnable(self, stages, now=None):
+        """
+        :param stages: stages to select
+        :return: <list> of rows pending at one of the stages and out of their backoff delay
+        """
+        marks = ",".join("?" * len(stages))
+        return self.db.execute("SELECT * FROM genomes WHERE status = 'pending' AND not_before <= ? "
+                               "AND stage IN ({}) ORDER BY genome".format(marks),
+                               [now or time.time()] + list(stages)).fetchall()
+
+    def at_stage(self, stage):
+        """
+        :return: <list> of genome ids at the stage, whatever their status
+        """
+        return [row[0] for row in self.db.execute("SELECT genome FROM genomes WHERE stage = ?", (stage,))]
+
+    def next_wakeup(self, stages=None):
+        """
+        :param stages: stages to select, all of them if not given
+        :return: <float> earliest time a pending genome leaves its backoff delay, None if nothing is pending
+        """
+        if stages is None:
+            return self.db.execute("SELECT MIN(not_before) FROM genomes WHERE status = 'pending'").fetchone()[0]
+        marks = ",".join("?" * len(stages))
+        return self.db.execute("SELECT MIN(not_before) FROM genomes WHERE status = 'pending' "
+                               "AND stage IN ({})".format(marks), list(stages)).fetchone()[0]
+
+    def claim(self, genome, stage):
+        """
+        mark a pending stage as running by this process
+
+        :return: <bool> True if the stage was claimed, False if another process holds it
+        """
+        now = time.time()
+        return self._transaction([
+            ("UPDATE genomes SET status = 'running', owner = ?, claimed = ?, updated = ? "
+             "WHERE genome = ? AND stage = ? AND status = 'pending'", (owner_id(), now, now, genome, stage)),
+            ("INSERT INTO transitions VALUES (?, ?, 'running', ?, ?)", (genome, stage, now, owner_id()))]) == 1
+
+    def advance(self, genome, stage, input_file=None):
+        """
+        complete a stage and queue the genome at the next one
+        """
+        now = time.time()
+        following = STAGES[STAGES.index(stage) + 1]
+        status = 'done' if following == 'done' else 'pending'
+        self._transaction([
+            ("UPDATE genomes SET stage = ?, status = ?, attempts = 0, not_before = 0, owner = NULL, "
+             "claimed = NULL, error = NULL, input_file = COALESCE(?, input_file), updated = ? "
+             "WHERE genome = ? AND stage = ?", (following, status, input_file, now, genome, stage)),
+            ("INSERT INTO transitions VALUES (?, ?, 'done', ?, ?)", (genome, stage, now, input_file))])
+
+    def fail(self, genome, stage, error, max_attempts=3, backoff=60):
+        """
+        record a failed attempt, the stage is retried after an exponential backoff until max_attempts
+
+        :return: <bool> True if the stage will be retried
+        """
+        now = time.time()
+        row = self.get(genome)
+        attempts = row['attempts'] + 1
+        retry = attempts < max_attempts
+        self._transaction([
+            ("UPDATE genomes SET status = ?, attempts = ?, not_before = ?, owner = NULL, claimed = NULL, "
+             "error = ?, updated = ? WHERE genome = ? AND stage = ?",
+             ('pending' if retry else 'failed', attempts, now + backoff * 2 ** (attempts - 1), str(error), now,
+              genome, stage)),
+            ("INSERT INTO transitions VALUES (?, ?, 'failed', ?, ?)", (genome, stage, now, str(error)))])
+        return retry
+
+    def reclaim(self, stale_after=24 * 3600):
+        """
+        hand out again the stages claimed by processes of this host that are gone, or claimed
+        longer than stale_after seconds ago on other hosts
+
+        :return: <int> number of stages released
+        """
+        host = socket.gethostname()
+        released = 0
+        for row in self.db.execute("SELECT * FROM genomes WHERE status = 'running'").fetchall():
+            owner_host, _, pid = (row['owner'] or ':').rpartition(':')
+            if owner_host == host:
+                try:
+                    os.kill(int(pid), 0)
+                    continue
+                except (ValueError, ProcessLookupError):
+                    pass
+                except PermissionError:
+                    continue
+            elif row['claimed'] and time.time() - row['claimed'] < stale_after:
+                continue
+            released += self._transaction([
+                ("UPDATE genomes SET status = 'pending', owner = NULL, claimed = NULL, updated = ? "
+                 "WHERE genome = ? AND status = 'running' AND owner = ?", (time.time(), row['genome'], row['owner'])),
+                ("INSERT INTO transitions VALUES (?, ?, 'released', ?, ?)",
+                 (row['genome'], row['stage'], time.time(), row['owner']))])
+        return released
+
+    def retry(self, genomes=None):
+        """
+        queue failed stages again with a fresh attempt count
+
+        :return: <int> number of genomes queued
+        """
+        sql = "UPDATE genomes SET status = 'pending', attempts = 0, not_before = 0 WHERE status = 'failed'"
+        if genomes:
+            return self._transaction([(sql + " AND genome IN ({})".format(",".join("?" * len(genomes))),
+                                       list(genomes))])
+        return self._transaction([(sql, ())])
+
+    def counts(self):
+        """
+        :return: <list> of (stage, status, number of genomes) rows
+        """
+        return self.db.execute("SELECT stage, status, COUNT(*) FROM genomes GROUP BY stage, status").fetchall()
+
+
+def seed_queue(queue, genomes_dir, taxa=None):
+    """
+    queue the genomes of the metadata sheet at the fetch stage, and the genome directories that
+    already hold a FASTA file at the decompress stage
+
+    :param queue: WorkQueue
+    :param genomes_dir: <str> path to the genomes directory
+    :param taxa: <dict> tax id -> [species, bioproject accession, scientific name], None without metadata
+    :return: <int> number of genomes added
+    """
+    added = 0
+    with os.scandir(genomes_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_dir() and not entry.name.startswith('.') and find_genomes(entry.path):
+                added += queue.add(entry.name, 'decompress')
+    for tax_id in (taxa or {}):
+        added += queue.add(str(tax_id), 'fetch')
+    return added
+
+
+def genome_input(genome_dir):
+    """
+    :param genome_dir: <str> path to the genome directory
+    :return: <str> path to the genome FASTA file, None if there is none
+    """
+    input_files = find_genomes(genome_dir)
+    return input_files[0] if input_files else None
+
+
+def run_stage(stage, genome, input_file, settings):
+    """
+    run one per-genome stage
+
+    :return: <str> path to the genome FASTA file for the next stages
+    :raise RuntimeError: if the stage failed
+    """
+    genome_dir = os.path.join(settings['genomes_dir'], genome)
+    if stage == 'decompress':
+        input_file = genome_input(genome_dir)
+        if input_file is None:
+            raise RuntimeError("no FASTA file in {}".format(genome_dir))
+        if input_file.endswith('.gz'):
+            input_file = uncompress_fasta(input_file, suffix='.fna', threads=settings['threads'])
+            if input_file is None:
+                raise RuntimeError("could not decompress the FASTA file of {}".format(genome))
+        return input_file
+
+    if stage == 'gene-call':
+        if settings['seq_type'] != 'protein':
+            faa = predict_genes(input_file=input_file, seq_type=settings['seq_type'], out_dir=genome_dir,
+                                logfile=GenomeLogWriter(genome), cache_dir=settings['gene_cache'])
+            if faa is None:
+                raise RuntimeError("gene prediction failed")
+        return input_file
+
+    if stage == 'annotate':
+        dbcan_cazymes(input_file=input_file, seq_type=settings['seq_type'], tools=settings['tools'],
+                      db_dir=settings['db_dir'], out_dir=genome_dir, dbcan_args=settings['dbcan_args'],
+                      threads=settings['threads'], gene_cache=settings['gene_cache'])
+        key = cache_key(input_file=input_file, seq_type=settings['seq_type'],
+                        tools=" ".join(settings['tools'].split(',')), db_dir=settings['db_dir'],
+                        dbcan_args=settings['dbcan_args'], manifest=read_manifest(genome_dir))
+        if not is_fresh(genome_dir, key):
+            raise RuntimeError("CAZyme prediction did not complete")
+        return input_file
+
+    raise ValueError("{} is not a per-genome stage".format(stage))
+
+
+def run_genome(queue_file, genome, settings):
+    """
+    take a genome through the per-genome stages, checkpointing every transition
+
+    :param queue_file: <str> path to the work queue
+    :param genome: <str> genome id
+    :param settings: <dict> pipeline settings
+    :return: <str> stage the genome stopped at
+    """
+    queue = WorkQueue(queue_file)
+    try:
+        while True:
+            row = queue.get(genome)
+            stage = row['stage']
+            if stage not in GENOME_STAGES or row['status'] != 'pending' or not queue.claim(genome, stage):
+                return stage
+            try:
+                input_file = run_stage(stage, genome, row['input_file'], settings)
+            except Exception as error:
+                logging.error("{} failed at {}: {}".format(genome, stage, error))
+                queue.fail(genome, stage, error, max_attempts=settings['max_attempts'], backoff=settings['backoff'])
+                return stage
+            queue.advance(genome, stage, input_file=input_file)
+    finally:
+        queue.close()
+
+
+def fetch_stage(queue, rows, taxa, settings):
+    """
+    fetch the genomes waiting at the fetch stage, concurrently
+
+    :param queue: WorkQueue
+    :param rows: queue rows at the fetch stage
+    :param taxa: <dict> tax id -> [species, bioproject accession, scientific name]
+    :param settings: <dict> pipeline settings
+    :return:
+    """
+    from fetch_genomes_async import fetch_genomes
+
+    wanted = dict()
+    for row in rows:
+        genome = row['genome']
+        if not queue.claim(genome, 'fetch'):
+            continue
+        if genome_input(os.path.join(settings['genomes_dir'], genome)) is not None:
+            queue.advance(genome, 'fetch')
+        elif taxa is None or not genome.isdigit() or int(genome) not in taxa:
+            queue.fail(genome, 'fetch', "no metadata to fetch the genome from", max_attempts=1)
+        else:
+            wanted[int(genome)] = list(taxa[int(genome)])
+    if not wanted:
+        return
+
+    logging.info("fetching {} genomes".format(len(wanted)))
+    try:
+        fetched = asyncio.run(fetch_genomes(wanted, settings['genomes_dir'], concurrency=settings['fetch_jobs']))
+    except Exception as error:
+        fetched = {tax_id: False for tax_id in wanted}
+        logging.error("fetching genomes failed: {}".format(error))
+    for tax_id, ok in fetched.items():
+        if ok:
+            queue.advance(str(tax_id), 'fetch')
+        else:
+            queue.fail(str(tax_id), 'fetch', "download failed", max_attempts=settings['max_attempts'],
+                       backoff=settings['backoff'])
+
+
+def summarize_stage(queue, rows, settings):
+    """
+    add the annotated genomes to the aggregated CAZyme matrix, re-summarizing only new or changed genomes
+
+    :param queue: WorkQueue
+    :param rows: queue rows at the summarize stage
+    :param settings: <dict> pipeline settings
+    :return:
+    """
+    from utils import find_genome_files
+    from aggregate_store import STORE
+    from diamond_out_summary import count_matrix
+    from diamond_out_summary import write_matrix
+    from diamond_out_summary import update_genome_counts
+
+    genomes = [row['genome'] for row in rows if queue.claim(row['genome'], 'summarize')]
+    if not genomes:
+        return
+    summarized = set(genomes) | set(queue.at_stage('done'))
+    genome_files = [(genome, fn) for genome, fn in find_genome_files(settings['genomes_dir'], 'overview.txt')
+                    if genome in summarized]
+    logging.info("summarizing {} genomes".format(len(genomes)))
+    try:
+        genome_counts = update_genome_counts(genome_files, os.path.join(settings['summary_dir'], STORE),
+                                             summary_dir=settings['summary_dir'], jobs=settings['jobs'])
+        write_matrix(count_matrix(genome_counts),
+                     os.path.join(settings['summary_dir'], "dbcan_overview_aggregated_cazyids_summary.csv"))
+    except Exception as error:
+        logging.error("summary failed: {}".format(error))
+        for genome in genomes:
+            queue.fail(genome, 'summarize', error, max_attempts=settings['max_attempts'], backoff=settings['backoff'])
+        return
+    for genome in genomes:
+        queue.advance(genome, 'summarize')
+
+
+def drive(queue, settings, taxa=None, log_queue=None):
+    """
+    run the stages until every genome is done or failed
+
+    :param queue: WorkQueue
+    :param settings: <dict> pipeline settings
+    :param taxa: <dict> tax id -> [species, bioproject accession, scientific name]
+    :param log_queue: queue the log records of the workers are sent to
+    :return:
+    """
+    # the workers are forked once and reused by the retry rounds
+    with worker_pool(jobs=settings['jobs'], threads_per_job=settings['threads'], log_queue=log_queue) as executor:
+        while True:
+            rows = queue.runnable(['fetch'])
+            if rows:
+                fetch_stage(queue, rows, taxa, settings)
+
+            rows = queue.runnable(GENOME_STAGES)
+            if rows:
+                # start the largest genomes first so that they do not end up as stragglers
+                rows.sort(key=lambda row: -os.path.getsize(row['input_file'])
+                          if row['input_file'] and os.path.exists(row['input_file']) else 0)
+                tasks = [dict(queue_file=queue.queue_file, genome=row['genome'], settings=settings) for row in rows]
+                run_jobs(func=run_genome, tasks=tasks, jobs=settings['jobs'], threads_per_job=settings['threads'],
+                         label=lambda task: task['genome'], executor=executor)
+
+            # the cohort summary waits for every genome still moving through the earlier stages
+            if not queue.runnable(['fetch'] + GENOME_STAGES, now=float('inf')):
+                rows = queue.runnable(['summarize'])
+                if rows:
+                    summarize_stage(queue, rows, settings)
+
+            # the summary is held back while earlier stages are pending, so wait for their backoff delays
+            wakeup = queue.next_wakeup(['fetch'] + GENOME_STAGES)
+            if wakeup is None:
+                wakeup = queue.next_wakeup()
+            if wakeup is None:
+                return
+            if wakeup > time.time():
+                logging.info("waiting {:.0f} sec for the next retry".format(wakeup - time.time()))
+                time.sleep(wakeup - time.time())
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    parser.add_argument('command', choices=['run', 'status', 'retry'],
+                        help="run the pipeline, show the state of the genomes or queue the failed genomes again")
+    parser.add_argument('genomes', metavar='<genome>', nargs='*',
+                        help="genomes to queue again with retry, all failed genomes if none given")
+    parser.add_argument('-g', '--genomes-dir', metavar='<dir>', required=True,
+                        dest='genomes_dir',
+                        help="path to the genomes directory having the <taxid> directories")
+    parser.add_argument('-q', '--queue', metavar='<file>',
+                        dest='queue_file', default=None,
+                        help="path to the work queue. If not provided, the default is "
+                             "<genomes-dir>/{}/queue.sqlite".format(STATE_DIR))
+    parser.add_argument('-m', '--metadata', metavar='<file>',
+                        dest='metadata_file', default=None,
+                        help="taxa metadata sheet, its genomes are fetched when missing")
+    parser.add_argument('-s', '--seq-type', metavar='<str>',
+                        dest='seq_type', default='meta', choices=['protein', 'prok', 'meta'],
+                        help="Type of sequence input. protein=proteome; prok=prokaryote; meta=metagenome")
+    parser.add_argument('-db', '--database-dir', metavar='<dir>',
+                        dest='db_dir', default=None,
+                        help="path to the database directory")
+    parser.add_argument('-t', '--tools', metavar="<tool1,tool2,tool3>",
+                        dest="tools", default='all',
+                        help="Choose a combination of tools to run ['hmmer', 'diamond', 'hotpep', 'all']")
+    parser.add_argument('--dbcan-args', type=str, metavar='<str>',
+                        dest='dbcan_args', default='',
+                        help="extra arguments to be passed directly to the run_dbcan.py executable")
+    parser.add_argument('-o', '--summary-dir', metavar='<dir>',
+                        dest='summary_dir', default=None,
+                        help="path to the directory to write the summaries. If not provided, the default is "
+                             "<genomes-dir>/{}/summary".format(STATE_DIR))
+    parser.add_argument('--gene-cache', metavar='<dir>',
+                        dest='gene_cache', default=None,
+                        help="path to the cache of the prodigal gene predictions. If not provided, the default is "
+                             "<genomes-dir>/{}/gene_cache".format(STATE_DIR))
+    parser.add_argument('-j', '--jobs', type=int, metavar='<int>',
+                        dest='jobs', default=1,
+                        help="number of genomes processed concurrently, 0 to fill the CPU cores available")
+    parser.add_argument('--threads-per-job', type=int, metavar='<int>',
+                        dest='threads_per_job', default=None,
+                        help="number of threads given to each job")
+    parser.add_argument('--fetch-jobs', type=int, metavar='<int>',
+                        dest='fetch_jobs', default=8,
+                        help="number of concurrent genome downloads")
+    parser.add_argument('--max-attempts', type=int, metavar='<int>',
+                        dest='max_attempts', default=3,
+                        help="number of attempts of a stage before the genome is marked as failed")
+    parser.add_argument('--backoff', type=float, metavar='<sec>',
+                        dest='backoff', default=60,
+                        help="delay before the first retry of a failed stage, doubled at every attempt")
+    parser.add_argument('--stale-after', type=float, metavar='<sec>',
+                        dest='stale_after', default=24 * 3600,
+                        help="age after which a stage claimed on another host is handed out again")
+    parser.add_argument('--rescan', action='store_true',
+                        dest='rescan',
+                        help="look for new genomes in the genomes directory and the metadata sheet, "
+                             "done by default when the queue is empty")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    parser = parse_args()
+    args = parser.parse_args()
+
+    state_dir = os.path.join(args.genomes_dir, STATE_DIR)
+    queue_file = args.queue_file or os.path.join(mkdir(state_dir), 'queue.sqlite')
+    queue = WorkQueue(queue_file)
+
+    if args.command == 'status':
+        for stage, status, n in sorted(queue.counts(), key=lambda row: (STAGES.index(row[0]), row[1])):
+            print("{}\t{}\t{}".format(stage, status, n))
+        for row in queue.db.execute("SELECT * FROM genomes WHERE status = 'failed' ORDER BY genome"):
+            print("failed\t{}\t{}\t{}".format(row['genome'], row['stage'], row['error']), file=sys.stderr)
+        return
+    if args.command == 'retry':
+        print("{} genomes queued again".format(queue.retry(args.genomes)))
+        return
+    if args.db_dir is None:
+        parser.error("run needs the database directory")
+
+    log_queue, listener = start_logging(os.path.join(state_dir, 'logs'))
+    try:
+        taxa = None
+        if args.metadata_file is not None:
+            from metadata import TaxaIndex
+            taxa = TaxaIndex(args.metadata_file).to_dict()
+        if args.rescan or not queue.counts():
+            logging.info("{} genomes added to the queue".format(seed_queue(queue, args.genomes_dir, taxa)))
+        released = queue.reclaim(stale_after=args.stale_after)
+        if released:
+            logging.info("{} interrupted stages queued again".format(released))
+
+        jobs, threads = cpu_budget(jobs=args.jobs, threads_per_job=args.threads_per_job)
+        settings = dict(genomes_dir=os.path.abspath(args.genomes_dir), seq_type=args.seq_type, tools=args.tools,
+                        db_dir=os.path.abspath(args.db_dir), dbcan_args=args.dbcan_args,
+                        summary_dir=os.path.abspath(args.summary_dir or os.path.join(state_dir, 'summary')),
+                        gene_cache=os.path.abspath(args.gene_cache or os.path.join(state_dir, 'gene_cache')),
+                        jobs=jobs, threads=threads, fetch_jobs=args.fetch_jobs,
+                        max_attempts=args.max_attempts, backoff=args.backoff)
+        drive(queue, settings, taxa=taxa, log_queue=log_queue)
+        for stage, status, n in queue.counts():
+            logging.info("[{} {}] {} genomes".format(stage, status, n))
+    finally:
+        listener.stop()
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+performance profiles for the tools run_dbcan.py launches
+
+a profile sets the DIAMOND block size (-b) and number of index chunks (-c) and the
+threads of DIAMOND, HMMER and Hotpep. The threads are passed as the run_dbcan.py cpu
+options. run_dbcan.py has no option for -b and -c, so they are handed to the diamond
+wrapper of tool_metrics through the CAZYME_DIAMOND_ARGS environment variable, which
+appends them to the 'diamond blastp' calls; without the wrapper on the PATH DIAMOND runs
+with its defaults, and the profile record says so. No profile changes the sensitivity,
+so switching profiles changes neither the hits nor the result cache keys.
+"""
+import os
+import json
+import shutil
+
+DIAMOND_ARGS_ENV = 'CAZYME_DIAMOND_ARGS'
+
+# directory of the tool_metrics wrappers, set once they are first on the PATH
+SHIM_ENV = 'CAZYME_SHIM_DIR'
+
+PROFILE_FILE = 'profile.json'
+
+# DIAMOND block size (billions of letters) and index chunks, None keeps the DIAMOND default;
+# HMMER and Hotpep threads, capped at the threads of the job, None gives them all of them
+PROFILES = {
+    'default': dict(block_size=None, index_chunks=None, hmm_cpu=None, hotpep_cpu=None,
+                    description="DIAMOND defaults (-b 2 -c 4)"),
+    'small-query': dict(block_size=2.0, index_chunks=1, hmm_cpu=None, hotpep_cpu=None,
+                        description="single-genome queries: the reference seed array is built once per shape "
+                                    "instead of once per index chunk"),
+    'batch': dict(block_size=6.0, index_chunks=1, hmm_cpu=None, hotpep_cpu=None,
+                  description="pooled queries: fewer, larger query blocks against the reference"),
+    'low-memory': dict(block_size=0.5, index_chunks=4, hmm_cpu=None, hotpep_cpu=1,
+                       description="small blocks and four index chunks to bound the memory use, a single "
+                                   "Hotpep worker"),
+}
+
+DIAMOND_DEFAULTS = dict(block_size=2.0, index_chunks=4)
+
+# query size, in letters, from which the pooled-query profile is chosen
+BATCH_LETTERS = 100e6
+
+
+def diamond_memory_gb(block_size, index_chunks, letters):
+    """
+    rough DIAMOND memory estimate: about six times the block size in GB with four index chunks,
+    the seed index share of it growing as the chunks get fewer; a block never holds more letters
+    than the query or the reference
+
+    :param block_size: <float> block size in billions of letters, None for the default
+    :param index_chunks: <int> number of index chunks, None for the default
+    :param letters: <float> letters of the larger of the query and the reference
+    :return: <float> memory in GB
+    """
+    block_size = block_size or DIAMOND_DEFAULTS['block_size']
+    index_chunks = index_chunks or DIAMOND_DEFAULTS['index_chunks']
+    block = min(block_size, max(letters, 1) / 1e9)
+    return block * (3 + 12 / index_chunks)
+
+
+def query_letters(input_file, seq_type):
+    """
+    approximate number of amino acids of a query from its file size
+
+    :param input_file: <str> input file in FASTA format, plain or gzipped
+    :param seq_type: <str> sequence type of the input ['protein', 'prok', 'meta']
+    :return: <float> letters
+    """
+    letters = os.path.getsize(input_file) * (4 if input_file.endswith('.gz') else 1)
+    return letters if seq_type == 'protein' else letters / 3
+
+
+def profile_memory_gb(name, letters, db_letters, wrapper=True):
+    """
+    :param name: <str> profile name
+    :param letters: <float> query letters
+    :param db_letters: <float> reference letters
+    :param wrapper: <bool> the diamond wrapper applies the -b and -c of the profile, DIAMOND defaults otherwise
+    :return: <float> DIAMOND memory estimate of the profile in GB
+    """
+    profile = PROFILES[name] if wrapper else PROFILES['default']
+    return diamond_memory_gb(profile['block_size'], profile['index_chunks'], max(letters, db_letters))
+
+
+def select_profile(letters, db_letters, memory_gb, wrapper=True):
+    """
+    choose the fastest profile whose DIAMOND memory estimate fits the memory of the job
+
+    :param letters: <float> query letters
+    :param db_letters: <float> reference letters
+    :param memory_gb: <float> memory available to the job in GB
+    :param wrapper: <bool> the diamond wrapper applies the -b and -c of the profile
+    :return: <str> profile name
+    """
+    candidates = ['batch', 'small-query', 'default'] if letters >= BATCH_LETTERS else ['small-query', 'default']
+    for name in candidates:
+        if profile_memory_gb(name, letters, db_letters, wrapper) <= memory_gb:
+            return name
+    return 'low-memory'
+
+
+def database_letters(db_dir):
+    """
+    :param db_dir: <str> path to the database directory
+    :return: <float> approximate letters of the CAZy reference
+    """
+    cazy_db = os.path.join(db_dir, 'CAZy.dmnd')
+    return os.path.getsize(cazy_db) if os.path.exists(cazy_db) else 0
+
+
+def max_chunk_mb(db_dir, seq_type, memory_gb):
+    """
+    largest query, as a FASTA chunk size, whose DIAMOND memory estimate with the low-memory
+    profile fits the memory; the query only matters while it is larger than the reference
+    and smaller than a block
+
+    :param db_dir: <str> path to the database directory
+    :param seq_type: <str> sequence type of the query
+    :param memory_gb: <float> memory ceiling in GB
+    :return: <float> chunk size in MB, None if a query of any size fits, 0 if none fits
+    """
+    db_letters = database_letters(db_dir)
+    wrapper = diamond_wrapper()
+    if profile_memory_gb('low-memory', float('inf'), db_letters, wrapper) <= memory_gb:
+        return None
+    if profile_memory_gb('low-memory', 0, db_letters, wrapper) > memory_gb:
+        return 0
+    # below a block, the estimate grows linearly with the query letters
+    per_letter = profile_memory_gb('low-memory', 1e6, 0, wrapper) / 1e6
+    letters = memory_gb / per_letter
+    return letters * (1 if seq_type == 'protein' else 3) / (1024 * 1024)
+
+
+def diamond_wrapper():
+    """
+    :return: <bool> True if the diamond found on the PATH is the tool_metrics wrapper
+    """
+    exe = shutil.which('diamond')
+    return exe is not None and SHIM_ENV in os.environ and \
+        os.path.dirname(os.path.abspath(exe)) == os.path.abspath(os.environ[SHIM_ENV])
+
+
+def profile_threads(cap, threads):
+    """
+    :param cap: <int> threads of the profile, None for all the threads of the job
+    :param threads: <int> threads of the job, None if not set
+    :return: <int> threads given to the tool, None to keep the run_dbcan.py default
+    """
+    if cap is None:
+        return threads
+    return min(cap, threads) if threads else cap
+
+
+def resolve_profile(name, input_file, seq_type, db_dir, memory_gb, threads=None, max_memory_gb=None):
+    """
+    resolve a profile name, 'auto' included, for a query; the record holds the settings that are
+    actually applied, DIAMOND -b and -c only if the diamond wrapper is on the PATH
+
+    :param name: <str> profile name or 'auto'
+    :param input_file: <str> query file in FASTA format
+    :param seq_type: <str> sequence type of the query
+    :param db_dir: <str> path to the database directory
+    :param memory_gb: <float> memory available to the job in GB
+    :param threads: <int> threads of the job
+    :param max_memory_gb: <float> memory ceiling in GB: a profile whose estimate exceeds it is replaced by the
+                          fastest one that fits
+    :return: <dict> profile record
+    :raises ValueError: if no profile fits the memory ceiling
+    """
+    letters = query_letters(input_file, seq_type)
+    db_letters = database_letters(db_dir)
+    wrapper = diamond_wrapper()
+    if max_memory_gb is not None:
+        memory_gb = min(memory_gb, max_memory_gb)
+    chosen = select_profile(letters, db_letters, memory_gb, wrapper) if name == 'auto' else name
+    if max_memory_gb is not None and profile_memory_gb(chosen, letters, db_letters, wrapper) > memory_gb:
+        chosen = select_profile(letters, db_letters, memory_gb, wrapper)
+        if profile_memory_gb(chosen, letters, db_letters, wrapper) > memory_gb:
+            raise ValueError("no profile fits the DIAMOND estimate of {} ({:.1f} GB) into {} GB".format(
+                os.path.basename(input_file), profile_memory_gb(chosen, letters, db_letters, wrapper), memory_gb))
+    profile = PROFILES[chosen]
+
+    block_size, index_chunks = profile['block_size'], profile['index_chunks']
+    if not wrapper:
+        block_size, index_chunks = None, None
+    record = dict(profile=chosen, auto=name == 'auto', block_size=block_size, index_chunks=index_chunks,
+                  diamond_wrapper=wrapper, threads=threads, dia_cpu=threads,
+                  hmm_cpu=profile_threads(profile['hmm_cpu'], threads),
+                  hotpep_cpu=profile_threads(profile['hotpep_cpu'], threads),
+                  query_letters=int(letters), memory_gb=round(memory_gb, 1),
+                  diamond_memory_gb=round(diamond_memory_gb(block_size, index_chunks, max(letters, db_letters)), 1))
+    if chosen != name and name != 'auto':
+        record['requested'] = name
+    record['dbcan_args'] = dbcan_args(record)
+    record['diamond_args'] = diamond_args(record)
+    return record
+
+
+def dbcan_args(profile):
+    """
+    :param profile: <dict> profile record
+    :return: <str> run_dbcan.py thread options of the profile
+    """
+    args = []
+    for option in ('dia_cpu', 'hmm_cpu', 'hotpep_cpu'):
+        if profile[option] is not None:
+            args.append("--{} {}".format(option, profile[option]))
+    return " ".join(args)
+
+
+def diamond_args(profile):
+    """
+    :param profile: <dict> profile record
+    :return: <str> options appended to 'diamond blastp'
+    """
+    args = []
+    if profile['block_size'] is not None:
+        args.append("-b {}".format(profile['block_size']))
+    if profile['index_chunks'] is not None:
+        args.append("-c {}".format(profile['index_chunks']))
+    return " ".join(args)
+
+
+def profile_env(profile):
+    """
+    :param profile: <dict> profile record
+    :return: <dict> environment of the run_dbcan.py call
+    """
+    return {DIAMOND_ARGS_ENV: profile['diamond_args']}
+
+
+def write_profile(out_dir, profile):
+    """
+    record the profile an output directory was produced with
+
+    :param out_dir: <str> path to the output directory
+    :param profile: <dict> profile record
+    :return:
+    """
+    tmp = os.path.join(out_dir, PROFILE_FILE + '.tmp')
+    with open(tmp, 'w') as f_out:
+        json.dump(profile, f_out, indent=2)
+    os.replace(tmp, os.path.join(out_dir, PROFILE_FILE))
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+content-addressed cache of the CAZyme annotation results
+
+every genome output directory holds a manifest recording the hash of the input
+sequence, the fingerprint of each database file and the normalized tool arguments
+the outputs were produced with. An entry is fresh only if all of these still
+match and every recorded output is present with its recorded size.
+
+python3 result_cache.py list -d genomes_dir [-db path_to_db -s meta -t 'hmmer hotpep diamond' --hotpep-index]
+python3 result_cache.py evict -d genomes_dir [--stale -db path_to_db ...] [genome ...]
+"""
+
+# --- standard imports ---#
+import os
+import re
+import sys
+import json
+import shlex
+import argparse
+from datetime import datetime
+
+# --- project specific imports ---#
+from utils import sha256sum
+
+MANIFEST = 'cazyme_cache.json'
+
+TOOL_OUTPUTS = {'hmmer': 'hmmer.out', 'diamond': 'diamond.out', 'hotpep': 'Hotpep.out'}
+
+# run_dbcan.py options that change the resources used but never the results
+RESOURCE_ARGS = {'--dia_cpu', '--hmm_cpu', '--hotpep_cpu', '--tf_cpu', '--stp_cpu'}
+
+
+def normalize_tools(tools):
+    """
+    normalize the tools selection, e.g. 'hmmer hotpep diamond' and 'diamond,hmmer,hotpep' are the same
+
+    :param tools: <str> tools for cazyme annotation
+    :return: <list> sorted tool names
+    """
+    names = {t.lower() for t in re.split(r'[,\s]+', tools.strip()) if t}
+    if 'all' in names:
+        names = set(TOOL_OUTPUTS)
+    return sorted(names)
+
+
+def normalize_args(dbcan_args):
+    """
+    normalize the extra run_dbcan.py arguments, dropping the thread counts
+
+    :param dbcan_args: <str> extra arguments passed on to the executable
+    :return: <list> argument tokens
+    """
+    tokens = shlex.split(dbcan_args or '')
+    args = []
+    skip = False
+    for token in tokens:
+        if skip:
+            skip = False
+            continue
+        if token.split('=', 1)[0] in RESOURCE_ARGS:
+            skip = '=' not in token
+            continue
+        args.append(token)
+    return args
+
+
+def database_fingerprint(db_dir):
+    """
+    fingerprint every file in the database directory by name, size and modification time
+
+    :param db_dir: <str> path to the database directory
+    :return: <dict> file name -> [size, mtime_ns]
+    """
+    fingerprint = dict()
+    with os.scandir(db_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                st = entry.stat()
+                fingerprint[entry.name] = [st.st_size, st.st_mtime_ns]
+    return dict(sorted(fingerprint.items()))
+
+
+def expected_outputs(tools):
+    """
+    run_dbcan.py output files expected for the tools selection
+
+    :param tools: <str> tools for cazyme annotation
+    :return: <list> output file names
+    """
+    return [TOOL_OUTPUTS[t] for t in normalize_tools(tools) if t in TOOL_OUTPUTS] + ['overview.txt']
+
+
+def read_manifest(out_dir):
+    """
+    read the cache manifest of a genome output directory
+
+    :param out_dir: <str> path to the genome output directory
+    :return: <dict> manifest, None if there is no readable manifest
+    """
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return None
+
+
+def input_hash(input_file, manifest=None):
+    """
+    hash the input sequence, reusing the hash recorded in the manifest if the file size
+    and modification time are unchanged
+
+    :param input_file: <str> input file in FASTA format
+    :param manifest: <dict> previous manifest of the genome
+    :return: <dict> input record
+    """
+    st = os.stat(input_file)
+    record = dict(path=os.path.abspath(input_file), size=st.st_size, mtime_ns=st.st_mtime_ns)
+    previous = (manifest or {}).get('key', {}).get('input', {})
+    if all(previous.get(k) == v for k, v in record.items()) and 'sha256' in previous:
+        record['sha256'] = previous['sha256']
+    else:
+        record['sha256'] = sha256sum(input_file)
+    return record
+
+
+def cache_key(input_file, seq_type, tools, db_dir, dbcan_args="", manifest=None, db_fingerprint=None,
+              hotpep_index=False):
+    """
+    build the cache key of an annotation
+
+    :param input_file: <str> input file in FASTA format
+    :param seq_type: <str> sequence type of the input
+    :param tools: <str> tools for cazyme annotation
+    :param db_dir: <str> path to the database directory
+    :param dbcan_args: <str> extra arguments passed on to the executable
+    :param manifest: <dict> previous manifest of the genome, used to skip re-hashing unchanged inputs
+    :param db_fingerprint: <dict> precomputed database fingerprint
+    :param hotpep_index: <bool> Hotpep.out is written from the peptide index instead of by run_dbcan.py
+    :return: <dict> cache key
+    """
+    key = dict(input=input_hash(input_file, manifest=manifest),
+               seq_type=seq_type,
+               tools=normalize_tools(tools),
+               dbcan_args=normalize_args(dbcan_args),
+               database=db_fingerprint if db_fingerprint is not None else database_fingerprint(db_dir))
+    if hotpep_index and 'hotpep' in key['tools']:
+        key['hotpep'] = 'peptide_index'
+    return key
+
+
+def _comparable(key):
+    """
+    the parts of a cache key that decide freshness, the input is compared by content only
+    """
+    key = dict(key)
+    key['input'] = key['input']['sha256']
+    return key
+
+
+def is_fresh(out_dir, key, manifest=None):
+    """
+    check whether the cached outputs of a genome match the cache key and are complete
+
+    :param out_dir: <str> path to the genome output directory
+    :param key: <dict> cache key of the annotation
+    :param manifest: <dict> manifest of the genome, read from out_dir if not given
+    :return: <bool>
+    """
+    manifest = manifest if manifest is not None else read_manifest(out_dir)
+    if manifest is None or _comparable(manifest['key']) != _comparable(key):
+        return False
+    for fn, size in manifest['outputs'].items():
+        path = os.path.join(out_dir, fn)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+
+def write_manifest(out_dir, key):
+    """
+    record the cache key and the output sizes once an annotation completed
+
+    :param out_dir: <str> path to the genome output directory
+    :param key: <dict> cache key of the annotation
+    :return: <dict> manifest, None if an expected output is missing
+    """
+    outputs = dict()
+    for fn in expected_outputs(' '.join(key['tools'])):
+        path = os.path.join(out_dir, fn)
+        if not os.path.exists(path):
+            return None
+        outputs[fn] = os.path.getsize(path)
+
+    manifest = dict(key=key, outputs=outputs, created=datetime.now().isoformat(timespec='seconds'))
+    tmp = os.path.join(out_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f_out:
+        json.dump(manifest, f_out, indent=2)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST))
+    return manifest
+
+
+def evict(out_dir):
+    """
+    remove the cached outputs and the manifest of a genome
+
+    :param out_dir: <str> path to the genome output directory
+    :return: <list> removed file names
+    """
+    manifest = read_manifest(out_dir) or {}
+    removed = []
+    for fn in list(manifest.get('outputs', {})) + [MANIFEST]:
+        path = os.path.join(out_dir, fn)
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(fn)
+    return removed
+
+
+def list_entries(data_dir):
+    """
+    find the cache manifests under the data directory
+
+    :param data_dir: <str> path to the genomes directory
+    :return: <list> of (genome output directory, manifest) tuples
+    """
+    entries = []
+    for root, dirs, fnames in os.walk(data_dir):
+        dirs.sort()
+        if MANIFEST in fnames:
+            entries.append((root, read_manifest(root)))
+    return entries
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prefix_chars='-',
+        description=__doc__
+    )
+    parser.add_argument('command', choices=['list', 'evict'],
+                        help="list the cache entries or evict them")
+    parser.add_argument('genomes', nargs='*', metavar='<genome>',
+                        help="genome directory names to evict")
+    parser.add_argument('-d', '--dataDir', type=str, metavar='<dir>', required=True,
+                        dest='data_dir',
+                        help="path to the genomes directory")
+    parser.add_argument('-db', '--database-dir', metavar='<dir>',
+                        dest='db_dir',
+                        help="path to the database directory, needed to report or evict stale entries")
+    parser.add_argument('-s', '--seq-type', metavar='<str>', type=str,
+                        dest='seq_type', choices=['protein', 'prok', 'meta'],
+                        help="sequence type the entries are checked against")
+    parser.add_argument('-t', '--tools', metavar="<tool1,tool2,tool3>",
+                        dest="tools", default='all',
+                        help="tools the entries are checked against")
+    parser.add_argument('--dbcan-args', type=str, metavar='<str>',
+                        dest='dbcan_args', default='',
+                        help="extra run_dbcan.py arguments the entries are checked against")
+    parser.add_argument('--hotpep-index', action='store_true',
+                        dest='hotpep_index',
+                        help="the entries are checked against Hotpep outputs written from the peptide index, as "
+                             "annotate_cazymes.py --hotpep-index does")
+    parser.add_argument('--stale', action='store_true',
+                        dest='stale',
+                        help="evict only the entries that no longer match the inputs, database and arguments")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    parser = parse_args()
+    args = parser.parse_args()
+
+    check = args.db_dir is not None and args.seq_type is not None
+    if args.stale and not check:
+        parser.error("--stale requires --database-dir and --seq-type")
+    db_fingerprint = database_fingerprint(args.db_dir) if check else None
+
+    for out_dir, manifest in list_entries(args.data_dir):
+        genome = os.path.basename(out_dir)
+        status = '-'
+        if check and manifest is not None:
+            input_file = manifest['key']['input']['path']
+            if not os.path.exists(input_file):
+                status = 'stale'
+            else:
+                key = cache_key(input_file=input_file, seq_type=args.seq_type, tools=args.tools, db_dir=args.db_dir,
+                                dbcan_args=args.dbcan_args, manifest=manifest, db_fingerprint=db_fingerprint,
+                                hotpep_index=args.hotpep_index)
+                status = 'fresh' if is_fresh(out_dir, key, manifest=manifest) else 'stale'
+
+        if args.command == 'list':
+            created = manifest['created'] if manifest else 'unreadable'
+            print("{}\t{}\t{}\t{}".format(genome, created, status, out_dir))
+        elif (not args.genomes or genome in args.genomes) and (not args.stale or status == 'stale'):
+            removed = evict(out_dir)
+            print("evicted {}: {}".format(genome, ", ".join(removed)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+process-pool scheduler for running many per-genome annotations at once within
+the CPU budget available to this process
+"""
+import os
+import time
+import logging
+import importlib
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import available_cpu_cores
+from genome_logs import install_queue_handler
+
+
+def cpu_budget(jobs, threads_per_job):
+    """
+    split the CPU cores available to this process into per-job thread counts
+
+    :param jobs: <int> number of concurrent jobs, 0 to derive it from the available cores
+    :param threads_per_job: <int> number of threads per job, None to derive it from the available cores
+    :return: <tuple> (jobs, threads per job)
+    """
+    cores = available_cpu_cores()
+    if jobs <= 0 and not threads_per_job:
+        threads_per_job = min(4, cores)
+    if jobs <= 0:
+        jobs = max(1, cores // threads_per_job)
+    if not threads_per_job:
+        threads_per_job = max(1, cores // jobs)
+    if jobs * threads_per_job > cores:
+        logging.warning("{} jobs x {} threads exceeds the {} available CPU cores".format(jobs, threads_per_job, cores))
+    return jobs, threads_per_job
+
+
+def cpu_slices(jobs, threads_per_job):
+    """
+    partition the affinity mask of this process into one CPU set per job
+
+    :param jobs: <int> number of concurrent jobs
+    :param threads_per_job: <int> number of threads per job
+    :return: <list> of CPU sets, empty if the affinity mask cannot be determined or is too small
+    """
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return []
+    if len(cpus) < jobs * threads_per_job:
+        return []
+    return [set(cpus[i * threads_per_job:(i + 1) * threads_per_job]) for i in range(jobs)]
+
+
+def _init_worker(slots, log_queue):
+    """
+    pool initializer: send the log records to the parent and pin the worker process to the next free CPU set
+    """
+    if log_queue is not None:
+        install_queue_handler(log_queue)
+    if slots is None:
+        return
+    try:
+        os.sched_setaffinity(0, slots.get_nowait())
+    except Exception:
+        pass
+
+
+def _timed_call(func, kwargs):
+    """
+    run the function in a worker and return its result together with the wall time
+    """
+    start = time.time()
+    return func(**kwargs), time.time() - start
+
+
+@contextlib.contextmanager
+def worker_pool(jobs, threads_per_job, log_queue=None, preload=()):
+    """
+    process pool whose workers are forked up front and reused by every run_jobs call made with it;
+    the preloaded modules are imported once in this process and inherited by the workers, instead
+    of being imported again by each of them
+
+    :param jobs: <int> number of worker processes
+    :param threads_per_job: <int> number of threads per job, used to pin workers to CPU sets
+    :param log_queue: queue the workers send their log records to
+    :param preload: <list> names of the modules the tasks import, e.g. the pandas-backed ones
+    :return: ProcessPoolExecutor
+    """
+    for name in preload:
+        importlib.import_module(name)
+    slices = cpu_slices(jobs=jobs, threads_per_job=threads_per_job)
+    slots = multiprocessing.Queue()
+    for cpus in slices:
+        slots.put(cpus)
+
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker,
+                             initargs=(slots if slices else None, log_queue)) as executor:
+        # with the fork start method, the first submission starts every worker
+        executor.submit(os.getpid).result()
+        yield executor
+
+
+def run_jobs(func, tasks, jobs, threads_per_job, label=None, log_queue=None, executor=None, preload=()):
+    """
+    run func(**kwargs) for every task in a process pool, submitting the tasks in the
+    given order and logging the completion status as the tasks finish
+
+    :param func: picklable top-level function
+    :param tasks: <list> of keyword argument dicts, one per task
+    :param jobs: <int> number of concurrent jobs
+    :param threads_per_job: <int> number of threads per job, used to pin workers to CPU sets
+    :param label: function returning a display name for a task
+    :param log_queue: queue the workers send their log records to
+    :param executor: pool from worker_pool to run the tasks in, a pool is started for the call if not given
+    :param preload: <list> names of the modules the tasks import, preloaded in the pool started for the call
+    :return: <list> of (task, result) tuples in completion order, result is None if the task failed
+    """
+    if executor is None:
+        with worker_pool(jobs=jobs, threads_per_job=threads_per_job, log_queue=log_queue,
+                         preload=preload) as executor:
+            return run_jobs(func, tasks, jobs, threads_per_job, label=label, executor=executor)
+
+    label = label or (lambda task: str(task))
+    results = []
+    futures = {executor.submit(_timed_call, func, task): task for task in tasks}
+    for done, future in enumerate(as_completed(futures), start=1):
+        task = futures[future]
+        try:
+            result, elapsed = future.result()
+        except Exception as error:
+            logging.error("[{}/{}] failed {}: {}".format(done, len(tasks), label(task), error))
+            result = None
+        else:
+            logging.info("[{}/{}] completed {} in {:.1f} sec".format(done, len(tasks), label(task), elapsed))
+        results.append((task, result))
+    return results
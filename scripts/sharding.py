@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+split the genomes of a data directory into size-balanced shards, one per SLURM array task
+
+the shard plan is computed once per genome listing, longest processing time first over
+the genome file sizes, and saved in <outDir>/.shards under a fingerprint of the sorted
+genome paths, so that every array task of a run works from the same assignment and a
+run over a data directory that has grown plans again. Each task records a marker once
+its shard is done; the gather step checks the markers and the result manifests of every
+genome of the newest plan and prints the array indices to resubmit.
+
+python3 sharding.py script -n 16 -d genomes_dir -s meta -db db_dir > annotate_array.sh
+python3 sharding.py gather -d genomes_dir -n 16
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import glob
+import json
+import heapq
+import hashlib
+import socket
+import argparse
+from datetime import datetime
+
+# --- project specific imports ---#
+from utils import mkdir
+
+SHARD_DIR = '.shards'
+
+ARRAY_SCRIPT = """#!/usr/bin/env bash
+
+#SBATCH --partition {partition}
+#SBATCH --nodes=1
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --array=0-{last}%{concurrent}
+#SBATCH --output=annotate_%A_%a.txt
+#SBATCH --error=annotate_%A_%a.err
+#SBATCH --job-name=annotate_CAZymes
+
+# one shard of the genomes per array task, gather once all tasks ended:
+#   sbatch --dependency=afterany:<array job id> --wrap "python3 {scripts}/sharding.py gather -d {data_dir} -n {shards}"
+
+{setup}
+cd {scripts} || exit
+python3 annotate_cazymes.py \\
+  --dataDir {data_dir} \\
+  --seq-type {seq_type} \\
+  --database-dir {db_dir} \\
+  --tools '{tools}' \\
+  --jobs 0 \\
+  --shard ${{SLURM_ARRAY_TASK_ID}}/{shards}{extra}
+"""
+
+
+def parse_shard(spec):
+    """
+    parse a shard specification
+
+    :param spec: <str> 'i/N' with 0 <= i < N
+    :return: <tuple> (i, N)
+    """
+    try:
+        index, count = (int(v) for v in spec.split('/'))
+    except ValueError:
+        raise ValueError("shard must be given as i/N, got {!r}".format(spec))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("shard index {} is out of range for {} shards".format(index, count))
+    return index, count
+
+
+def shard_from_env(environ=None):
+    """
+    shard of the current SLURM array task
+
+    :param environ: environment, os.environ if not given
+    :return: <tuple> (i, N), None outside of an array job
+    """
+    environ = os.environ if environ is None else environ
+    if 'SLURM_ARRAY_TASK_ID' not in environ:
+        return None
+    task_min = int(environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    if 'SLURM_ARRAY_TASK_COUNT' in environ:
+        count = int(environ['SLURM_ARRAY_TASK_COUNT'])
+    else:
+        count = int(environ['SLURM_ARRAY_TASK_MAX']) - task_min + 1
+    return parse_shard("{}/{}".format(int(environ['SLURM_ARRAY_TASK_ID']) - task_min, count))
+
+
+def balance(input_files, count):
+    """
+    assign the files to shards, largest first to the shard with the smallest total size
+
+    :param input_files: <list> of paths to the genome files
+    :param count: <int> number of shards
+    :return: <list> of file lists, one per shard
+    """
+    sizes = {fn: os.path.getsize(fn) for fn in input_files}
+    shards = [[] for _ in range(count)]
+    heap = [(0, i) for i in range(count)]
+    for fn in sorted(input_files, key=lambda f: (-sizes[f], f)):
+        load, i = heapq.heappop(heap)
+        shards[i].append(fn)
+        heapq.heappush(heap, (load + sizes[fn], i))
+    return shards
+
+
+def plan_key(input_files):
+    """
+    fingerprint of a genome listing, independent of the listing order
+
+    :param input_files: <list> of paths to the genome files
+    :return: <str> hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    for fn in sorted(os.path.abspath(fn) for fn in input_files):
+        digest.update(fn.encode('utf-8') + b'\n')
+    return digest.hexdigest()[:16]
+
+
+def plan_file(out_dir, count, key):
+    return os.path.join(out_dir, SHARD_DIR, "plan-{}-{}.json".format(count, key))
+
+
+def marker_file(out_dir, index, count, key):
+    return os.path.join(out_dir, SHARD_DIR, "shard-{}-of-{}-{}.json".format(index, count, key))
+
+
+def latest_plan(out_dir, count):
+    """
+    :param out_dir: <str> path to the output directory
+    :param count: <int> number of shards
+    :return: <str> key of the most recently written plan of this many shards, None if there is none
+    """
+    plans = glob.glob(os.path.join(out_dir, SHARD_DIR, "plan-{}-*.json".format(count)))
+    if not plans:
+        return None
+    newest = max(plans, key=os.path.getmtime)
+    return os.path.basename(newest)[len("plan-{}-".format(count)):-len('.json')]
+
+
+def load_plan(out_dir, input_files, count):
+    """
+    read the shard plan of the genome listing, computing and saving it if this is the first task to run
+
+    :param out_dir: <str> path to the output directory
+    :param input_files: <list> of paths to the genome files
+    :param count: <int> number of shards
+    :return: <list> of file lists, one per shard
+    """
+    path = plan_file(out_dir, count, plan_key(input_files))
+    if not os.path.exists(path):
+        mkdir(os.path.dirname(path))
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'w') as f_out:
+            json.dump(balance(input_files, count), f_out, indent=1)
+        try:
+            # the first task to finish writing the plan wins, the others read it
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(path) as f_in:
+        return json.load(f_in)
+
+
+def select_shard(out_dir, input_files, index, count):
+    """
+    :param out_dir: <str> path to the output directory
+    :param input_files: <list> of paths to the genome files
+    :param index: <int> shard index
+    :param count: <int> number of shards
+    :return: <list> of paths to the genome files of the shard
+    """
+    shard = load_plan(out_dir, input_files, count)[index]
+    missing = [fn for fn in shard if not os.path.exists(fn)]
+    if missing:
+        print("{} genomes of shard {}/{} are gone: {}".format(len(missing), index, count, ", ".join(missing)),
+              file=sys.stderr)
+    return [fn for fn in shard if fn not in missing]
+
+
+def write_marker(out_dir, index, count, input_files, key):
+    """
+    record that a shard ran to completion
+
+    :param key: <str> key of the plan the shard belongs to, see plan_key
+    :return: <str> path to the marker
+    """
+    path = marker_file(out_dir, index, count, key)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f_out:
+        json.dump(dict(shard=index, shards=count, genomes=len(input_files), host=socket.gethostname(),
+                       job=os.environ.get('SLURM_ARRAY_JOB_ID'), finished=datetime.now().isoformat(timespec='seconds')),
+                  f_out, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+def gather(out_dir, count):
+    """
+    check that every shard of the newest plan ran to completion and every genome has a result manifest
+
+    :param out_dir: <str> path to the output directory
+    :param count: <int> number of shards
+    :return: <dict> shard index -> list of genome files lacking outputs, for the incomplete shards
+    """
+    from result_cache import read_manifest
+
+    key = latest_plan(out_dir, count)
+    if key is None:
+        raise FileNotFoundError("no {}-shard plan in {}".format(count, os.path.join(out_dir, SHARD_DIR)))
+    with open(plan_file(out_dir, count, key)) as f_in:
+        plan = json.load(f_in)
+    incomplete = dict()
+    for index, shard in enumerate(plan):
+        missing = [fn for fn in shard if read_manifest(os.path.dirname(fn)) is None]
+        if missing or not os.path.exists(marker_file(out_dir, index, count, key)):
+            incomplete[index] = missing
+    return incomplete
+
+
+def parse_args():
+    """command line options"""
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    script = subparsers.add_parser('script', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help="write the SLURM array job script annotating one shard per task")
+    script.add_argument('-n', '--shards', type=int, metavar='<int>', required=True,
+                        dest='shards',
+                        help="number of shards, one array task each")
+    script.add_argument('-d', '--dataDir', metavar='<dir>', required=True,
+                        dest='data_dir',
+                        help="path to the genomes directory")
+    script.add_argument('-s', '--seq-type', metavar='<str>', required=True,
+                        dest='seq_type', choices=['protein', 'prok', 'meta'],
+                        help="Type of sequence input. protein=proteome; prok=prokaryote; meta=metagenome")
+    script.add_argument('-db', '--database-dir', metavar='<dir>', required=True,
+                        dest='db_dir',
+                        help="path to the database directory")
+    script.add_argument('-t', '--tools', metavar='<str>',
+                        dest='tools', default='hmmer hotpep diamond',
+                        help="tools for cazyme annotation")
+    script.add_argument('--cpus', type=int, metavar='<int>',
+                        dest='cpus', default=4,
+                        help="CPUs per array task")
+    script.add_argument('--partition', metavar='<str>',
+                        dest='partition', default='batch',
+                        help="SLURM partition")
+    script.add_argument('--concurrent', type=int, metavar='<int>',
+                        dest='concurrent', default=32,
+                        help="maximum number of array tasks running at once")
+    script.add_argument('--setup', metavar='<str>',
+                        dest='setup',
+                        default="source ~/miniconda3/etc/profile.d/conda.sh\nconda activate run_dbcan",
+                        help="shell lines run before the annotation, e.g. to activate the environment")
+    script.add_argument('--extra', metavar='<str>',
+                        dest='extra', default='',
+                        help="extra annotate_cazymes.py options")
+
+    gather_parser = subparsers.add_parser('gather', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                          help="check that all shards completed")
+    gather_parser.add_argument('-d', '--outDir', metavar='<dir>', required=True,
+                               dest='out_dir',
+                               help="output directory given to annotate_cazymes.py (its dataDir by default)")
+    gather_parser.add_argument('-n', '--shards', type=int, metavar='<int>', required=True,
+                               dest='shards',
+                               help="number of shards")
+    return parser
+
+
+def main():
+    """
+
+    :return:
+    """
+    args = parse_args().parse_args()
+
+    if args.command == 'script':
+        extra = " \\\n  " + args.extra if args.extra else ""
+        sys.stdout.write(ARRAY_SCRIPT.format(partition=args.partition, cpus=args.cpus, last=args.shards - 1,
+                                             concurrent=args.concurrent, setup=args.setup,
+                                             scripts=os.path.dirname(os.path.abspath(__file__)),
+                                             data_dir=os.path.abspath(args.data_dir), seq_type=args.seq_type,
+                                             db_dir=os.path.abspath(args.db_dir), tools=args.tools,
+                                             shards=args.shards, extra=extra))
+        return
+
+    incomplete = gather(args.out_dir, args.shards)
+    if not incomplete:
+        print("all {} shards completed".format(args.shards))
+        return
+    for index, missing in sorted(incomplete.items()):
+        print("shard {}/{}: {} genomes without outputs{}".format(
+            index, args.shards, len(missing), "" if missing else ", no completion marker"))
+        for fn in missing:
+            print("\t{}".format(fn))
+    print("resubmit with --array={}".format(",".join(str(i) for i in sorted(incomplete))))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+streaming CAZyme annotation of metagenome-scale inputs: the input is split on record
+boundaries into bounded-size chunks, run_dbcan.py annotates one chunk at a time and the
+chunk outputs are appended to the usual per-sample files. Contigs are never split, so
+the prodigal gene identifiers (<contig>_<n>) are the same as for the whole input.
+"""
+import os
+import shutil
+import logging
+
+from utils import mkdir
+from utils import run_shell_command
+from fasta_chunks import stream_chunks
+from batch_annotation import OUTPUT_FILES
+from profiles import profile_env
+from profiles import resolve_profile
+
+CHUNK_DIR = '.chunks'
+
+# proteins run_dbcan.py calls from nucleotide input, merged with the tables
+PROTEIN_FILE = 'uniInput'
+
+
+def merge_outputs(chunk_dir, out_dir, partial):
+    """
+    append the outputs of a chunk to the merged files, writing the table headers once
+
+    :param chunk_dir: <str> directory having the run_dbcan.py outputs of the chunk
+    :param out_dir: <str> path to the genome output directory
+    :param partial: <dict> output file name -> open merged file, updated in place
+    :return:
+    """
+    for fn in OUTPUT_FILES + [PROTEIN_FILE]:
+        path = os.path.join(chunk_dir, fn)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f_in:
+            header = f_in.readline() if fn != PROTEIN_FILE else ''
+            if fn not in partial:
+                partial[fn] = open(os.path.join(out_dir, fn + '.partial'), 'w')
+                partial[fn].write(header)
+            shutil.copyfileobj(f_in, partial[fn])
+
+
+def annotate_chunks(dbcan, fasta, seq_type, tools, db_dir, out_dir, logfile, chunk_mb, dbcan_args="", threads=None,
+                    profile='default', memory_gb=None, max_memory=None):
+    """
+    annotate an input chunk by chunk, the next chunk being written while the current one is annotated
+
+    :param dbcan: <str> path to the run_dbcan.py executable
+    :param fasta: <str> input file in FASTA format, plain or gzipped
+    :param seq_type: <str> sequence type of the input, 'protein' or 'meta'
+    :param tools: <list> tools run by run_dbcan.py
+    :param db_dir: <str> path to the database directory
+    :param out_dir: <str> path to the genome output directory
+    :param logfile: file object to write the standard errors
+    :param chunk_mb: <float> chunk size in MB
+    :param dbcan_args: <str> extra arguments passed on to the executable
+    :param threads: <int> threads of the job, shared out by the profile to DIAMOND, HMMER and Hotpep
+    :param profile: <str> performance profile, 'auto' to choose it per chunk
+    :param memory_gb: <float> memory available to the job in GB
+    :param max_memory: <float> memory ceiling of DIAMOND in GB, each chunk's profile is fitted to it
+    :return: <dict> profile record of the largest chunk, None if a chunk failed
+    """
+    chunk_root = mkdir(os.path.join(out_dir, CHUNK_DIR))
+    partial = dict()
+    largest = None
+    chunks = 0
+    completed = False
+    try:
+        for index, chunk in stream_chunks(fasta, int(chunk_mb * 1024 * 1024), chunk_root):
+            chunk_dir = mkdir(os.path.join(chunk_root, "chunk-{:05d}".format(index)))
+            try:
+                settings = resolve_profile(profile, chunk, seq_type, db_dir, memory_gb, threads=threads,
+                                           max_memory_gb=max_memory)
+            except ValueError as error:
+                logging.error(str(error))
+                os.remove(chunk)
+                return None
+            cmd = "{} {} {} --tools {} --db_dir {} --out_dir {} {} {}".format(dbcan, chunk, seq_type, " ".join(tools),
+                                                                          db_dir, chunk_dir, settings['dbcan_args'],
+                                                                          dbcan_args)
+            logging.info("CAZyme prediction on chunk {} of {} ({} profile)".format(index, os.path.basename(fasta),
+                                                                                  settings['profile']))
+            tags = dict(genome=os.path.basename(out_dir), tool='run_dbcan', profile=settings['profile'], chunk=index)
+            ok = run_shell_command(cmd=cmd, logfile=logfile, raise_errors=False, extra_env=profile_env(settings),
+                                   tags=tags)
+            os.remove(chunk)
+            if not ok:
+                return None
+            merge_outputs(chunk_dir, out_dir, partial)
+            shutil.rmtree(chunk_dir)
+            chunks += 1
+            if largest is None or settings['query_letters'] > largest['query_letters']:
+                largest = settings
+        completed = True
+    finally:
+        for f_out in partial.values():
+            f_out.close()
+        if not completed:
+            for fn in partial:
+                os.remove(os.path.join(out_dir, fn + '.partial'))
+
+    for fn in partial:
+        os.replace(os.path.join(out_dir, fn + '.partial'), os.path.join(out_dir, fn))
+    shutil.rmtree(chunk_root, ignore_errors=True)
+    if largest is None:
+        logging.error("no sequences in {}".format(fasta))
+        return None
+    largest['chunks'] = chunks
+    return largest
@@ -1,11 +1,7 @@
 #!/usr/bin/env python3
 
-import os
-import pandas as pd
+from utils import find_genome_files
 
 
-for root, dirs, fnames in os.walk("/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/genomes"):
-    for fn in fnames:
-        if fn == 'diamond.out':
-            fn = os.path.join(root, fn)
-            print(os.path.split(os.path.dirname(fn))[1])
\ No newline at end of file
+for genome, fn in find_genome_files("/Users/jjuma/Work/Stanley_Onyango/cazyme_project_05102020/genomes", 'diamond.out', skip_empty=False):
+    print(genome)
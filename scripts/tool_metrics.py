@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+per-tool resource accounting for the tools run_dbcan.py launches internally
+
+run_dbcan.py starts DIAMOND, HMMER and prodigal itself, so their resource usage is
+only visible as part of the run_dbcan.py record. Instrumented wrappers placed first
+on the PATH run the real executables under wait4 accounting and append a record per
+invocation, tagged with the tool and the genome, to the CAZYME_METRICS_FILE. The diamond
+wrapper also appends the options of the performance profile to the 'diamond blastp' calls.
+
+python3 tool_metrics.py summary metrics.jsonl
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import json
+import shlex
+import shutil
+import argparse
+import collections
+
+# --- project specific imports ---#
+from utils import mkdir
+from utils import record_metrics
+from utils import run_instrumented
+from profiles import DIAMOND_ARGS_ENV
+from profiles import SHIM_ENV
+
+# executables wrapped and the tool name their records are tagged with
+TOOLS = {'diamond': 'DIAMOND', 'hmmscan': 'HMMER', 'hmmsearch': 'HMMER', 'prodigal': 'Prodigal'}
+
+SHIM = '''#!{python}
+import sys
+sys.path.insert(0, {scripts!r})
+import tool_metrics
+sys.exit(tool_metrics.shim_main({name!r}))
+'''
+
+
+def install_shims(bin_dir, names=None):
+    """
+    write the instrumented wrappers and put them first on the PATH of this process and its children
+
+    :param bin_dir: <str> directory for the wrappers
+    :param names: executables to wrap, all the TOOLS if None
+    :return: <str> path to the wrapper directory
+    """
+    bin_dir = mkdir(bin_dir)
+    scripts = os.path.dirname(os.path.abspath(__file__))
+    for name in names or TOOLS:
+        shim = os.path.join(bin_dir, name)
+        with open(shim, 'w') as f_out:
+            f_out.write(SHIM.format(python=sys.executable, scripts=scripts, name=name))
+        os.chmod(shim, 0o755)
+    os.environ[SHIM_ENV] = bin_dir
+    if os.environ['PATH'].split(os.pathsep)[0] != bin_dir:
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    return bin_dir
+
+
+def shim_main(name):
+    """
+    run the real executable in place of the wrapper and record its resource usage
+
+    :param name: <str> executable name
+    :return: <int> exit code of the executable
+    """
+    bin_dir = os.environ.get(SHIM_ENV, os.path.dirname(os.path.abspath(sys.argv[0])))
+    path = os.pathsep.join(p for p in os.environ['PATH'].split(os.pathsep)
+                           if os.path.abspath(p) != os.path.abspath(bin_dir))
+    exe = shutil.which(name, path=path)
+    if exe is None:
+        print("{}: command not found".format(name), file=sys.stderr)
+        return 127
+
+    args = sys.argv[1:]
+    if name == 'diamond' and args[:1] == ['blastp']:
+        args += shlex.split(os.environ.get(DIAMOND_ARGS_ENV, ''))
+    tags = dict(tool=TOOLS[name], genome=os.environ.get('CAZYME_GENOME'), cmd=" ".join([name] + args))
+    record = run_instrumented([exe] + args, stderr_sink=sys.stderr, tags=tags)
+    record_metrics(record)
+    return record['returncode'] if record['returncode'] >= 0 else 128 - record['returncode']
+
+
+def summarize(metrics_file):
+    """
+    sum the wall and CPU time of the records per tool, and the DIAMOND time per phase
+
+    :param metrics_file: <str> path to the JSON lines file
+    :return: <tuple> (per-tool totals, per-phase totals)
+    """
+    tools = collections.defaultdict(lambda: collections.Counter())
+    phases = collections.Counter()
+    with open(metrics_file) as f_in:
+        for line in f_in:
+            record = json.loads(line)
+            totals = tools[record.get('tool', '-')]
+            totals['runs'] += 1
+            totals['wall_seconds'] += record['wall_seconds']
+            totals['cpu_seconds'] += record['user_seconds'] + record['system_seconds']
+            totals['max_rss_kb'] = max(totals['max_rss_kb'], record['max_rss_kb'])
+            if record.get('tool') == 'DIAMOND':
+                for phase in record.get('diamond_phases', []):
+                    phases[phase['phase']] += phase['seconds']
+    return tools, phases
+
+
+def main():
+    """
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__)
+    parser.add_argument('command', choices=['summary'],
+                        help="summarize the resource records per tool and per DIAMOND phase")
+    parser.add_argument('metrics_file', metavar='<file>',
+                        help="JSON lines file written with annotate_cazymes.py --metrics")
+    args = parser.parse_args()
+
+    tools, phases = summarize(args.metrics_file)
+    print("tool\truns\twall_seconds\tcpu_seconds\tmax_rss_kb")
+    for tool, totals in sorted(tools.items(), key=lambda item: -item[1]['wall_seconds']):
+        print("{}\t{}\t{:.1f}\t{:.1f}\t{}".format(tool, totals['runs'], totals['wall_seconds'],
+                                                  totals['cpu_seconds'], totals['max_rss_kb']))
+    if phases:
+        print("\nDIAMOND phase\tseconds")
+        for phase, seconds in phases.most_common():
+            print("{}\t{:.1f}".format(phase, seconds))
+
+
+if __name__ == '__main__':
+    main()
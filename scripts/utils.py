@@ -2,10 +2,15 @@
 """
 utility functions
 """
+import io
+import gzip
 import argparse
+import hashlib
+import json
 import os
 import re
 import sys
+import time
 import errno
 import shutil
 import tempfile
@@ -91,14 +96,111 @@ def find_executable(names, default=None):
     return exe
 
 
-def run_shell_command(cmd, logfile, raise_errors=False, extra_env=None):
+# DIAMOND reports the time of each phase, e.g. "Masking reference...  [8.244s]"
+DIAMOND_PHASE = re.compile(r'^(?P<phase>[A-Z][^\[\]]*?)\.\.\.\s*\[(?P<seconds>[\d.]+)s\]\s*$')
+DIAMOND_BLOCK = re.compile(r'^Processing (?P<block>query block .*?)\.?\s*$')
+DIAMOND_TOTAL = re.compile(r'^Total time = (?P<seconds>[\d.]+)s\s*$')
+
+# environment variable naming the JSON lines file the resource records are appended to
+METRICS_ENV = 'CAZYME_METRICS_FILE'
+
+
+def parse_diamond_phases(lines):
+    """
+    parse the phase timings DIAMOND writes to the standard error
+
+    :param lines: iterable of standard error lines
+    :return: <list> of dicts with the phase, the query/reference block it belongs to and the seconds
+    """
+    phases = []
+    block = None
+    for line in lines:
+        line = line.strip()
+        match = DIAMOND_BLOCK.match(line)
+        if match:
+            block = match.group('block')
+            continue
+        match = DIAMOND_PHASE.match(line)
+        if match:
+            phases.append(dict(phase=match.group('phase'), block=block, seconds=float(match.group('seconds'))))
+            continue
+        match = DIAMOND_TOTAL.match(line)
+        if match:
+            phases.append(dict(phase='Total time', block=None, seconds=float(match.group('seconds'))))
+            block = None
+    return phases
+
+
+def record_metrics(record, metrics_file=None):
     """
-    run the given command string via Bash with error checking
+    append a resource record as one JSON line, small appends are atomic so concurrent
+    processes can share the file
+
+    :param record: <dict> resource record
+    :param metrics_file: path to the JSON lines file, defaults to the CAZYME_METRICS_FILE environment variable
+    :return:
+    """
+    metrics_file = metrics_file or os.environ.get(METRICS_ENV)
+    if not metrics_file:
+        return
+    line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+    fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def run_instrumented(args, stderr_sink, env=None, tags=None):
+    """
+    run a command, copying its standard error to the sink, and account for its wall time,
+    CPU time, peak memory and block I/O with wait4
+
+    :param args: <list> command and arguments
+    :param stderr_sink: file object the standard error is copied to, None to discard it
+    :param env: mapping of the subprocess environment
+    :param tags: <dict> extra fields of the resource record, e.g. genome and tool
+    :return: <dict> resource record
+    """
+    start = time.time()
+    p = subprocess.Popen(args, stderr=subprocess.PIPE, env=env, universal_newlines=True, errors='replace')
+    stderr_lines = []
+    for line in p.stderr:
+        if stderr_sink is not None:
+            stderr_sink.write(line)
+        if line.rstrip().endswith('s]') or line.startswith('Processing ') or line.startswith('Total time'):
+            stderr_lines.append(line)
+    p.stderr.close()
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if stderr_sink is not None:
+        stderr_sink.flush()
+
+    record = dict(tags or {})
+    record.update(start=datetime.fromtimestamp(start).isoformat(timespec='seconds'),
+                  returncode=p.returncode,
+                  wall_seconds=round(time.time() - start, 3),
+                  user_seconds=round(usage.ru_utime, 3),
+                  system_seconds=round(usage.ru_stime, 3),
+                  max_rss_kb=usage.ru_maxrss,
+                  block_input=usage.ru_inblock,
+                  block_output=usage.ru_oublock)
+    phases = parse_diamond_phases(stderr_lines)
+    if phases:
+        record['diamond_phases'] = phases
+    return record
+
+
+def run_shell_command(cmd, logfile, raise_errors=False, extra_env=None, tags=None):
+    """
+    run the given command string via Bash with error checking, recording its resource
+    usage as a JSON line when the CAZYME_METRICS_FILE environment variable is set
 
     :param cmd: command given to the bash shell for executing
     :param logfile: file object to write the standard errors
     :param raise_errors: bool to raise error if running command fails/succeeds
     :param extra_env: mapping that provides keys and values which are overlayed onto the default subprocess environment.
+    :param tags: <dict> fields identifying the run in the resource record, e.g. genome and tool
     :return:
     """
 
@@ -106,38 +208,39 @@ def run_shell_command(cmd, logfile, raise_errors=False, extra_env=None):
 
     if extra_env:
         env.update(extra_env)
+    if tags and 'genome' in tags:
+        # lets the instrumented tool wrappers tag their records with the genome
+        env['CAZYME_GENOME'] = str(tags['genome'])
 
     try:
-        p = subprocess.check_call("set -euo pipefail; " + cmd,
-                                  shell=True,
-                                  stderr=logfile,
-                                  universal_newlines=True,
-                                  executable="/bin/bash"
-                                  )
-    except (subprocess.CalledProcessError, OSError) as error:
-        # except subprocess.CalledProcessError as error:
-        rc = error.returncode
-        if rc == 127:
-            extra = "Are you sure this program is installed?"
-        else:
-            extra = " "
-        print("Error occurred: shell exited with return code: {}\ncommand running: {}\n{}".format(
-            error.returncode, cmd, extra), file=sys.stderr
+        record = run_instrumented(["/bin/bash", "-c", "set -euo pipefail; " + cmd], stderr_sink=logfile, env=env,
+                                  tags=tags)
+    except FileNotFoundError as error:
+        print("Unable to run shell command using {}! tool requires {} to be installed.".format(
+            error.filename, error.filename), file=sys.stderr
         )
         if raise_errors:
             raise
         else:
             return False
-    except FileNotFoundError as error:
-        print("Unable to run shell command using {}! tool requires {} to be installed.".format(
-            error.filename, error.filename), file=sys.stderr
+
+    record['cmd'] = cmd
+    record_metrics(record)
+
+    rc = record['returncode']
+    if rc != 0:
+        if rc == 127:
+            extra = "Are you sure this program is installed?"
+        else:
+            extra = " "
+        print("Error occurred: shell exited with return code: {}\ncommand running: {}\n{}".format(
+            rc, cmd, extra), file=sys.stderr
         )
         if raise_errors:
-            raise
+            raise subprocess.CalledProcessError(rc, cmd)
         else:
             return False
-    else:
-        return True
+    return True
 
 
 def mkdir(directory):
@@ -156,6 +259,63 @@ def mkdir(directory):
     return directory
 
 
+def find_genome_files(genomes_dir, filename, skip_empty=True):
+    """
+    find a per-genome file in the <genomes>/<taxid>/ layout, scanning only the
+    genome directories instead of walking the whole tree
+
+    :param genomes_dir: path to the genomes directory
+    :param filename: name of the per-genome file, e.g. overview.txt
+    :param skip_empty: bool to leave out empty files
+    :return: <list> of (genome id, absolute path) tuples sorted by genome id
+    """
+    found = []
+    with os.scandir(genomes_dir) as genomes:
+        for genome in genomes:
+            # hidden directories hold pooled or intermediate outputs, not genomes
+            if genome.name.startswith('.') or not genome.is_dir():
+                continue
+            path = os.path.join(genome.path, filename)
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+            if skip_empty and size == 0:
+                continue
+            found.append((genome.name, os.path.abspath(path)))
+    return sorted(found)
+
+
+def sha256sum(filename, blocksize=1 << 20):
+    """
+    compute the SHA-256 digest of a file, reading it in blocks
+
+    :param filename: path to the file
+    :param blocksize: <int> number of bytes read at a time
+    :return: <str> hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parquet_engine():
+    """
+    name of the importable Parquet engine of pandas
+
+    :return: <str> 'pyarrow' or 'fastparquet', None if neither is installed
+    """
+    for module in ('pyarrow', 'fastparquet'):
+        try:
+            __import__(module)
+            return module
+        except ImportError:
+            continue
+    return None
+
+
 def available_cpu_cores(fallback: int = 1) -> int:
     """
     Returns the number (an int) of CPU cores available to this **process**, if
@@ -180,29 +340,170 @@ def available_cpu_cores(fallback: int = 1) -> int:
         return os.cpu_count() or fallback
 
 
-def uncompress_fasta(filename, suffix=".fasta"):
+def available_memory_gb(fallback=4.0):
     """
+    memory available to this job in GB: the SLURM allocation if running under SLURM,
+    otherwise the memory the kernel reports as available
 
-    :param filename:
-    :param suffix:
-    :return:
+    :param fallback: <float> value returned if the memory cannot be determined
+    :return: <float> memory in GB
     """
+    if os.environ.get('SLURM_MEM_PER_NODE'):
+        return int(os.environ['SLURM_MEM_PER_NODE']) / 1024
+    if os.environ.get('SLURM_MEM_PER_CPU'):
+        cpus = int(os.environ.get('SLURM_CPUS_ON_NODE') or available_cpu_cores())
+        return int(os.environ['SLURM_MEM_PER_CPU']) * cpus / 1024
+    try:
+        with open('/proc/meminfo') as f_in:
+            for line in f_in:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    return fallback
+
+
+FASTA_SUFFIXES = ('.fna', '.fasta', '.fa', '.faa', '.ffn')
+
+# residue codes accepted in sequence lines, IUPAC nucleotides and amino acids plus stop and gap
+FASTA_RESIDUES = re.compile(r'^[A-Za-z*\-.]*$')
+
+
+@contextlib.contextmanager
+def open_fasta(filename, threads=1):
+    """
+    open a plain or gzipped FASTA file for reading text, gzipped files are decompressed in
+    chunks as they are read, with pigz in a separate process if more than one thread is given
+
+    :param filename: path to the FASTA file
+    :param threads: <int> number of decompression threads
+    :return: text file object
+    """
+    if not filename.endswith('.gz'):
+        with open(filename) as f_in:
+            yield f_in
+        return
+
+    pigz = shutil.which('pigz') if threads > 1 else None
+    if pigz is None:
+        with gzip.open(filename, 'rt') as f_in:
+            yield f_in
+        return
+
+    p = subprocess.Popen([pigz, '-dc', '-p', str(threads), filename], stdout=subprocess.PIPE)
+    try:
+        with io.TextIOWrapper(p.stdout) as f_in:
+            yield f_in
+    finally:
+        p.stdout.close()
+        if p.wait() not in (0, -13):
+            raise subprocess.CalledProcessError(p.returncode, [pigz, '-dc', filename])
 
-    match = re.findall(r"(\w+.)", os.path.basename(filename))
-    if match[-1] == 'gz':
-        out = os.path.splitext(filename)[0]
-        ext = os.path.splitext(out)[1]
-        outfile = os.path.join(os.path.dirname(filename), ''.join(match[:-1]).strip(ext)) + suffix
 
-        if Path(out).is_file():
-            print(f"decompression done, check file: {out}")
+def normalize_fasta(lines, filename=''):
+    """
+    validate and normalize FASTA lines as they stream past: line endings and surrounding
+    whitespace are stripped, blank lines dropped, headers collapsed to single spaces and
+    sequences upper-cased
+
+    :param lines: iterable of text lines
+    :param filename: name of the file used in the error messages
+    :return: generator of normalized lines without line endings
+    """
+    seen_header = False
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('>'):
+            header = ' '.join(line[1:].split())
+            if not header:
+                raise ValueError("{}:{}: empty FASTA header".format(filename, number))
+            seen_header = True
+            yield '>' + header
         else:
-            cmd = 'gunzip {}'.format(filename)
-            try:
-                print(f"decompressing file {filename}")
-                p = subprocess.check_call(cmd, shell=True)
-                # if p == 0:
-                #     os.remove(os.path.abspath(filename))
-            except Exception as error:
-                print(f"Error: {error}")
+            if not seen_header:
+                raise ValueError("{}:{}: sequence before the first FASTA header".format(filename, number))
+            if not FASTA_RESIDUES.match(line):
+                raise ValueError("{}:{}: invalid characters in FASTA sequence".format(filename, number))
+            yield line.upper()
+
+
+def read_fasta(filename, threads=1):
+    """
+    stream the records of a plain or gzipped FASTA file without writing a decompressed copy
+
+    :param filename: path to the FASTA file
+    :param threads: <int> number of decompression threads
+    :return: generator of (header, sequence) tuples
+    """
+    with open_fasta(filename, threads=threads) as f_in:
+        header, seq = None, []
+        for line in normalize_fasta(f_in, filename=filename):
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(seq)
+                header, seq = line[1:], []
+            else:
+                seq.append(line)
+        if header is not None:
+            yield header, ''.join(seq)
+
+
+def fasta_stem(filename):
+    """
+    strip the compression and FASTA extensions from a file name, e.g. x_genomic.fna.gz -> x_genomic
+
+    :param filename: path to the FASTA file
+    :return: <str> path without the extensions
+    """
+    stem = filename[:-3] if filename.endswith('.gz') else filename
+    root, ext = os.path.splitext(stem)
+    return root if ext in FASTA_SUFFIXES else stem
+
+
+def uncompress_fasta(filename, suffix=".fasta", threads=1, keep_compressed=False):
+    """
+    decompress a gzipped FASTA file in process, validating and normalizing the records as
+    they stream past and writing their .fai offset index alongside
+
+    :param filename: path to the gzipped FASTA file
+    :param suffix: extension of the decompressed file
+    :param threads: <int> number of decompression threads
+    :param keep_compressed: bool to keep the gzipped file once decompressed
+    :return: path to the decompressed file, None if the file is not gzipped or decompression failed
+    """
+    if not filename.endswith('.gz'):
+        return None
+
+    outfile = fasta_stem(filename) + suffix
+    if Path(outfile).is_file():
+        print(f"decompression done, check file: {outfile}")
         return outfile
+
+    from fasta_index import FaiBuilder
+
+    print(f"decompressing file {filename}")
+    tmp = outfile + '.part'
+    builder = FaiBuilder(outfile)
+    try:
+        with open_fasta(filename, threads=threads) as f_in, open(tmp, 'w') as f_out:
+            for line in normalize_fasta(f_in, filename=filename):
+                f_out.write(line + '\n')
+                if builder is not None:
+                    try:
+                        builder.add(line)
+                    except ValueError:
+                        # irregular line lengths, the file is read sequentially
+                        builder = None
+    except (OSError, EOFError, ValueError, subprocess.CalledProcessError) as error:
+        print(f"Error: {error}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+    os.replace(tmp, outfile)
+    if builder is not None:
+        builder.write(outfile + '.fai')
+    if not keep_compressed:
+        os.remove(filename)
+    return outfile
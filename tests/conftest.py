@@ -0,0 +1,9 @@
+"""
+the scripts are run from their directory and import each other by module name
+"""
+
+# --- standard imports ---#
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
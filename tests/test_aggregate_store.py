@@ -0,0 +1,87 @@
+"""
+incremental summaries against a full recount
+"""
+
+# --- standard imports ---#
+import os
+import shutil
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+import consensus
+import diamond_out_summary
+from aggregate_store import STORE, load_store
+from diamond_out_summary import count_genomes, update_genome_counts
+from utils import find_genome_files
+
+GENES = ["contig_{}_{}".format(i // 50 + 1, i % 50 + 1) for i in range(200)]
+
+
+@pytest.fixture
+def genomes(tmp_path, monkeypatch):
+    genomes_dir = bench.make_genomes(str(tmp_path), 5, len(GENES))
+    for taxid in sorted(os.listdir(genomes_dir)):
+        bench.write_dbcan_outputs(os.path.join(genomes_dir, taxid), GENES, seed=int(taxid), hit_rate=0.2)
+
+    # record the overview files that are parsed
+    parsed = []
+    count_genome = diamond_out_summary.count_genome
+
+    def counting(overview_file, *args):
+        parsed.append(os.path.basename(os.path.dirname(overview_file)))
+        return count_genome(overview_file, *args)
+    monkeypatch.setattr(diamond_out_summary, 'count_genome', counting)
+    return genomes_dir, parsed
+
+
+def full_recount(genomes_dir, summary_dir):
+    counts = count_genomes([fn for genome, fn in find_genome_files(genomes_dir, 'overview.txt')],
+                           summary_dir=summary_dir)
+    return [(genome, [str(f) for f in families], [int(c) for c in values]) for genome, families, values in counts]
+
+
+def test_only_changed_genomes_are_parsed(genomes, tmp_path):
+    genomes_dir, parsed = genomes
+    summary_dir = str(tmp_path / 'summary')
+    store_file = os.path.join(summary_dir, STORE)
+    taxids = sorted(os.listdir(genomes_dir))
+
+    def update():
+        del parsed[:]
+        return update_genome_counts(find_genome_files(genomes_dir, 'overview.txt'), store_file,
+                                    summary_dir=summary_dir)
+
+    counts = update()
+    assert sorted(parsed) == taxids
+    assert update() == counts
+    assert parsed == []
+    assert counts == full_recount(genomes_dir, str(tmp_path / 'full'))
+
+    # a touched but identical file is hashed, not parsed
+    os.utime(os.path.join(genomes_dir, taxids[0], 'overview.txt'), ns=(0, 0))
+    # a modified genome is parsed again, a removed one is dropped with its summary
+    bench.write_dbcan_outputs(os.path.join(genomes_dir, taxids[1]), GENES, seed=1, hit_rate=0.3)
+    shutil.rmtree(os.path.join(genomes_dir, taxids[2]))
+    counts = update()
+    assert parsed == [taxids[1]]
+    assert counts == full_recount(genomes_dir, str(tmp_path / 'full'))
+    assert sorted(load_store(store_file, dict(hits_dir=None, hits_format='parquet'))) == \
+        [taxids[0], taxids[1], taxids[3], taxids[4]]
+    assert not os.path.exists(os.path.join(summary_dir, "{}_overview_geneids_cazyids_summary.csv".format(taxids[2])))
+
+
+def test_other_settings_recount_every_genome(genomes, tmp_path):
+    genomes_dir, parsed = genomes
+    summary_dir = str(tmp_path / 'summary')
+    store_file = os.path.join(summary_dir, STORE)
+    genome_files = find_genome_files(genomes_dir, 'overview.txt')
+    update_genome_counts(genome_files, store_file, summary_dir=summary_dir)
+    del parsed[:]
+    update_genome_counts(genome_files, store_file, summary_dir=summary_dir, rule=consensus.DEFAULT_RULE)
+    assert len(parsed) == len(genome_files)
+    del parsed[:]
+    update_genome_counts(genome_files, store_file, summary_dir=summary_dir, rule=consensus.DEFAULT_RULE)
+    assert parsed == []
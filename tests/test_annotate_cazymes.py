@@ -0,0 +1,123 @@
+"""
+annotate_cazymes.py end to end with an offline run_dbcan.py and a recording diamond, and its scratch copies
+"""
+
+# --- standard imports ---#
+import os
+import gzip
+import sys
+import json
+import subprocess
+
+# --- third party imports ---#
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+# records its command line, standing in for DIAMOND
+DIAMOND = '''#!{python}
+import sys
+with open({log!r}, 'a') as f_out:
+    f_out.write(' '.join(sys.argv[1:]) + '\\n')
+'''
+
+# calls diamond the way run_dbcan.py does, then writes synthetic outputs
+RUN_DBCAN = '''#!{python}
+import sys, subprocess
+sys.path.insert(0, {scripts!r})
+import benchmark_pipeline as bench
+args = sys.argv[1:]
+out_dir = args[args.index('--out_dir') + 1]
+subprocess.check_call(['diamond', 'blastp', '-d', 'CAZy.dmnd', '-q', args[0], '--threads', '2'])
+genes = [line[1:].split()[0] for line in open(args[0]) if line.startswith('>')]
+bench.write_dbcan_outputs(out_dir, genes)
+'''
+
+
+@pytest.fixture
+def run(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'diamond.log'
+    for name, template in (('diamond', DIAMOND), ('run_dbcan.py', RUN_DBCAN)):
+        (bin_dir / name).write_text(template.format(python=sys.executable, log=str(log), scripts=SCRIPTS))
+        (bin_dir / name).chmod(0o755)
+
+    genome_dir = tmp_path / 'data' / '100001'
+    genome_dir.mkdir(parents=True)
+    (genome_dir / '100001.fasta').write_text(">contig_1_1\nMKTAYIAKQRQISFVKSHFSRQ\n>contig_1_2\nMSTNPKPQRKTKRNTNRRPQDVKFPGG\n")
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+
+    def annotate(*options, db_gb=1.0):
+        # a sparse reference of db_gb billion letters drives the DIAMOND memory estimate
+        with open(str(db_dir / 'CAZy.dmnd'), 'wb') as f_out:
+            f_out.truncate(int(db_gb * 1e9))
+        env = dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ['PATH'])
+        subprocess.check_call([sys.executable, os.path.join(SCRIPTS, 'annotate_cazymes.py'), '-d',
+                               str(tmp_path / 'data'), '-s', 'protein', '-db', str(db_dir), '-t', 'diamond'] +
+                              list(options), env=env, cwd=str(tmp_path))
+        with open(str(genome_dir / 'profile.json')) as f_in:
+            profile = json.load(f_in)
+        return log.read_text().splitlines(), profile
+    return annotate
+
+
+def test_max_memory_applies_the_low_memory_profile(run):
+    # DIAMOND defaults need about 6 GB against a billion letters, the low-memory profile about 3
+    calls, profile = run('--max-memory', '4')
+    assert profile['profile'] == 'low-memory' and profile['diamond_wrapper']
+    assert len(calls) == 1
+    assert calls[0].endswith('-b 0.5 -c 4')
+
+
+def test_max_memory_keeps_diamond_defaults_when_they_fit(run):
+    calls, profile = run('--max-memory', '64', db_gb=0.1)
+    assert profile['profile'] == 'default'
+    assert len(calls) == 1
+    assert ' -b ' not in calls[0] and ' -c ' not in calls[0]
+
+
+def test_profile_options_reach_diamond(run):
+    calls, profile = run('--profile', 'small-query', db_gb=0.1)
+    assert calls[0].endswith('-b 2.0 -c 1')
+
+
+@pytest.fixture
+def gzipped_genome(tmp_path, monkeypatch):
+    import annotate_cazymes
+    monkeypatch.setattr(annotate_cazymes, 'find_executable', lambda names, default=None: names[0])
+    out_dir = tmp_path / '100001'
+    out_dir.mkdir()
+    fasta = tmp_path / '100001.fasta.gz'
+    with gzip.open(str(fasta), 'wt') as f_out:
+        f_out.write(">contig_1_1\nMKTAYIAKQRQISFVKSHFSRQ\n")
+    (tmp_path / 'db').mkdir()
+    return annotate_cazymes, str(fasta), str(tmp_path / 'db'), out_dir
+
+
+def test_scratch_copy_removed_when_run_dbcan_fails(gzipped_genome, monkeypatch):
+    annotate_cazymes, fasta, db_dir, out_dir = gzipped_genome
+
+    def fail(cmd, **kwargs):
+        assert os.path.exists(cmd.split()[1])
+        raise RuntimeError('run_dbcan.py killed')
+    monkeypatch.setattr(annotate_cazymes, 'run_shell_command', fail)
+    with pytest.raises(RuntimeError):
+        annotate_cazymes.dbcan_cazymes(fasta, 'protein', 'diamond', db_dir, str(out_dir))
+    assert sorted(os.listdir(str(out_dir))) == []
+
+
+def test_scratch_copy_removed_when_the_genome_is_skipped(gzipped_genome):
+    annotate_cazymes, fasta, db_dir, out_dir = gzipped_genome
+    annotate_cazymes.dbcan_cazymes(fasta, 'prok', 'hotpep', db_dir, str(out_dir), hotpep_index=True)
+    assert sorted(os.listdir(str(out_dir))) == []
+
+
+def test_array_tasks_annotate_every_genome_unless_sharded(run, monkeypatch, tmp_path):
+    # task 1 of 2 would get no genome of a single genome listing
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '1')
+    monkeypatch.setenv('SLURM_ARRAY_TASK_COUNT', '2')
+    calls, profile = run(db_gb=0.1)
+    assert len(calls) == 1
+    assert not (tmp_path / 'data' / '.shards').exists()
@@ -0,0 +1,117 @@
+"""
+pooled run_dbcan.py outputs split back per genome
+"""
+
+# --- standard imports ---#
+import os
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+from batch_annotation import OUTPUT_FILES, TAG_SEP, annotate_batch, pool_proteins, pool_unique_proteins, split_outputs
+from utils import read_fasta
+
+
+def read_table(path):
+    with open(path) as f_in:
+        header = f_in.readline().rstrip('\n').split('\t')
+        return header, [line.rstrip('\n').split('\t') for line in f_in]
+
+
+def genome_proteins(tmp_path, n_genomes=4, n_genes=120):
+    genomes_dir = bench.make_genomes(str(tmp_path), n_genomes, n_genes)
+    proteins = []
+    for taxid in sorted(os.listdir(genomes_dir)):
+        out_dir = tmp_path / 'out' / taxid
+        out_dir.mkdir(parents=True)
+        proteins.append((os.path.join(genomes_dir, taxid, taxid + '.faa'), str(out_dir)))
+    return proteins
+
+
+def expected_rows(proteins, batch_dir, gene_of):
+    """
+    rows of each pooled output expected in each genome, keyed by (output, genome directory)
+
+    :param gene_of: function mapping a pooled gene id to its (genome directory, gene id) pairs
+    """
+    expected = dict()
+    for fn in OUTPUT_FILES:
+        for faa, out_dir in proteins:
+            expected[fn, out_dir] = []
+        header, rows = read_table(os.path.join(batch_dir, fn))
+        gene_col = header.index('Gene ID')
+        for fields in rows:
+            for out_dir, gene in gene_of(fields[gene_col]):
+                expected[fn, out_dir].append(fields[:gene_col] + [gene] + fields[gene_col + 1:])
+    return expected
+
+
+def test_split_tagged_outputs(tmp_path):
+    proteins = genome_proteins(tmp_path)
+    batch_dir = tmp_path / 'batch'
+    batch_dir.mkdir()
+    pooled = str(batch_dir / 'pooled.faa')
+    tags = pool_proteins(proteins, pooled)
+    bench.write_dbcan_outputs(str(batch_dir), [h for h, s in read_fasta(pooled)], hit_rate=0.3)
+
+    split_outputs(str(batch_dir), tags)
+
+    def gene_of(pooled_gene):
+        tag, gene = pooled_gene.split(TAG_SEP, 1)
+        return [(tags[tag], gene)]
+    expected = expected_rows(proteins, str(batch_dir), gene_of)
+    for (fn, out_dir), rows in expected.items():
+        assert read_table(os.path.join(out_dir, fn))[1] == rows
+
+
+def test_split_deduplicated_outputs(tmp_path):
+    proteins = genome_proteins(tmp_path)
+    batch_dir = tmp_path / 'batch'
+    batch_dir.mkdir()
+    pooled = str(batch_dir / 'pooled.faa')
+    tags, members = pool_unique_proteins(proteins, pooled)
+
+    # the synthetic genomes draw their proteins from a small pool, many genes share a sequence
+    unique = [h for h, s in read_fasta(pooled)]
+    assert len(unique) == len(members) < sum(len(m) for m in members)
+    sequences = {h: s for h, s in read_fasta(pooled)}
+    for faa, out_dir in proteins:
+        tag = next(t for t, d in tags.items() if d == out_dir)
+        genes = {h.split()[0]: s for h, s in read_fasta(faa)}
+        for u, carriers in enumerate(members):
+            for carrier_tag, gene in carriers:
+                if carrier_tag == tag:
+                    assert genes[gene] == sequences["u{}".format(u)]
+
+    bench.write_dbcan_outputs(str(batch_dir), unique, hit_rate=0.3)
+    split_outputs(str(batch_dir), tags, members=members)
+
+    def gene_of(pooled_gene):
+        return [(tags[tag], gene) for tag, gene in members[int(pooled_gene[1:])]]
+    expected = expected_rows(proteins, str(batch_dir), gene_of)
+    assert any(expected.values())
+    for (fn, out_dir), rows in expected.items():
+        header, split = read_table(os.path.join(out_dir, fn))
+        assert header == read_table(os.path.join(str(batch_dir), fn))[0]
+        assert split == rows
+
+
+def test_missing_outputs_are_skipped(tmp_path):
+    proteins = genome_proteins(tmp_path, n_genomes=2, n_genes=10)
+    batch_dir = tmp_path / 'batch'
+    batch_dir.mkdir()
+    tags = pool_proteins(proteins, str(batch_dir / 'pooled.faa'))
+    split_outputs(str(batch_dir), tags)
+    assert all(os.listdir(out_dir) == [] for faa, out_dir in proteins)
+
+
+def test_genomes_sharing_a_directory_are_rejected(tmp_path):
+    genome_dir = tmp_path / '100001'
+    genome_dir.mkdir()
+    input_files = [str(genome_dir / fn) for fn in ('100001.fasta', '100001_plasmid.fasta')]
+    with pytest.raises(ValueError) as error:
+        annotate_batch(input_files, 'protein', 'all', str(tmp_path / 'db'), str(tmp_path / 'batch'), None)
+    assert str(genome_dir) in str(error.value)
+    assert not os.path.exists(str(tmp_path / 'batch'))
@@ -0,0 +1,72 @@
+"""
+agreement rules and overview.txt of the tool outputs
+"""
+
+# --- standard imports ---#
+import os
+
+# --- project specific imports ---#
+from consensus import DEFAULT_RULE, Rule, apply_rule, family_counts, read_tool_calls, write_overview
+
+HMMER = [('g1', 'GH5_2.hmm', '1', '100'), ('g3', 'GH13.hmm', '5', '300'), ('g1', 'CBM1.hmm', '120', '160')]
+HOTPEP = [('g1', 'GH5', '3'), ('g2', 'GT2', '11'), ('g4', 'CE1', '2')]
+DIAMOND = [('g1', 'AAA1.1|GH5_2|CBM1|'), ('g2', 'BBB2.1|GT2'), ('g3', 'CCC3.1|GH13_5|')]
+
+
+def write_outputs(genome_dir):
+    with open(os.path.join(genome_dir, 'hmmer.out'), 'w') as f_out:
+        f_out.write("HMM Profile\tGene ID\tGene Start\tGene End\n")
+        f_out.writelines("{1}\t{0}\t{2}\t{3}\n".format(*row) for row in HMMER)
+    with open(os.path.join(genome_dir, 'Hotpep.out'), 'w') as f_out:
+        f_out.write("CAZy Family\tPPR Subfamily\tGene ID\n")
+        f_out.writelines("{1}\t{2}\t{0}\n".format(*row) for row in HOTPEP)
+    with open(os.path.join(genome_dir, 'diamond.out'), 'w') as f_out:
+        f_out.write("Gene ID\tCAZy ID\n")
+        f_out.writelines("{}\t{}\n".format(*row) for row in DIAMOND)
+
+
+def hits_of(calls, rule):
+    hits = apply_rule(calls, rule=rule)
+    return sorted(zip(hits['Gene ID'], hits['CAZy ID'], hits['#ofTools']))
+
+
+def test_rules(tmp_path):
+    write_outputs(str(tmp_path))
+    calls = read_tool_calls(str(tmp_path))
+    assert hits_of(calls, DEFAULT_RULE) == [('g1', 'GH5', 3), ('g2', 'GT2', 2)]
+    assert hits_of(calls, Rule(require=(), min_tools=2, family_from='agreed')) == \
+        [('g1', 'GH5+CBM1', 3), ('g2', 'GT2', 2), ('g3', 'GH13', 2)]
+    assert hits_of(calls, Rule(require=('hmmer',), min_tools=1, family_from='diamond')) == \
+        [('g1', 'GH5_2+CBM1', 3), ('g3', 'GH13_5', 2)]
+    assert hits_of(calls, Rule(require=('hotpep',), min_tools=1, family_from='hotpep')) == \
+        [('g1', 'GH5', 3), ('g2', 'GT2', 2), ('g4', 'CE1', 1)]
+
+
+def test_chunked_reads_match(tmp_path):
+    write_outputs(str(tmp_path))
+    whole = read_tool_calls(str(tmp_path))
+    chunked = read_tool_calls(str(tmp_path), chunksize=1)
+    assert whole.equals(chunked)
+    counts = family_counts(apply_rule(whole, rule=Rule(require=(), min_tools=1, family_from='hotpep')))
+    assert list(zip(counts['CAZy ID'], counts['count'])) == [('CE1', 1), ('GH5', 1), ('GT2', 1)]
+
+
+def test_missing_outputs(tmp_path):
+    assert hits_of(read_tool_calls(str(tmp_path)), DEFAULT_RULE) == []
+    assert write_overview(str(tmp_path)) == 0
+    with open(str(tmp_path / 'overview.txt')) as f_in:
+        assert f_in.read() == "Gene ID\tHMMER\tHotpep\tDIAMOND\tSignalp\t#ofTools\n"
+
+
+def test_overview_keeps_signalp(tmp_path):
+    write_outputs(str(tmp_path))
+    (tmp_path / 'overview.txt').write_text("Gene ID\tHMMER\tHotpep\tDIAMOND\tSignalp\t#ofTools\n"
+                                           "g2\t-\tGT2(11)\tGT2\tY(1-20)\t2\n")
+    assert write_overview(str(tmp_path)) == 4
+    with open(str(tmp_path / 'overview.txt')) as f_in:
+        rows = [line.rstrip('\n').split('\t') for line in f_in]
+    assert rows == [['Gene ID', 'HMMER', 'Hotpep', 'DIAMOND', 'Signalp', '#ofTools'],
+                    ['g1', 'GH5_2(1-100)+CBM1(120-160)', 'GH5(3)', 'GH5_2+CBM1', 'N', '3'],
+                    ['g2', '-', 'GT2(11)', 'GT2', 'Y(1-20)', '2'],
+                    ['g3', 'GH13(5-300)', '-', 'GH13_5', 'N', '2'],
+                    ['g4', '-', 'CE1(2)', '-', 'N', '1']]
@@ -0,0 +1,102 @@
+"""
+database releases built once with stand-in diamond and hmmpress, and staged per node
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import subprocess
+import collections
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import databases
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+# write the index named by -d, slowly enough for concurrent builds to overlap
+DIAMOND = '''#!/bin/sh
+echo diamond >> {log}
+sleep 0.2
+while [ "$1" != "-d" ]; do shift; done
+echo index > "$2.dmnd"
+'''
+
+HMMPRESS = '''#!/bin/sh
+echo hmmpress >> {log}
+for s in h3f h3i h3m h3p; do echo index > "$2.$s"; done
+'''
+
+
+@pytest.fixture
+def db_root(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'tools.log'
+    for name, template in (('diamond', DIAMOND), ('hmmpress', HMMPRESS)):
+        (bin_dir / name).write_text(template.format(log=str(log)))
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+    # sources already downloaded into the release
+    root = tmp_path / 'db'
+    sources = root / databases.RELEASE / databases.SOURCES_DIR
+    sources.mkdir(parents=True)
+    for name, (url, source_name, command, outputs) in databases.DATABASES.items():
+        (sources / source_name).write_text("{} source\n".format(name))
+    return root, log
+
+
+def test_concurrent_builds_build_each_database_once(db_root):
+    root, log = db_root
+    command = [sys.executable, os.path.join(SCRIPTS, 'databases.py'), 'build', '-r', str(root)]
+    builds = [subprocess.Popen(command, cwd=str(root), stdout=subprocess.PIPE) for _ in range(3)]
+    assert [build.wait() for build in builds] == [0, 0, 0]
+    tools = log.read_text().split()
+    assert sorted(tools) == ['diamond', 'diamond', 'hmmpress', 'hmmpress', 'hmmpress', 'hmmpress']
+    assert os.path.realpath(str(root / 'current')) == str(root / databases.RELEASE)
+
+
+def test_damaged_databases_are_rebuilt(db_root):
+    root, log = db_root
+    release_dir = databases.build(str(root))
+    assert databases.build(str(root)) == release_dir
+    assert len(log.read_text().split()) == 6
+
+    with open(os.path.join(release_dir, 'CAZy.dmnd'), 'a') as f_out:
+        f_out.write('damaged\n')
+    assert databases.build(str(root)) == release_dir
+    assert log.read_text().split().count('diamond') == 3
+    manifest = databases.read_manifest(release_dir)
+    assert sorted(manifest['databases']) == sorted(databases.DATABASES)
+    assert all(not databases.check_database(release_dir, entry, verify=True)
+               for entry in manifest['databases'].values())
+
+
+def test_stage_copies_once_keeping_modification_times(db_root, tmp_path):
+    root, log = db_root
+    release_dir = databases.build(str(root))
+    target = str(tmp_path / 'shm')
+    staged = databases.stage(str(root / 'current'), target)
+    assert staged != release_dir
+    files = databases.release_files(release_dir)
+    assert databases.release_files(staged) == files
+    assert databases.SOURCES_DIR not in {fn.split(os.sep)[0] for fn in files}
+    for fn in files:
+        assert os.stat(os.path.join(staged, fn)).st_mtime_ns == os.stat(os.path.join(release_dir, fn)).st_mtime_ns
+
+    # a second job finds the staged copy complete and leaves it be
+    marker = os.path.join(staged, 'CAZy.dmnd')
+    inode = os.stat(marker).st_ino
+    assert databases.stage(release_dir, target) == staged
+    assert os.stat(marker).st_ino == inode
+
+
+def test_stage_reads_in_place_without_space(db_root, tmp_path, monkeypatch):
+    root, log = db_root
+    release_dir = databases.build(str(root))
+    usage = collections.namedtuple('usage', ['total', 'used', 'free'])
+    monkeypatch.setattr(databases.shutil, 'disk_usage', lambda path: usage(1, 1, 0))
+    assert databases.stage(release_dir, str(tmp_path / 'shm')) == os.path.realpath(release_dir)
@@ -0,0 +1,64 @@
+"""
+single-pass CAZy family x genome matrix against the outer-merge chain it replaces
+"""
+
+# --- standard imports ---#
+import os
+import functools
+
+# --- third party imports ---#
+import numpy as np
+import pandas as pd
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+from diamond_out_summary import count_genomes, count_matrix, write_matrix
+from utils import find_genome_files
+
+
+def genome_counts(tmp_path, n_genomes=6, n_genes=200):
+    genomes_dir = bench.make_genomes(str(tmp_path), n_genomes, n_genes)
+    for taxid in sorted(os.listdir(genomes_dir)):
+        genes = ["contig_{}_{}".format(i // 50 + 1, i % 50 + 1) for i in range(n_genes)]
+        bench.write_dbcan_outputs(os.path.join(genomes_dir, taxid), genes, seed=int(taxid))
+    overview_files = [fn for genome, fn in find_genome_files(genomes_dir, 'overview.txt')]
+    return count_genomes(overview_files, summary_dir=str(tmp_path / 'summary'))
+
+
+def legacy_merge(counts, out_file):
+    frames = [pd.DataFrame({'CAZy ID': families, genome: values}) for genome, families, values in counts]
+    merged = functools.reduce(lambda left, right: pd.merge(left, right, on=['CAZy ID'], how='outer'),
+                              frames).fillna(0)
+    merged.to_csv(out_file, index=False, sep=",")
+
+
+def test_count_matrix_coordinates():
+    matrix = count_matrix([('g1', ['GH2', 'GH1'], [3, 1]), ('g2', [], []), ('g3', ['GH1', 'CE4'], [2, 5])])
+    assert matrix.families == ['CE4', 'GH1', 'GH2']
+    assert matrix.genomes == ['g1', 'g2', 'g3']
+    dense = np.zeros((3, 3), dtype=np.int64)
+    dense[matrix.rows, matrix.cols] = matrix.counts
+    assert dense.tolist() == [[0, 0, 5], [1, 0, 2], [3, 0, 0]]
+
+
+def test_count_matrix_of_nothing():
+    matrix = count_matrix([])
+    assert matrix.families == [] and matrix.genomes == [] and len(matrix.rows) == 0
+
+
+def test_dense_csv_matches_the_outer_merge(tmp_path):
+    counts = genome_counts(tmp_path)
+    assert len(counts) == 6
+    write_matrix(count_matrix(counts), str(tmp_path / 'aggregated.csv'))
+    legacy_merge(counts, str(tmp_path / 'legacy.csv'))
+    assert (tmp_path / 'aggregated.csv').read_text() == (tmp_path / 'legacy.csv').read_text()
+
+
+def test_npz_round_trip(tmp_path):
+    counts = [('g1', ['GH2', 'GH1'], [3, 1]), ('g2', ['GT2'], [4])]
+    matrix = count_matrix(counts)
+    write_matrix(matrix, str(tmp_path / 'aggregated.npz'), fmt='npz')
+    with np.load(str(tmp_path / 'aggregated.npz')) as data:
+        assert data['families'].tolist() == matrix.families
+        assert data['genomes'].tolist() == matrix.genomes
+        assert data['counts'].tolist() == matrix.counts.tolist()
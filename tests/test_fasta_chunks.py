@@ -0,0 +1,77 @@
+"""
+record offsets and chunk plans of FASTA files
+"""
+
+# --- standard imports ---#
+import os
+import random
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+from fasta_chunks import record_offsets, plan_chunks, iter_chunks
+
+
+def synthetic_fasta(n_records, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(n_records):
+        # a '>' within a header must not open a record
+        seq = bench.random_sequence(rng, bench.AMINO_ACIDS, rng.randint(1, 400))
+        records.append(">gene_{} len>{}\n{}\n".format(i, len(seq), seq))
+    return ''.join(records).encode()
+
+
+def brute_force_offsets(data):
+    return [i for i, byte in enumerate(data) if byte == ord('>') and (i == 0 or data[i - 1] == ord('\n'))]
+
+
+@pytest.mark.parametrize('window', [1, 7, 64, 1 << 20])
+def test_record_offsets_match_a_scan(window):
+    data = synthetic_fasta(200)
+    assert record_offsets(data, window=window).tolist() == brute_force_offsets(data)
+
+
+def test_record_offsets_of_an_empty_file():
+    assert record_offsets(b'').tolist() == []
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 100, 1000, 10 ** 6])
+def test_plan_chunks_tiles_the_records(chunk_bytes):
+    data = synthetic_fasta(200, seed=1)
+    offsets = record_offsets(data)
+    chunks = plan_chunks(offsets, len(data), chunk_bytes)
+
+    # contiguous from the first record to the end of the file
+    assert chunks[0][0] == offsets[0]
+    assert chunks[-1][1] == len(data)
+    assert all(end == start for (_, end), (start, _) in zip(chunks, chunks[1:]))
+
+    starts = set(offsets.tolist())
+    for start, end in chunks:
+        assert start in starts and (end in starts or end == len(data))
+        # over the size only when the chunk is a single record
+        records = sum(1 for o in offsets if start <= o < end)
+        assert end - start <= chunk_bytes or records == 1
+
+
+def test_plan_chunks_without_records():
+    assert plan_chunks(record_offsets(b''), 0, 100) == []
+
+
+def test_iter_chunks_round_trip(tmp_path):
+    data = synthetic_fasta(300, seed=2)
+    fasta = tmp_path / 'proteins.faa'
+    fasta.write_bytes(data)
+    out_dir = tmp_path / 'chunks'
+    out_dir.mkdir()
+    paths = [path for index, path in iter_chunks(str(fasta), 5000, str(out_dir))]
+    assert len(paths) > 1
+    joined = b''
+    for path in paths:
+        with open(path, 'rb') as f_in:
+            joined += f_in.read()
+        os.remove(path)
+    assert joined == data
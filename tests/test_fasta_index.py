@@ -0,0 +1,79 @@
+"""
+.fai records built while reading a FASTA file and the seeks they serve
+"""
+
+# --- standard imports ---#
+import gzip
+import random
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+from fasta_index import FaiBuilder, build_index, read_index, fetch
+
+
+def wrapped_fasta(path, n_records, width, seed=0, line_ending='\n'):
+    """
+    write a FASTA file with the sequences wrapped at width residues
+
+    :return: <dict> name -> sequence
+    """
+    rng = random.Random(seed)
+    records = dict()
+    with open(path, 'w', newline='') as f_out:
+        for i in range(n_records):
+            name = "contig_{}_{}".format(i // 50 + 1, i % 50 + 1)
+            seq = bench.random_sequence(rng, bench.AMINO_ACIDS, rng.randint(1, 300))
+            records[name] = seq
+            f_out.write(">{} some description{}".format(name, line_ending))
+            for start in range(0, len(seq), width):
+                f_out.write(seq[start:start + width] + line_ending)
+    return records
+
+
+@pytest.mark.parametrize('width,line_ending', [(60, '\n'), (7, '\n'), (60, '\r\n'), (1000, '\n')])
+def test_fetch_every_record(tmp_path, width, line_ending):
+    fasta = str(tmp_path / 'proteins.faa')
+    records = wrapped_fasta(fasta, 120, width, line_ending=line_ending)
+    build_index(fasta)
+    index = read_index(fasta)
+    assert list(index) == list(records)
+    assert all(index[name].length == len(seq) for name, seq in records.items())
+
+    names = list(records)[::-1] + ['missing']
+    assert dict(fetch(fasta, names)) == dict(records, missing=None)
+
+
+def test_fetch_from_gzipped_file(tmp_path):
+    fasta = str(tmp_path / 'proteins.faa')
+    records = wrapped_fasta(fasta, 20, 60)
+    with open(fasta, 'rb') as f_in, gzip.open(fasta + '.gz', 'wb') as f_out:
+        f_out.write(f_in.read())
+    assert dict(fetch(fasta + '.gz', ['contig_1_3', 'missing'])) == {'contig_1_3': records['contig_1_3'],
+                                                                      'missing': None}
+
+
+def test_builder_matches_the_file_index(tmp_path):
+    fasta = str(tmp_path / 'proteins.faa')
+    wrapped_fasta(fasta, 30, 13)
+    builder = FaiBuilder(fasta)
+    with open(fasta) as f_in:
+        for line in f_in:
+            builder.add(line.rstrip('\n'))
+    builder.write(str(tmp_path / 'built.fai'))
+    build_index(fasta)
+    assert (tmp_path / 'built.fai').read_text() == (tmp_path / 'proteins.faa.fai').read_text()
+
+
+@pytest.mark.parametrize('lines', [
+    ['>a', 'ACGT', 'ACGTA', 'AC'],
+    ['>a', 'ACGT', 'AC', 'ACGT'],
+    ['>a', 'ACGT', '', 'ACGT'],
+])
+def test_builder_rejects_uneven_lines(lines):
+    builder = FaiBuilder('uneven.faa')
+    with pytest.raises(ValueError):
+        for line in lines:
+            builder.add(line)
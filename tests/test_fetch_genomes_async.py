@@ -0,0 +1,242 @@
+"""
+HttpPool, download_fasta and fetch_genome against a local stand-in HTTP server
+"""
+
+# --- standard imports ---#
+import os
+import zlib
+import gzip
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+from fetch_genomes_async import HttpPool, HttpError, download_fasta
+
+FASTA = b">contig_1\nACGTACGTACGT\n>contig_2\nGGGCCCAAATTT\n"
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    serves the routes of the server, counting the requests per path
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.hits[self.path] = server.hits.get(self.path, 0) + 1
+        server.peers.add(self.client_address)
+        route = server.routes.get(self.path)
+        if route is None:
+            self._send(404, b'')
+        elif route[0] == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', route[1])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif route[0] == 'truncate':
+            # announce the whole body but hang up half way on the first request
+            body = route[1]
+            if server.hits[self.path] == 1:
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+            else:
+                self._send(200, body)
+        elif route[0] == 'chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in route[1]:
+                self.wfile.write("{:x};ext=1\r\n".format(len(part)).encode() + part + b'\r\n')
+            self.wfile.write(b'0\r\nX-Trailer: 1\r\n\r\n')
+        elif route[0] == 'eof':
+            # neither a length nor chunks, the body ends when the server hangs up
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(route[1])
+            self.close_connection = True
+        elif route[0] == 'status':
+            self._send(route[1], b'server error')
+        elif route[0] == 'drop':
+            # keep-alive is not announced as closed, the client finds out on reuse
+            self._send(200, route[1])
+            self.close_connection = True
+        else:
+            self._send(200, route[1])
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    httpd.routes = dict()
+    httpd.hits = dict()
+    httpd.peers = set()
+    httpd.url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch(url, out_file=None):
+    async def run():
+        pool = HttpPool(timeout=5)
+        try:
+            if out_file:
+                return await download_fasta(pool, url, out_file)
+            return await pool.get(url)
+        finally:
+            pool.close()
+    return asyncio.run(run())
+
+
+def test_follows_relative_redirects(server):
+    server.routes['/genomes/all/GCA_1/x.fna.gz'] = ('redirect', '../GCA_2/x.fna.gz')
+    server.routes['/genomes/all/GCA_2/x.fna.gz'] = ('redirect', '/mirror/x.fna.gz')
+    body = gzip.compress(FASTA)
+    server.routes['/mirror/x.fna.gz'] = ('body', body)
+    assert fetch(server.url + '/genomes/all/GCA_1/x.fna.gz') == body
+    assert server.hits['/mirror/x.fna.gz'] == 1
+
+
+def test_follows_absolute_redirects(server):
+    server.routes['/a'] = ('redirect', server.url + '/b')
+    server.routes['/b'] = ('body', b'payload')
+    assert fetch(server.url + '/a') == b'payload'
+
+
+def test_redirect_loop_is_an_error(server):
+    server.routes['/loop'] = ('redirect', 'loop')
+    with pytest.raises(HttpError):
+        fetch(server.url + '/loop')
+
+
+def test_missing_file_is_an_error(server):
+    with pytest.raises(HttpError) as error:
+        fetch(server.url + '/missing')
+    assert error.value.status == 404
+
+
+def test_reopens_a_connection_closed_by_the_server(server):
+    server.routes['/one'] = ('drop', b'first')
+    server.routes['/two'] = ('body', b'second')
+
+    async def run():
+        pool = HttpPool(timeout=5)
+        try:
+            return [await pool.get(server.url + '/one'), await pool.get(server.url + '/two')]
+        finally:
+            pool.close()
+    assert asyncio.run(run()) == [b'first', b'second']
+
+
+def test_truncated_body_leaves_no_file_and_retry_succeeds(server, tmp_path):
+    body = gzip.compress(FASTA * 200)
+    server.routes['/x.fna.gz'] = ('truncate', body)
+    out_file = str(tmp_path / 'x.fna')
+    with pytest.raises((asyncio.IncompleteReadError, ConnectionError)):
+        fetch(server.url + '/x.fna.gz', out_file)
+    assert os.listdir(str(tmp_path)) == []
+
+    received, seconds = fetch(server.url + '/x.fna.gz', out_file)
+    assert received == len(body)
+    with open(out_file, 'rb') as f_in:
+        assert f_in.read() == FASTA * 200
+
+
+def test_truncated_gzip_stream_is_an_error(server, tmp_path):
+    server.routes['/x.fna.gz'] = ('body', gzip.compress(FASTA * 200)[:-12])
+    out_file = str(tmp_path / 'x.fna')
+    with pytest.raises(zlib.error) as error:
+        fetch(server.url + '/x.fna.gz', out_file)
+    assert 'truncated' in str(error.value)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_concatenated_gzip_members(server, tmp_path):
+    server.routes['/x.fna.gz'] = ('body', gzip.compress(FASTA) + gzip.compress(FASTA))
+    out_file = str(tmp_path / 'x.fna')
+    fetch(server.url + '/x.fna.gz', out_file)
+    with open(out_file, 'rb') as f_in:
+        assert f_in.read() == FASTA * 2
+
+
+def get_all(server, paths):
+    async def run():
+        pool = HttpPool(timeout=5)
+        try:
+            return [await pool.get(server.url + path) for path in paths]
+        finally:
+            pool.close()
+    return asyncio.run(run())
+
+
+def test_chunked_bodies_keep_the_connection(server):
+    server.routes['/chunked'] = ('chunked', [b'ACGT' * 1000, b'GGCC'])
+    server.routes['/plain'] = ('body', b'payload')
+    assert get_all(server, ['/chunked', '/plain', '/chunked']) == [b'ACGT' * 1000 + b'GGCC', b'payload',
+                                                                   b'ACGT' * 1000 + b'GGCC']
+    assert len(server.peers) == 1
+
+
+def test_body_read_to_the_end_of_the_connection(server):
+    server.routes['/eof'] = ('eof', b'until the end')
+    server.routes['/plain'] = ('body', b'payload')
+    assert get_all(server, ['/eof', '/plain']) == [b'until the end', b'payload']
+    # a body without a length cannot leave the connection reusable
+    assert len(server.peers) == 2
+
+
+def test_error_status_closes_the_connection(server):
+    server.routes['/broken'] = ('status', 500)
+    server.routes['/plain'] = ('body', b'payload')
+    with pytest.raises(HttpError) as error:
+        fetch(server.url + '/broken')
+    assert error.value.status == 500
+    assert get_all(server, ['/plain', '/plain']) == [b'payload', b'payload']
+    assert len(server.peers) == 2
+
+
+def test_fallback_decompresses_off_the_event_loop(tmp_path, monkeypatch):
+    import fetch_genomes_async
+    threads = []
+
+    async def download(cmd):
+        (tmp_path / '100001' / 'GCA_1_genomic.fna.gz').write_bytes(gzip.compress(FASTA))
+        return FakeProcess()
+
+    class FakeProcess:
+        returncode = 0
+
+        async def wait(self):
+            return 0
+
+    def uncompress(filename, suffix):
+        threads.append(threading.current_thread())
+        assert filename.endswith('GCA_1_genomic.fna.gz') and suffix == '.fna'
+    monkeypatch.setattr(asyncio, 'create_subprocess_shell', download)
+    monkeypatch.setattr(fetch_genomes_async, 'uncompress_fasta', uncompress)
+
+    async def run():
+        return await fetch_genomes_async.fetch_genome(None, asyncio.Semaphore(1), 100001,
+                                                      ['Bacteroides ovatus', 'PRJNA1', 'Bacteroides ovatus ATCC 8483'],
+                                                      None, str(tmp_path))
+    assert asyncio.run(run())
+    assert len(threads) == 1 and threads[0] is not threading.main_thread()
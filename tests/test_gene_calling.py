@@ -0,0 +1,108 @@
+"""
+gene predictions cached by input digest and prodigal mode
+"""
+
+# --- standard imports ---#
+import io
+import os
+import sys
+import gzip
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+from gene_calling import cache_entry, predict_genes
+from utils import read_fasta, sha256sum
+
+# one protein per contig, named after the mode; fails on inputs without contigs
+PRODIGAL = '''#!{python}
+import sys
+with open({log!r}, 'a') as f_out:
+    f_out.write(' '.join(sys.argv[1:]) + '\\n')
+args = sys.argv[1:]
+f_in = open(args[args.index('-i') + 1]) if '-i' in args else sys.stdin
+contigs = [line[1:].split()[0] for line in f_in if line.startswith('>')]
+if not contigs:
+    sys.exit(1)
+mode = args[args.index('-p') + 1]
+with open(args[args.index('-a') + 1], 'w') as f_out:
+    f_out.writelines('>{{}}_1 # {{}}\\nMKTAYIAKQR\\n'.format(contig, mode) for contig in contigs)
+with open(args[args.index('-o') + 1], 'w') as f_out:
+    f_out.write('##gff-version 3\\n')
+'''
+
+
+@pytest.fixture
+def prodigal(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'prodigal.log'
+    (bin_dir / 'prodigal').write_text(PRODIGAL.format(python=sys.executable, log=str(log)))
+    (bin_dir / 'prodigal').chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+    return calls
+
+
+def genome(tmp_path, name, contigs, gzipped=False):
+    out_dir = tmp_path / name
+    out_dir.mkdir(exist_ok=True)
+    text = ''.join(">{}\nACGTACGTAAAC\n".format(contig) for contig in contigs)
+    if gzipped:
+        fasta = out_dir / (name + '.fna.gz')
+        with gzip.open(str(fasta), 'wt') as f_out:
+            f_out.write(text)
+    else:
+        fasta = out_dir / (name + '.fna')
+        fasta.write_text(text)
+    return str(fasta), str(out_dir)
+
+
+def proteins(faa):
+    return [header for header, seq in read_fasta(faa)]
+
+
+def test_cached_by_digest_and_mode(tmp_path, prodigal):
+    cache_dir = str(tmp_path / 'cache')
+    fasta, out_dir = genome(tmp_path, '100001', ['contig_1', 'contig_2'], gzipped=True)
+    faa = predict_genes(fasta, 'meta', out_dir, io.StringIO(), cache_dir=cache_dir)
+    assert faa == os.path.join(cache_entry(cache_dir, 'meta', sha256sum(fasta)), 'proteins.faa')
+    assert proteins(faa) == ['contig_1_1 # meta', 'contig_2_1 # meta']
+    assert predict_genes(fasta, 'meta', out_dir, io.StringIO(), cache_dir=cache_dir) == faa
+    assert len(prodigal()) == 1
+
+    # another mode is another entry, and so is another genome with the same contig names
+    assert proteins(predict_genes(fasta, 'prok', out_dir, io.StringIO(), cache_dir=cache_dir)) == \
+        ['contig_1_1 # single', 'contig_2_1 # single']
+    other, other_dir = genome(tmp_path, '100002', ['contig_1'])
+    assert predict_genes(other, 'meta', other_dir, io.StringIO(), cache_dir=cache_dir) != faa
+    assert len(prodigal()) == 3
+    assert '-i ' + other in prodigal()[-1]
+
+
+def test_failed_prediction_is_not_cached(tmp_path, prodigal):
+    cache_dir = tmp_path / 'cache'
+    fasta, out_dir = genome(tmp_path, '100001', [])
+    assert predict_genes(fasta, 'meta', out_dir, io.StringIO(), cache_dir=str(cache_dir)) is None
+    entries = [files for root, dirs, files in os.walk(str(cache_dir)) if files]
+    assert entries == []
+    assert predict_genes(fasta, 'meta', out_dir, io.StringIO(), cache_dir=str(cache_dir)) is None
+    assert len(prodigal()) == 2
+
+
+def test_predictions_next_to_the_genome(tmp_path, prodigal):
+    fasta, out_dir = genome(tmp_path, '100001', ['contig_1'])
+    faa = predict_genes(fasta, 'prok', out_dir, io.StringIO())
+    assert faa == os.path.join(out_dir, 'proteins.faa')
+    assert predict_genes(fasta, 'prok', out_dir, io.StringIO()) == faa
+    assert len(prodigal()) == 1
+
+    # an edited genome is predicted again
+    fasta, out_dir = genome(tmp_path, '100001', ['contig_1', 'contig_9'])
+    assert proteins(predict_genes(fasta, 'prok', out_dir, io.StringIO())) == ['contig_1_1 # single',
+                                                                              'contig_9_1 # single']
+    assert len(prodigal()) == 2
+    assert sorted(os.listdir(out_dir)) == ['100001.fna', 'genes.gff', 'proteins.faa', 'proteins.faa.sha256']
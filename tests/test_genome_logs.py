@@ -0,0 +1,81 @@
+"""
+per-genome log files fed by the workers through a queue
+"""
+
+# --- standard imports ---#
+import os
+import logging
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import scheduler
+from genome_logs import PIPELINE_LOG, GenomeFileHandler, GenomeLogWriter, start_logging
+
+
+def log_genome(genome, lines):
+    GenomeLogWriter(genome).write(''.join(line + '\n' for line in lines))
+    return genome
+
+
+def read_log(log_dir, genome):
+    with open(os.path.join(log_dir, "{}.log".format(genome))) as f_in:
+        return [line.rstrip('\n').split(' - ', 2)[-1] for line in f_in]
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_records_are_routed_per_genome(tmp_path):
+    handler = GenomeFileHandler(str(tmp_path), max_open=2)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for i, genome in enumerate(['g1', 'g2', 'g3', 'g1', None]):
+        record = logging.LogRecord('tools', logging.INFO, __file__, 0, "line {}".format(i), None, None)
+        if genome is not None:
+            record.genome = genome
+        handler.emit(record)
+    # the least recently used file is closed, and reopened for appending
+    assert len(handler._handlers) == 2
+    handler.close()
+    assert read_log(str(tmp_path), 'g1') == ['line 0', 'line 3']
+    assert read_log(str(tmp_path), 'g3') == ['line 2']
+    assert read_log(str(tmp_path), PIPELINE_LOG) == ['line 4']
+
+
+def test_rotation(tmp_path):
+    handler = GenomeFileHandler(str(tmp_path), max_bytes=100, backup_count=2)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for i in range(40):
+        record = logging.LogRecord('tools', logging.INFO, __file__, 0, "line {:02d}".format(i), None, None)
+        record.genome = 'g1'
+        handler.emit(record)
+    handler.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['g1.log', 'g1.log.1', 'g1.log.2']
+    assert read_log(str(tmp_path), 'g1')[-1] == 'line 39'
+
+
+def test_worker_records_reach_their_genome_log(tmp_path, root_logger):
+    log_dir = str(tmp_path / 'logs')
+    queue, listener = start_logging(log_dir, console_level=logging.CRITICAL)
+    try:
+        tasks = [dict(genome=genome, lines=["{} stderr {}".format(genome, i) for i in range(3)])
+                 for genome in ('100001', '100002')]
+        scheduler.run_jobs(log_genome, tasks, jobs=2, threads_per_job=1, log_queue=queue,
+                           label=lambda task: task['genome'])
+    finally:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+    for genome in ('100001', '100002'):
+        assert read_log(log_dir, genome) == ["{} stderr {}".format(genome, i) for i in range(3)]
+    assert any('completed 100001' in line for line in read_log(log_dir, PIPELINE_LOG))
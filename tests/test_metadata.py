@@ -0,0 +1,83 @@
+"""
+columnar cache of the metadata sheets and the joins onto the CAZyme matrix
+"""
+
+# --- standard imports ---#
+import os
+
+# --- third party imports ---#
+import numpy as np
+import pandas as pd
+import pytest
+
+# --- project specific imports ---#
+import metadata
+from metadata import CACHE_DIR, TaxaIndex, Taxon, join_samples, join_taxa, read_sheet
+
+TAXA = pd.DataFrame({'Tax_ID': [102, 101, 103, np.nan],
+                     'Species': ['Bacteroides ovatus', 'Bacteroides ovatus', 'NA', np.nan],
+                     'BioProject Accession': ['PRJNA2', 'PRJNA1', 'PRJNA3', np.nan],
+                     'Scientific_Name': ['Bacteroides ovatus 2', 'Bacteroides ovatus 1', 'Prevotella copri', np.nan],
+                     'specI': ['specI_v3_1', 'specI_v3_1', 'specI_v3_2', np.nan]})
+
+
+@pytest.fixture
+def workbook(tmp_path, monkeypatch):
+    """
+    a workbook whose sheets are served without openpyxl, counting the conversions
+    """
+    xlsx_file = tmp_path / 'taxa_metadata.xlsx'
+    xlsx_file.write_bytes(b'workbook')
+    reads = []
+
+    def read_excel(path, sheet_name=0):
+        reads.append(sheet_name)
+        return TAXA.astype(object).copy()
+    monkeypatch.setattr(metadata.pd, 'read_excel', read_excel)
+    return str(xlsx_file), reads
+
+
+def test_sheet_converted_once(workbook):
+    xlsx_file, reads = workbook
+    first = read_sheet(xlsx_file, 'Taxa_metadata')
+    second = read_sheet(xlsx_file, 'Taxa_metadata')
+    assert reads == ['Taxa_metadata']
+    pd.testing.assert_frame_equal(first, second)
+    assert first['Tax_ID'].dtype.kind == 'f'
+    assert isinstance(first['Species'].dtype, pd.CategoricalDtype)
+    assert first['Species'].isna().sum() == 2
+
+    # a new version of the workbook is converted again, replacing the stale conversion
+    with open(xlsx_file, 'ab') as f_out:
+        f_out.write(b' edited')
+    read_sheet(xlsx_file, 'Taxa_metadata')
+    assert reads == ['Taxa_metadata'] * 2
+    assert len(os.listdir(os.path.join(os.path.dirname(xlsx_file), CACHE_DIR))) == 1
+
+
+def test_taxa_index(workbook):
+    xlsx_file, reads = workbook
+    taxa = TaxaIndex(xlsx_file)
+    assert reads == []
+    assert len(taxa) == 3 and 101 in taxa and '103' in taxa and 104 not in taxa
+    assert taxa[103] == Taxon(None, 'PRJNA3', 'Prevotella copri')
+    assert [tax_id for tax_id, taxon in taxa.items()] == [101, 102, 103]
+    assert taxa.to_dict()[101] == ['Bacteroides ovatus', 'PRJNA1', 'Bacteroides ovatus 1']
+    assert reads == ['Taxa_metadata']
+
+
+def test_joins(workbook):
+    xlsx_file, reads = workbook
+    taxa = TaxaIndex(xlsx_file)
+    matrix = pd.DataFrame({'GH1': [1, 0, 2], 'GT2': [3, 1, 0]}, index=pd.Index([101, 102, 103], name='Tax_ID'))
+    joined = join_taxa(matrix, taxa, columns=['Scientific_Name'])
+    assert joined.loc[102].tolist() == ['Bacteroides ovatus 2', 0, 1]
+
+    samples = pd.DataFrame({'age': [30, 40]}, index=pd.Index(['s1', 's2'], name='sample'))
+    abundance = pd.DataFrame({'specI_v3_1': [0.5, 0.0], 'specI_v3_2': [0.5, 1.0]}, index=['s1', 's2'])
+    profile = join_samples(matrix, samples, abundance, taxa=taxa)
+    # a specI cluster stands for its first Tax_ID
+    assert profile.loc['s1', ['GH1', 'GT2']].tolist() == [1.5, 1.5]
+    assert profile.loc['s2', ['age', 'GH1', 'GT2']].tolist() == [40, 2.0, 0.0]
+    with pytest.raises(ValueError):
+        join_samples(matrix, samples, abundance)
@@ -0,0 +1,123 @@
+"""
+vectorized conserved-peptide scan against a brute-force matcher
+"""
+
+# --- standard imports ---#
+import random
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+from peptide_index import ALPHABET, FREQ_TOLERANCE, MAX_K, build_index, load_index, read_patterns, scan_batch
+
+K = 5
+
+
+def make_patterns(patterns_dir, proteins, seed=0):
+    """
+    write peptide groups, half of their peptides taken from one of the proteins so that some groups match
+    """
+    rng = random.Random(seed)
+    for family in bench.FAMILIES[:6]:
+        family_dir = patterns_dir / family
+        family_dir.mkdir(parents=True)
+        for group in range(1, 4):
+            protein = rng.choice(proteins)
+            peptides = set()
+            while len(peptides) < 8:
+                if rng.random() < 0.5:
+                    start = rng.randrange(len(protein) - K)
+                    peptides.add(protein[start:start + K])
+                else:
+                    peptides.add(bench.random_sequence(rng, bench.AMINO_ACIDS, K))
+            (family_dir / "{}.txt".format(group)).write_text(
+                ''.join("{}\t{:.2f}\n".format(p, rng.uniform(0.05, 1.0)) for p in sorted(peptides)))
+
+
+def brute_force(groups, batch, min_hits, min_freq):
+    best = dict()
+    for protein_id, (gene, seq) in enumerate(batch):
+        seq = seq.upper()
+        kmers = {seq[i:i + K] for i in range(len(seq) - K + 1) if all(r in ALPHABET for r in seq[i:i + K])}
+        for (family, number), peptides in groups:
+            matched = [(p, f) for p, f in peptides if p in kmers]
+            freq = sum(f for p, f in matched)
+            if len(matched) >= min_hits and freq >= min_freq - FREQ_TOLERANCE:
+                score = (freq, len(matched))
+                if (protein_id, family) not in best or score > best[protein_id, family][0]:
+                    best[protein_id, family] = (score, number, sorted(p for p, f in matched))
+    return [[family, number, batch[protein_id][0], round(freq, 2), hits, ','.join(signature)]
+            for (protein_id, family), ((freq, hits), number, signature) in sorted(best.items())]
+
+
+@pytest.fixture
+def proteins():
+    rng = random.Random(1)
+    sequences = [bench.random_sequence(rng, bench.AMINO_ACIDS, rng.randint(K, 120)) for _ in range(60)]
+    # non-standard residues, lower case and sequences shorter than a peptide
+    sequences += ['ACDXEFGHIKLMNP', sequences[0].lower(), 'ACD', '']
+    return [("gene_{}".format(i), seq) for i, seq in enumerate(sequences)]
+
+
+@pytest.mark.parametrize('min_hits,min_freq', [(1, 0.0), (2, 0.8), (3, 1.5)])
+def test_scan_matches_brute_force(tmp_path, proteins, min_hits, min_freq):
+    patterns_dir = tmp_path / 'patterns'
+    make_patterns(patterns_dir, [seq for gene, seq in proteins if len(seq) > K and seq.isupper()])
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    build_index(str(patterns_dir), str(db_dir))
+
+    expected = brute_force(read_patterns(str(patterns_dir)), proteins, min_hits, min_freq)
+    assert expected
+    for mmap in (True, False):
+        index = load_index(str(db_dir), mmap=mmap)
+        assert scan_batch(index, proteins, min_hits=min_hits, min_freq=min_freq) == expected
+
+
+def test_peptides_do_not_span_proteins(tmp_path):
+    patterns_dir = tmp_path / 'patterns' / 'GH1'
+    patterns_dir.mkdir(parents=True)
+    (patterns_dir / '1.txt').write_text("ACDEF\t1.0\n")
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    build_index(str(tmp_path / 'patterns'), str(db_dir))
+    index = load_index(str(db_dir))
+    assert scan_batch(index, [('a', 'WWACD'), ('b', 'EFWW')], min_hits=1, min_freq=0) == []
+    assert scan_batch(index, [('a', 'WWACDEFWW')], min_hits=1, min_freq=0) == [['GH1', 1, 'a', 1.0, 1, 'ACDEF']]
+
+
+def test_summed_frequency_at_the_threshold(tmp_path):
+    patterns_dir = tmp_path / 'patterns' / 'GH1'
+    patterns_dir.mkdir(parents=True)
+    peptides = ['ACDEF', 'CDEFG', 'DEFGH', 'EFGHI', 'FGHIK', 'GHIKL']
+    (patterns_dir / '1.txt').write_text(''.join("{}\t{}\n".format(p, f) for p, f in zip(peptides, [0.1] * 6)))
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    build_index(str(tmp_path / 'patterns'), str(db_dir))
+    rows = scan_batch(load_index(str(db_dir)), [('a', 'ACDEFGHIKL')], min_hits=6, min_freq=0.6)
+    assert [row[4] for row in rows] == [6]
+
+
+def test_batches_beyond_65535_proteins(tmp_path):
+    patterns_dir = tmp_path / 'patterns' / 'GH1'
+    patterns_dir.mkdir(parents=True)
+    (patterns_dir / '1.txt').write_text("ACDEF\t1.0\n")
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    build_index(str(tmp_path / 'patterns'), str(db_dir))
+    batch = [('gene_{}'.format(i), 'WWWWW') for i in range(70000)] + [('last', 'ACDEF'), ('empty', 'WW')]
+    assert scan_batch(load_index(str(db_dir)), batch, min_hits=1, min_freq=0) == \
+        [['GH1', 1, 'last', 1.0, 1, 'ACDEF']]
+    assert scan_batch(load_index(str(db_dir)), batch[:10], min_hits=1, min_freq=0) == []
+
+
+def test_long_peptides_rejected(tmp_path):
+    patterns_dir = tmp_path / 'patterns' / 'GH1'
+    patterns_dir.mkdir(parents=True)
+    (patterns_dir / '1.txt').write_text("{}\t1.0\n".format('A' * (MAX_K + 1)))
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    with pytest.raises(ValueError):
+        build_index(str(tmp_path / 'patterns'), str(db_dir))
@@ -0,0 +1,112 @@
+"""
+stage and status transitions of the pipeline work queue
+"""
+
+# --- standard imports ---#
+import time
+import socket
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+from pipeline import STAGES, WorkQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    yield queue
+    queue.close()
+
+
+def transitions(queue, genome):
+    return [(row['stage'], row['status']) for row in
+            queue.db.execute("SELECT * FROM transitions WHERE genome = ? ORDER BY rowid", (genome,))]
+
+
+def test_genome_walks_every_stage(queue):
+    assert queue.add('g1', 'fetch')
+    for stage in STAGES[:-1]:
+        assert [row['genome'] for row in queue.runnable([stage])] == ['g1']
+        assert queue.claim('g1', stage)
+        assert queue.get('g1')['status'] == 'running'
+        assert queue.runnable([stage]) == []
+        queue.advance('g1', stage, input_file='/data/{}.out'.format(stage))
+    row = queue.get('g1')
+    assert (row['stage'], row['status'], row['input_file']) == ('done', 'done', '/data/summarize.out')
+    assert transitions(queue, 'g1') == [(stage, status) for stage in STAGES[:-1] for status in ('running', 'done')]
+
+
+def test_add_keeps_the_state_of_a_queued_genome(queue):
+    assert queue.add('g1', 'fetch')
+    queue.claim('g1', 'fetch')
+    queue.advance('g1', 'fetch')
+    assert not queue.add('g1', 'fetch')
+    assert queue.get('g1')['stage'] == 'decompress'
+
+
+def test_claim_is_exclusive(queue):
+    queue.add('g1', 'annotate')
+    other = WorkQueue(queue.queue_file)
+    try:
+        assert queue.claim('g1', 'annotate')
+        assert not other.claim('g1', 'annotate')
+        # a claim of another stage than the current one does nothing
+        assert not other.claim('g1', 'summarize')
+    finally:
+        other.close()
+
+
+def test_failures_back_off_then_give_up(queue):
+    queue.add('g1', 'gene-call')
+    start = time.time()
+    for attempt in range(1, 3):
+        queue.claim('g1', 'gene-call')
+        assert queue.fail('g1', 'gene-call', 'prodigal exited with 1', max_attempts=3, backoff=60)
+        row = queue.get('g1')
+        assert (row['status'], row['attempts']) == ('pending', attempt)
+        assert row['not_before'] >= start + 60 * 2 ** (attempt - 1)
+        assert queue.runnable(['gene-call']) == []
+        assert queue.runnable(['gene-call'], now=row['not_before']) != []
+        assert queue.next_wakeup() == row['not_before']
+        # rows pending at other stages are not waited for
+        assert queue.next_wakeup(['fetch']) is None
+        queue.db.execute("UPDATE genomes SET not_before = 0")
+
+    queue.claim('g1', 'gene-call')
+    assert not queue.fail('g1', 'gene-call', 'prodigal exited with 1', max_attempts=3)
+    row = queue.get('g1')
+    assert (row['status'], row['error']) == ('failed', 'prodigal exited with 1')
+    assert queue.next_wakeup() is None
+
+    assert queue.retry(['other']) == 0
+    assert queue.retry() == 1
+    row = queue.get('g1')
+    assert (row['stage'], row['status'], row['attempts']) == ('gene-call', 'pending', 0)
+
+
+def test_advance_clears_the_failure(queue):
+    queue.add('g1', 'annotate')
+    queue.claim('g1', 'annotate')
+    queue.fail('g1', 'annotate', 'timeout', backoff=0)
+    queue.claim('g1', 'annotate')
+    queue.advance('g1', 'annotate')
+    row = queue.get('g1')
+    assert (row['stage'], row['status'], row['attempts'], row['error']) == ('summarize', 'pending', 0, None)
+
+
+def test_reclaim_stages_of_dead_owners(queue):
+    for genome in ('dead', 'alive', 'remote', 'stale'):
+        queue.add(genome, 'annotate')
+        queue.claim(genome, 'annotate')
+    host = socket.gethostname()
+    # pid 2**22 + 1 is above the kernel limit, no process has it
+    queue.db.execute("UPDATE genomes SET owner = ? WHERE genome = 'dead'", ("{}:{}".format(host, 2 ** 22 + 1),))
+    queue.db.execute("UPDATE genomes SET owner = 'elsewhere:1' WHERE genome IN ('remote', 'stale')")
+    queue.db.execute("UPDATE genomes SET claimed = ? WHERE genome = 'stale'", (time.time() - 7200,))
+
+    assert queue.reclaim(stale_after=3600) == 2
+    status = {genome: queue.get(genome)['status'] for genome in ('dead', 'alive', 'remote', 'stale')}
+    assert status == {'dead': 'pending', 'alive': 'running', 'remote': 'running', 'stale': 'pending'}
+    assert transitions(queue, 'dead')[-1] == ('annotate', 'released')
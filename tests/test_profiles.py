@@ -0,0 +1,99 @@
+"""
+performance profiles and the diamond wrapper applying them
+"""
+
+# --- standard imports ---#
+import os
+import sys
+import subprocess
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import profiles
+from profiles import SHIM_ENV, diamond_memory_gb, resolve_profile, select_profile
+from tool_metrics import install_shims
+
+# records its command line, standing in for DIAMOND
+DIAMOND = '''#!{python}
+import sys
+with open({log!r}, 'a') as f_out:
+    f_out.write(' '.join(sys.argv[1:]) + '\\n')
+'''
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    """
+    a PATH holding only the stand-in diamond, without the wrapper
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'diamond.log'
+    (bin_dir / 'diamond').write_text(DIAMOND.format(python=sys.executable, log=str(log)))
+    (bin_dir / 'diamond').chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    # set first, so that the wrappers installed by the tests are taken off again
+    monkeypatch.setenv(SHIM_ENV, '')
+    monkeypatch.delenv(SHIM_ENV)
+    return log
+
+
+def query(tmp_path, letters):
+    fasta = tmp_path / 'query.faa'
+    with open(str(fasta), 'wb') as f_out:
+        f_out.truncate(int(letters))
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir(exist_ok=True)
+    with open(str(db_dir / 'CAZy.dmnd'), 'wb') as f_out:
+        f_out.truncate(int(1e9))
+    return str(fasta), str(db_dir)
+
+
+def test_memory_estimates():
+    assert diamond_memory_gb(None, None, 1e9) == pytest.approx(6.0)
+    assert diamond_memory_gb(0.5, 4, 1e9) == pytest.approx(3.0)
+    assert diamond_memory_gb(2.0, 1, 1e9) == pytest.approx(15.0)
+    # a block never holds more letters than the query or the reference
+    assert diamond_memory_gb(6.0, 1, 1e8) == pytest.approx(1.5)
+
+
+def test_select_profile():
+    assert select_profile(1e6, 1e9, 32) == 'small-query'
+    assert select_profile(2e8, 1e9, 64) == 'batch'
+    assert select_profile(1e6, 1e9, 8) == 'default'
+    assert select_profile(1e6, 1e9, 4) == 'low-memory'
+    # without the wrapper every profile runs with the DIAMOND defaults
+    assert select_profile(1e6, 1e9, 8, wrapper=False) == 'small-query'
+
+
+def test_profile_without_the_wrapper(path, tmp_path):
+    fasta, db_dir = query(tmp_path, 1e6)
+    record = resolve_profile('small-query', fasta, 'protein', db_dir, 32, threads=8)
+    assert not record['diamond_wrapper']
+    assert record['block_size'] is None and record['diamond_args'] == ''
+    assert record['dbcan_args'] == '--dia_cpu 8 --hmm_cpu 8 --hotpep_cpu 8'
+
+
+def test_profile_with_the_wrapper(path, tmp_path):
+    install_shims(str(tmp_path / 'shims'), names=['diamond'])
+    assert profiles.diamond_wrapper()
+    fasta, db_dir = query(tmp_path, 1e6)
+    record = resolve_profile('low-memory', fasta, 'protein', db_dir, 32, threads=8)
+    assert record['diamond_args'] == '-b 0.5 -c 4'
+    assert record['dbcan_args'] == '--dia_cpu 8 --hmm_cpu 8 --hotpep_cpu 1'
+
+    # the ceiling replaces a profile that does not fit, and fails when none does
+    record = resolve_profile('small-query', fasta, 'protein', db_dir, 32, max_memory_gb=4)
+    assert (record['profile'], record['requested']) == ('low-memory', 'small-query')
+    with pytest.raises(ValueError):
+        resolve_profile('default', fasta, 'protein', db_dir, 32, max_memory_gb=2)
+
+
+def test_wrapper_appends_the_profile_options(path, tmp_path):
+    install_shims(str(tmp_path / 'shims'), names=['diamond'])
+    env = dict(os.environ, **profiles.profile_env(dict(diamond_args='-b 0.5 -c 4')))
+    subprocess.check_call(['diamond', 'blastp', '-q', 'x.faa'], env=env)
+    subprocess.check_call(['diamond', 'makedb', '--in', 'x.faa'], env=env)
+    assert path.read_text().splitlines() == ['blastp -q x.faa -b 0.5 -c 4', 'makedb --in x.faa']
@@ -0,0 +1,119 @@
+"""
+freshness of the cached annotation results
+"""
+
+# --- standard imports ---#
+import os
+import sys
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import benchmark_pipeline as bench
+import result_cache
+from result_cache import cache_key, is_fresh, normalize_args, normalize_tools, read_manifest, write_manifest
+
+
+@pytest.fixture
+def genome(tmp_path):
+    """
+    a genome annotated with every tool, its manifest written
+    """
+    genome_dir = tmp_path / 'genomes' / '100001'
+    genome_dir.mkdir(parents=True)
+    fasta = genome_dir / '100001.fasta'
+    fasta.write_text(">contig_1_1\nMKTAYIAKQRQISFVKSHFSRQ\n")
+    db_dir = tmp_path / 'db'
+    db_dir.mkdir()
+    (db_dir / 'CAZy.dmnd').write_bytes(b'reference')
+    bench.write_dbcan_outputs(str(genome_dir), ['contig_1_1'], hit_rate=1.0)
+    return genome_dir, fasta, db_dir
+
+
+def key_of(genome, **kwargs):
+    genome_dir, fasta, db_dir = genome
+    options = dict(input_file=str(fasta), seq_type='protein', tools='all', db_dir=str(db_dir),
+                   manifest=read_manifest(str(genome_dir)))
+    options.update(kwargs)
+    return cache_key(**options)
+
+
+def test_normalized_tools_and_args():
+    assert normalize_tools('hmmer hotpep diamond') == normalize_tools('diamond,HMMER, hotpep') == \
+        normalize_tools('all') == ['diamond', 'hmmer', 'hotpep']
+    assert normalize_args('--dia_cpu 8 --hmm_cpu=4 --hmm_eval 1e-15') == ['--hmm_eval', '1e-15']
+
+
+def test_fresh_until_something_changes(genome):
+    genome_dir, fasta, db_dir = genome
+    assert not is_fresh(str(genome_dir), key_of(genome))
+    assert write_manifest(str(genome_dir), key_of(genome)) is not None
+    assert is_fresh(str(genome_dir), key_of(genome))
+
+    # tool order and thread counts do not change the results
+    assert is_fresh(str(genome_dir), key_of(genome, tools='diamond,hmmer,hotpep', dbcan_args='--dia_cpu 3'))
+    assert not is_fresh(str(genome_dir), key_of(genome, tools='diamond'))
+    assert not is_fresh(str(genome_dir), key_of(genome, seq_type='prok'))
+    assert not is_fresh(str(genome_dir), key_of(genome, dbcan_args='--hmm_eval 1e-10'))
+
+    # a touched but identical input is hashed again and still matches
+    os.utime(str(fasta), ns=(0, 0))
+    assert is_fresh(str(genome_dir), key_of(genome))
+    fasta.write_text(">contig_1_1\nMKTAYIAKQRQISFVKSHFSRW\n")
+    assert not is_fresh(str(genome_dir), key_of(genome))
+
+
+def test_database_change_makes_stale(genome):
+    genome_dir, fasta, db_dir = genome
+    write_manifest(str(genome_dir), key_of(genome))
+    (db_dir / 'CAZy.dmnd').write_bytes(b'newer reference')
+    assert not is_fresh(str(genome_dir), key_of(genome))
+
+
+def test_damaged_outputs_make_stale(genome):
+    genome_dir, fasta, db_dir = genome
+    write_manifest(str(genome_dir), key_of(genome))
+    with open(str(genome_dir / 'diamond.out'), 'a') as f_out:
+        f_out.write('partial\n')
+    assert not is_fresh(str(genome_dir), key_of(genome))
+    os.remove(str(genome_dir / 'diamond.out'))
+    assert not is_fresh(str(genome_dir), key_of(genome))
+
+
+def test_missing_output_writes_no_manifest(genome):
+    genome_dir, fasta, db_dir = genome
+    os.remove(str(genome_dir / 'Hotpep.out'))
+    assert write_manifest(str(genome_dir), key_of(genome)) is None
+    assert read_manifest(str(genome_dir)) is None
+
+
+def test_peptide_index_entries(genome):
+    genome_dir, fasta, db_dir = genome
+    write_manifest(str(genome_dir), key_of(genome, hotpep_index=True))
+    assert is_fresh(str(genome_dir), key_of(genome, hotpep_index=True))
+    assert not is_fresh(str(genome_dir), key_of(genome))
+    # without Hotpep among the tools the peptide index plays no part
+    assert key_of(genome, tools='diamond', hotpep_index=True) == key_of(genome, tools='diamond')
+
+
+def cli(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', ['result_cache.py'] + list(args))
+    result_cache.main()
+    return capsys.readouterr()
+
+
+def test_cli_checks_peptide_index_entries(genome, monkeypatch, capsys):
+    genome_dir, fasta, db_dir = genome
+    write_manifest(str(genome_dir), key_of(genome, hotpep_index=True))
+    data_dir = str(genome_dir.parent)
+    check = ['-d', data_dir, '-db', str(db_dir), '-s', 'protein']
+
+    assert cli(monkeypatch, capsys, 'list', *check, '--hotpep-index').out.split('\t')[2] == 'fresh'
+    assert cli(monkeypatch, capsys, 'list', *check).out.split('\t')[2] == 'stale'
+
+    cli(monkeypatch, capsys, 'evict', *check, '--hotpep-index', '--stale')
+    assert read_manifest(str(genome_dir)) is not None
+    cli(monkeypatch, capsys, 'evict', *check, '--stale')
+    assert read_manifest(str(genome_dir)) is None
+    assert not os.path.exists(str(genome_dir / 'diamond.out'))
@@ -0,0 +1,63 @@
+"""
+CPU budget and process pool of the per-genome jobs
+"""
+
+# --- standard imports ---#
+import os
+import logging
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import scheduler
+
+
+def square(x):
+    if x < 0:
+        raise ValueError("negative input {}".format(x))
+    return x * x
+
+
+def affinity():
+    return sorted(os.sched_getaffinity(0))
+
+
+@pytest.mark.parametrize('jobs,threads,expected', [(0, None, (4, 4)), (0, 8, (2, 8)), (4, None, (4, 4)),
+                                                   (3, 2, (3, 2)), (32, None, (32, 1))])
+def test_cpu_budget(monkeypatch, jobs, threads, expected):
+    monkeypatch.setattr(scheduler, 'available_cpu_cores', lambda: 16)
+    assert scheduler.cpu_budget(jobs, threads) == expected
+
+
+def test_cpu_budget_warns_on_oversubscription(monkeypatch, caplog):
+    monkeypatch.setattr(scheduler, 'available_cpu_cores', lambda: 4)
+    with caplog.at_level(logging.WARNING):
+        assert scheduler.cpu_budget(2, 4) == (2, 4)
+    assert 'exceeds the 4 available CPU cores' in caplog.text
+
+
+def test_cpu_slices_partition_the_affinity_mask(monkeypatch):
+    monkeypatch.setattr(scheduler.os, 'sched_getaffinity', lambda pid: {0, 2, 4, 6, 8, 10})
+    assert scheduler.cpu_slices(3, 2) == [{0, 2}, {4, 6}, {8, 10}]
+    assert scheduler.cpu_slices(4, 2) == []
+
+
+def test_run_jobs_collects_results_and_failures(caplog):
+    tasks = [dict(x=x) for x in (3, -1, 5)]
+    with caplog.at_level(logging.INFO):
+        results = scheduler.run_jobs(square, tasks, jobs=2, threads_per_job=1,
+                                     label=lambda task: 'x={}'.format(task['x']))
+    assert sorted((task['x'], result) for task, result in results) == [(-1, None), (3, 9), (5, 25)]
+    assert 'failed x=-1: negative input -1' in caplog.text
+
+
+def test_worker_pool_is_reused_and_pins_workers():
+    cpus = sorted(os.sched_getaffinity(0))
+    with scheduler.worker_pool(jobs=len(cpus), threads_per_job=1) as executor:
+        first = scheduler.run_jobs(square, [dict(x=2)], jobs=len(cpus), threads_per_job=1, executor=executor)
+        masks = scheduler.run_jobs(affinity, [dict() for _ in cpus], jobs=len(cpus), threads_per_job=1,
+                                   executor=executor)
+    assert first[0][1] == 4
+    # every worker holds a single CPU of the mask
+    assert all(len(mask) == 1 and mask[0] in cpus for task, mask in masks)
@@ -0,0 +1,53 @@
+"""
+shard plans of a genome listing
+"""
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+import sharding
+
+
+def make_genomes(root, names):
+    files = []
+    for i, name in enumerate(names):
+        genome_dir = root / name
+        genome_dir.mkdir()
+        fn = genome_dir / 'genome.fasta'
+        fn.write_text(">contig\n" + "ACGT" * (i + 1) + "\n")
+        files.append(str(fn))
+    return files
+
+
+def test_shards_cover_every_genome_once(tmp_path):
+    files = make_genomes(tmp_path, ["g{}".format(i) for i in range(7)])
+    shards = [sharding.select_shard(str(tmp_path), files, i, 3) for i in range(3)]
+    assert sorted(fn for shard in shards for fn in shard) == sorted(files)
+
+
+def test_plan_key_ignores_listing_order(tmp_path):
+    files = make_genomes(tmp_path, ['a', 'b', 'c'])
+    assert sharding.plan_key(files) == sharding.plan_key(files[::-1])
+    assert sharding.plan_key(files) != sharding.plan_key(files[:2])
+
+
+def test_genomes_added_after_a_plan_are_planned_again(tmp_path):
+    out_dir = str(tmp_path / 'out')
+    files = make_genomes(tmp_path, ['a', 'b', 'c'])
+    for i in range(2):
+        shard = sharding.select_shard(out_dir, files, i, 2)
+        sharding.write_marker(out_dir, i, 2, shard, sharding.plan_key(files))
+
+    grown = files + make_genomes(tmp_path, ['d'])
+    shards = [sharding.select_shard(out_dir, grown, i, 2) for i in range(2)]
+    assert sorted(fn for shard in shards for fn in shard) == sorted(grown)
+
+    # the markers of the old plan do not count for the new one
+    assert sharding.latest_plan(out_dir, 2) == sharding.plan_key(grown)
+    assert sorted(sharding.gather(out_dir, 2)) == [0, 1]
+
+
+def test_gather_without_a_plan(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        sharding.gather(str(tmp_path), 4)
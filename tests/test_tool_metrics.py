@@ -0,0 +1,87 @@
+"""
+resource records of the shell commands and of the tools behind the wrappers
+"""
+
+# --- standard imports ---#
+import io
+import os
+import sys
+import json
+
+# --- third party imports ---#
+import pytest
+
+# --- project specific imports ---#
+from profiles import SHIM_ENV
+from tool_metrics import install_shims, summarize
+from utils import METRICS_ENV, parse_diamond_phases, run_shell_command
+
+DIAMOND_STDERR = '''diamond v0.9.24.125 | by Benjamin Buchfink
+Processing query block 1, reference block 1/1, shape 1/2.
+Building reference seed array...  [0.512s]
+Searching alignments...  [1.25s]
+Processing query block 1, reference block 1/1, shape 2/2.
+Building reference seed array...  [0.488s]
+Searching alignments...  [1.5s]
+Total time = 4.1s
+Reported 12 pairwise alignments, 12 HSPs.
+'''
+
+# writes the stderr of a DIAMOND run, standing in for the real executable
+DIAMOND = '''#!{python}
+import sys
+sys.stderr.write({stderr!r})
+'''
+
+
+def read_records(metrics_file):
+    with open(str(metrics_file)) as f_in:
+        return [json.loads(line) for line in f_in]
+
+
+def test_diamond_phases():
+    phases = parse_diamond_phases(DIAMOND_STDERR.splitlines(True))
+    assert [(p['phase'], p['block'], p['seconds']) for p in phases] == [
+        ('Building reference seed array', 'query block 1, reference block 1/1, shape 1/2', 0.512),
+        ('Searching alignments', 'query block 1, reference block 1/1, shape 1/2', 1.25),
+        ('Building reference seed array', 'query block 1, reference block 1/1, shape 2/2', 0.488),
+        ('Searching alignments', 'query block 1, reference block 1/1, shape 2/2', 1.5),
+        ('Total time', None, 4.1)]
+
+
+def test_shell_commands_are_recorded(tmp_path, monkeypatch):
+    metrics_file = tmp_path / 'metrics.jsonl'
+    monkeypatch.setenv(METRICS_ENV, str(metrics_file))
+    sink = io.StringIO()
+    cmd = "{} -c 'import sys; sum(range(10 ** 6)); sys.stderr.write(\"done\\n\")'".format(sys.executable)
+    assert run_shell_command(cmd, logfile=sink, tags=dict(genome='100001', tool='run_dbcan'))
+    assert not run_shell_command("exit 3", logfile=sink, tags=dict(genome='100002'))
+    assert sink.getvalue() == "done\n"
+
+    ok, failed = read_records(metrics_file)
+    assert (ok['genome'], ok['tool'], ok['cmd'], ok['returncode']) == ('100001', 'run_dbcan', cmd, 0)
+    assert ok['user_seconds'] + ok['system_seconds'] > 0 and ok['max_rss_kb'] > 0 and ok['wall_seconds'] > 0
+    assert (failed['genome'], failed['returncode']) == ('100002', 3)
+
+
+def test_wrapped_tools_are_recorded_with_their_phases(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'diamond').write_text(DIAMOND.format(python=sys.executable, stderr=DIAMOND_STDERR))
+    (bin_dir / 'diamond').chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv(SHIM_ENV, '')
+    metrics_file = tmp_path / 'metrics.jsonl'
+    monkeypatch.setenv(METRICS_ENV, str(metrics_file))
+    install_shims(str(tmp_path / 'shims'), names=['diamond'])
+
+    sink = io.StringIO()
+    assert run_shell_command("diamond blastp -q x.faa", logfile=sink, tags=dict(genome='100001', tool='run_dbcan'))
+    assert sink.getvalue() == DIAMOND_STDERR
+    tool, shell = read_records(metrics_file)
+    assert (tool['tool'], tool['genome'], tool['cmd']) == ('DIAMOND', '100001', 'diamond blastp -q x.faa')
+    assert len(tool['diamond_phases']) == 5 and shell['tool'] == 'run_dbcan'
+
+    tools, phases = summarize(str(metrics_file))
+    assert tools['DIAMOND']['runs'] == 1 and tools['run_dbcan']['runs'] == 1
+    assert phases['Searching alignments'] == pytest.approx(2.75)